@@ -0,0 +1,53 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from app.api.routes import verify_admin_key
+from app.config import get_settings
+from app.models.adapters import adapter_registry
+
+# Adapters name files on the server, so only admins manage them
+router = APIRouter(dependencies=[Depends(verify_admin_key)])
+
+class AdapterCreate(BaseModel):
+    name: str = Field(..., description="Identifier clients pass as adapter")
+    path: str = Field(..., description="LoRA file on the server")
+    scale: float = Field(1.0, description="Strength the adapter is applied with")
+    api_keys: List[str] = Field([], description="Keys that use this adapter by default and alone may name it; empty lets any key name it")
+
+class AdapterResponse(BaseModel):
+    name: str
+    path: str
+    scale: float
+    api_keys: int
+    size_bytes: int
+
+@router.post("", response_model=AdapterResponse)
+async def register_adapter(adapter_create: AdapterCreate):
+    """Register an adapter; it is loaded onto the model by the first request that uses it"""
+    if not get_settings().LORA_ENABLED:
+        raise HTTPException(
+            status_code=status.HTTP_501_NOT_IMPLEMENTED,
+            detail="LoRA adapters are disabled; set LORA_ENABLED=true"
+        )
+    try:
+        adapter = adapter_registry.register(
+            adapter_create.name, adapter_create.path, adapter_create.scale, adapter_create.api_keys
+        )
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+    return AdapterResponse(**adapter.to_dict())
+
+@router.get("", response_model=List[AdapterResponse])
+async def list_adapters():
+    """List registered adapters"""
+    return [AdapterResponse(**adapter.to_dict()) for adapter in adapter_registry.list()]
+
+@router.delete("/{name}")
+async def delete_adapter(name: str):
+    """Stop routing requests to an adapter"""
+    if not adapter_registry.unregister(name):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Adapter not found"
+        )
+    return {"status": "success", "message": "Adapter removed"}
@@ -0,0 +1,44 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import PlainTextResponse
+from app.api.routes import verify_admin_key
+from app.config import get_settings
+from app.profiling import ProfilerBusyError, loop_monitor, sampling_profiler
+
+router = APIRouter(dependencies=[Depends(verify_admin_key)])
+
+@router.get("/profile")
+async def profile(
+    seconds: float = Query(10.0, gt=0, description="How long to sample"),
+    format: str = Query("collapsed", pattern="^(collapsed|json)$", description="collapsed stacks as text, or JSON with top frames"),
+    idle: bool = Query(False, description="Keep samples of threads parked waiting for work"),
+    interval_ms: float = Query(None, gt=0, description="Time between samples, defaults to PROFILE_INTERVAL_MS")
+):
+    """Sample every thread's Python stack for `seconds` and return flamegraph-ready collapsed stacks"""
+    settings = get_settings()
+    if seconds > settings.PROFILE_MAX_SECONDS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"seconds must be at most {settings.PROFILE_MAX_SECONDS}"
+        )
+    try:
+        result = await sampling_profiler.profile(seconds, interval_ms or settings.PROFILE_INTERVAL_MS, idle)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+    if format == "collapsed":
+        return PlainTextResponse(
+            sampling_profiler.collapsed(result["stacks"]),
+            headers={"X-Profile-Samples": str(result["samples"]), "X-Profile-Seconds": str(result["duration_seconds"])}
+        )
+    return {
+        "duration_seconds": result["duration_seconds"],
+        "interval_ms": result["interval_ms"],
+        "samples": result["samples"],
+        "top_frames": sampling_profiler.top_frames(result["stacks"]),
+        "collapsed": sampling_profiler.collapsed(result["stacks"]).splitlines(),
+    }
+
+@router.get("/loop")
+async def loop_lag():
+    """Event loop lag percentiles and the stacks of recent stalls over LOOP_LAG_THRESHOLD_MS"""
+    return loop_monitor.report()
@@ -0,0 +1,48 @@
+from fastapi import APIRouter, HTTPException, status
+from app.models.backend import get_model
+from app.models.memory import memory_governor
+from app.placement import cpu_placement
+
+router = APIRouter()
+
+@router.get("/memory")
+async def memory_diagnostics():
+    """Memory limit, committed footprint by component, in-flight reservations and admission counters"""
+    return memory_governor.breakdown()
+
+@router.get("/placement")
+async def placement_diagnostics():
+    """NUMA topology and which CPUs inference and the event loop are pinned to"""
+    return cpu_placement.report()
+
+@router.get("/kv")
+async def kv_diagnostics():
+    """KV cache element types and the bytes each active sequence holds"""
+    model = get_model()
+    if not model._initialized:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Model is not loaded yet")
+    return model.kv_usage()
+
+@router.get("/adapters")
+async def adapter_diagnostics():
+    """Applied and resident LoRA adapters, their load and switch times, and how often the queue regrouped"""
+    model = get_model()
+    if not hasattr(model, "adapter_stats"):
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="LoRA adapters require the llama_cpp backend")
+    return model.adapter_stats()
+
+@router.get("/scheduler")
+async def scheduler_diagnostics():
+    """Step scheduler counters with time-to-first-token and inter-token latency percentiles"""
+    model = get_model()
+    if not hasattr(model, "scheduler_stats"):
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="The step scheduler requires the llama_cpp backend")
+    return model.scheduler_stats()
+
+@router.get("/grammars")
+async def grammar_diagnostics():
+    """Compiled grammar cache hits and misses, compile time, and tokens saved by stopping at the JSON close"""
+    model = get_model()
+    if not hasattr(model, "grammar_stats"):
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="response_format requires the llama_cpp backend")
+    return model.grammar_stats()
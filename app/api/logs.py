@@ -0,0 +1,78 @@
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, status, Query
+from pydantic import BaseModel
+from typing import List, Optional
+from datetime import datetime, timezone
+from app.api.routes import verify_admin_key
+from app.models.request_log import request_log, LogFilter
+
+router = APIRouter(dependencies=[Depends(verify_admin_key)])
+
+class RequestLogEntry(BaseModel):
+    timestamp: datetime
+    request_id: str
+    api_key: Optional[str] = None
+    method: str
+    endpoint: str
+    status: int
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    latency_ms: float
+
+class RequestLogPage(BaseModel):
+    entries: List[RequestLogEntry]
+    next_cursor: Optional[str] = None
+
+def _to_epoch(value: Optional[datetime]) -> Optional[float]:
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+@router.get("", response_model=RequestLogPage)
+async def list_logs(
+    key: Optional[str] = Query(None, description="Only requests made with the API key of this id, as listed in api_key"),
+    endpoint: Optional[str] = Query(None, description="Only requests to this path, e.g. /api/chat"),
+    status_code: Optional[int] = Query(None, alias="status", description="Only requests that returned this status"),
+    start: Optional[datetime] = Query(None, description="Range start"),
+    end: Optional[datetime] = Query(None, description="Range end"),
+    limit: int = Query(50, ge=1, le=500, description="Entries per page"),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page")
+):
+    """Structured request log, newest first, paginated with a keyset cursor"""
+    before = None
+    if cursor:
+        try:
+            ts, request_id = cursor.split(":", 1)
+            before = (float(ts), request_id)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Invalid cursor"
+            )
+    log_filter = LogFilter(
+        api_key=key,
+        endpoint=endpoint,
+        status=status_code,
+        since=_to_epoch(start),
+        until=_to_epoch(end),
+        before=before
+    )
+    rows = await asyncio.get_event_loop().run_in_executor(None, request_log.query, log_filter, limit)
+    entries = [
+        RequestLogEntry(
+            timestamp=datetime.fromtimestamp(row["ts"], tz=timezone.utc),
+            **{name: value for name, value in row.items() if name != "ts"}
+        )
+        for row in rows
+    ]
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = f"{rows[-1]['ts']!r}:{rows[-1]['request_id']}"
+    return RequestLogPage(entries=entries, next_cursor=next_cursor)
+
+@router.get("/stats")
+async def log_stats():
+    """Ring buffer occupancy and flush counters"""
+    return request_log.stats()
@@ -1,17 +1,29 @@
 from fastapi import APIRouter, HTTPException, status, Depends, Header, UploadFile, File
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any, List
-from app.models.llama_model import LlamaModel
+from typing import Optional, Dict, Any, List, AsyncIterator, Literal
+from app.config import get_settings
+from app.models.backend import get_model
 from app.api.api_keys import router as api_key_router
 from app.models.database import get_db, APIKeyModel
+from app.models.usage import usage_meter
+from app.models.templates import template_registry
+from app.models.adapters import LoraAdapter, adapter_registry
+from app.models.coalescing import single_flight, request_key, is_deterministic
+from app.models.memory import memory_governor, MemoryPressureError, Reservation, estimate_tokens
+from app.models.capture import traffic_capture, request_shape
+from app.tracing import span, tag_request
 from sqlalchemy.orm import Session
 from datetime import datetime
+import json
+import math
 import os
+import time
 import aiofiles
 import shutil
 
 router = APIRouter()
-model = LlamaModel()
+model = get_model()
 
 # Include API key routes
 router.include_router(api_key_router, prefix="/keys", tags=["api-keys"])
@@ -114,16 +126,8 @@ async def list_uploads():
             detail=f"Failed to list uploads: {str(e)}"
         )
 
-async def verify_api_key(api_key: str = Header(..., alias="Authorization"), db: Session = Depends(get_db)):
-    """Verify API key and update last used timestamp"""
-    if not api_key.startswith("Bearer "):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid authentication scheme"
-        )
-    
-    key = api_key.split(" ")[1]
-    
+def authenticate_key(key: str, db: Session) -> Optional[APIKeyModel]:
+    """The active API key record for `key`, with its last used timestamp updated"""
     # Accept test-key for development
     if key == "test-key":
         return APIKeyModel(
@@ -133,22 +137,71 @@ async def verify_api_key(api_key: str = Header(..., alias="Authorization"), db:
             is_active=True
         )
     
-    db_key = db.query(APIKeyModel).filter(
-        APIKeyModel.key == key,
-        APIKeyModel.is_active == True
-    ).first()
-    
-    if not db_key:
+    with span("db"):
+        db_key = db.query(APIKeyModel).filter(
+            APIKeyModel.key == key,
+            APIKeyModel.is_active == True
+        ).first()
+        if db_key:
+            # Update last used timestamp
+            db_key.last_used = datetime.utcnow()
+            db.commit()
+    return db_key
+
+async def verify_api_key(api_key: str = Header(..., alias="Authorization"), db: Session = Depends(get_db)):
+    """Verify API key and update last used timestamp"""
+    with span("auth"):
+        if not api_key.startswith("Bearer "):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid authentication scheme"
+            )
+        
+        key = api_key.split(" ")[1]
+        db_key = authenticate_key(key, db)
+        if not db_key:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid API key"
+            )
+        # Only keys that authenticated reach the request log, and it stores their hash
+        tag_request(api_key=key)
+        return db_key
+
+async def optional_api_key(api_key: Optional[str] = Header(None, alias="Authorization"), db: Session = Depends(get_db)):
+    """Verify the API key when one is sent, for endpoints that also serve anonymous callers"""
+    if api_key is None:
+        return None
+    return await verify_api_key(api_key, db)
+
+def is_admin_key(api_key: APIKeyModel) -> bool:
+    admin_keys = {key.strip() for key in get_settings().ADMIN_API_KEYS.split(",") if key.strip()}
+    return api_key.key in admin_keys
+
+async def verify_admin_key(api_key: APIKeyModel = Depends(verify_api_key)):
+    """Allow only the keys listed in ADMIN_API_KEYS"""
+    if not is_admin_key(api_key):
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid API key"
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin API key required"
         )
-    
-    # Update last used timestamp
-    db_key.last_used = datetime.utcnow()
-    db.commit()
-    
-    return db_key
+    return api_key
+
+async def enforce_quota(api_key: APIKeyModel = Depends(verify_api_key)):
+    """Reject the request before it reaches the model if the key's token bucket is empty"""
+    retry_after = usage_meter.check_quota(api_key.key)
+    if retry_after > 0:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Token quota exceeded",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+    return api_key
+
+class ResponseFormat(BaseModel):
+    type: Literal["json_object", "json_schema", "grammar"] = Field(..., description="Any JSON object, JSON matching json_schema, or text matching a GBNF grammar")
+    json_schema: Optional[Dict[str, Any]] = Field(None, description="JSON schema the output must match, for type json_schema")
+    grammar: Optional[str] = Field(None, description="GBNF grammar with a root rule, for type grammar")
 
 class ChatRequest(BaseModel):
     prompt: str = Field(..., description="The input prompt to send to the model")
@@ -156,23 +209,204 @@ class ChatRequest(BaseModel):
     temperature: Optional[float] = Field(None, description="Sampling temperature (0.0 to 1.0)")
     top_p: Optional[float] = Field(None, description="Nucleus sampling parameter")
     top_k: Optional[int] = Field(None, description="Top-k sampling parameter")
+    template_id: Optional[str] = Field(None, description="Registered template whose prefix precedes the prompt")
+    seed: Optional[int] = Field(None, description="Sampling seed; seeded or temperature 0 requests are deterministic")
+    stream: bool = Field(False, description="Stream tokens as server-sent events")
+    adapter: Optional[str] = Field(None, description="LoRA adapter to generate with; defaults to the one registered for the API key")
+    response_format: Optional[ResponseFormat] = Field(None, description="Constrain the output to JSON or a grammar")
 
 class ChatResponse(BaseModel):
     text: str
-    usage: Dict[str, int]
+    usage: Dict[str, Any]
+
+async def _collect(events: AsyncIterator[Dict[str, Any]]) -> Dict[str, Any]:
+    """Assemble a streamed generation into the non-streaming response shape"""
+    parts = []
+    usage: Dict[str, Any] = {}
+    async for event in events:
+        if "text" in event:
+            parts.append(event["text"])
+        else:
+            usage = event["usage"]
+    return {"text": "".join(parts).strip(), "usage": usage}
+
+async def _governed(events: AsyncIterator[Dict[str, Any]], reservation: Reservation) -> AsyncIterator[Dict[str, Any]]:
+    """Hold the request's memory reservation until its generation finishes"""
+    try:
+        async for event in events:
+            yield event
+    finally:
+        reservation.release()
+
+def reserve_memory(prompt: str, max_tokens: Optional[int]) -> Reservation:
+    """Admit a generation against the memory budget or answer 503"""
+    try:
+        return memory_governor.reserve(estimate_tokens(prompt), max_tokens)
+    except MemoryPressureError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(math.ceil(e.retry_after))}
+        )
+
+async def _stream_events(events: AsyncIterator[Dict[str, Any]], api_key: APIKeyModel, started: float):
+    try:
+        async for event in events:
+            if "usage" in event:
+                tag_request(prompt_tokens=event["usage"]["prompt_tokens"], completion_tokens=event["usage"]["completion_tokens"])
+                usage_meter.record(
+                    api_key.key,
+                    event["usage"]["prompt_tokens"],
+                    event["usage"]["completion_tokens"],
+                    (time.perf_counter() - started) * 1000
+                )
+            yield f"data: {json.dumps(event)}\n\n"
+    except Exception as e:
+        yield f"data: {json.dumps({'error': f'Error during chat generation: {str(e)}'})}\n\n"
+    yield "data: [DONE]\n\n"
+
+def resolve_template(template_id: Optional[str]):
+    """The registered template a request names, or 404"""
+    if template_id is None:
+        return None
+    template = template_registry.get(template_id)
+    if template is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Template '{template_id}' not found"
+        )
+    return template
+
+def resolve_adapter(name: Optional[str], api_key: APIKeyModel) -> Optional[LoraAdapter]:
+    """The LoRA adapter a request names, or the one registered for its API key"""
+    if name is None:
+        adapter = adapter_registry.for_key(api_key.key)
+    else:
+        adapter = adapter_registry.get(name)
+        if adapter is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Adapter '{name}' not found"
+            )
+        if not adapter.allowed(api_key.key):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail=f"Adapter '{name}' is not available to this API key"
+            )
+    if adapter is not None and not hasattr(model, "adapter_stats"):
+        raise HTTPException(
+            status_code=status.HTTP_501_NOT_IMPLEMENTED,
+            detail="LoRA adapters require the llama_cpp backend"
+        )
+    return adapter
+
+async def resolve_grammar(response_format: Optional[ResponseFormat]):
+    """The compiled grammar a response_format asks for, or 422 when it does not compile"""
+    if response_format is None:
+        return None
+    if not hasattr(model, "compile_grammar"):
+        raise HTTPException(
+            status_code=status.HTTP_501_NOT_IMPLEMENTED,
+            detail="response_format requires the llama_cpp backend"
+        )
+    try:
+        return await model.compile_grammar(response_format.type, response_format.json_schema, response_format.grammar)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(e)
+        )
+
+def _generation_params(request: ChatRequest) -> Dict[str, Any]:
+    return dict(
+        prompt=request.prompt,
+        max_tokens=request.max_tokens,
+        temperature=request.temperature,
+        top_p=request.top_p,
+        top_k=request.top_k,
+        seed=request.seed
+    )
+
+def stream_generation(request: ChatRequest, template, adapter: Optional[LoraAdapter] = None, grammar=None) -> AsyncIterator[Dict[str, Any]]:
+    """Token events for a chat request, admitted against the memory budget"""
+    params = _generation_params(request)
+    if adapter is not None:
+        params["adapter"] = adapter
+    if grammar is not None:
+        params["grammar"] = grammar
+    prompt_text = (template.prefix if template else "") + request.prompt
+    
+    # Identical deterministic requests share one generation, streamed or not;
+    # only the request that starts a generation reserves memory for it
+    if is_deterministic(request.temperature, request.seed):
+        key = request_key(
+            template_id=request.template_id,
+            **{**params, "adapter": adapter.name if adapter else None, "grammar": grammar.key if grammar else None}
+        )
+        reservation = None
+        if key not in single_flight:
+            reservation = reserve_memory(prompt_text, request.max_tokens)
+        return single_flight.join(
+            key, lambda: _governed(model.generate_stream(template=template, **params), reservation)
+        )
+    reservation = reserve_memory(prompt_text, request.max_tokens)
+    return _governed(model.generate_stream(template=template, **params), reservation)
+
+def chat_shape(endpoint: str, request: ChatRequest, template, key: str, **fields) -> Dict[str, Any]:
+    """Capture record for a chat request; prompt length includes the template prefix"""
+    return request_shape(
+        endpoint,
+        estimate_tokens((template.prefix if template else "") + request.prompt),
+        request.max_tokens,
+        request.temperature,
+        request.top_p,
+        request.top_k,
+        request.seed,
+        request.stream,
+        key=key,
+        tpl=request.template_id,
+        **fields
+    )
 
 @router.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest, api_key: APIKeyModel = Depends(verify_api_key)):
+async def chat(request: ChatRequest, api_key: APIKeyModel = Depends(enforce_quota)):
     """
     Chat with the LLaMA model.
     """
+    template = resolve_template(request.template_id)
+    adapter = resolve_adapter(request.adapter, api_key)
+    grammar = await resolve_grammar(request.response_format)
+    params = _generation_params(request)
+    if adapter is not None:
+        params["adapter"] = adapter
+    if grammar is not None:
+        params["grammar"] = grammar
+    started = time.perf_counter()
+    if traffic_capture.enabled:
+        tag_request(capture=chat_shape("api_chat", request, template, api_key.key))
+    
+    events = None
+    reservation = None
+    if request.stream or is_deterministic(request.temperature, request.seed):
+        events = stream_generation(request, template, adapter, grammar)
+    else:
+        reservation = reserve_memory((template.prefix if template else "") + request.prompt, request.max_tokens)
+    
+    if request.stream:
+        return StreamingResponse(_stream_events(events, api_key, started), media_type="text/event-stream")
+    
     try:
-        response = await model.generate_response(
-            prompt=request.prompt,
-            max_tokens=request.max_tokens,
-            temperature=request.temperature,
-            top_p=request.top_p,
-            top_k=request.top_k
+        if events is not None:
+            response = await _collect(events)
+        else:
+            with reservation:
+                response = await model.generate_response(template=template, **params)
+        tag_request(prompt_tokens=response["usage"]["prompt_tokens"], completion_tokens=response["usage"]["completion_tokens"])
+        usage_meter.record(
+            api_key.key,
+            response["usage"]["prompt_tokens"],
+            response["usage"]["completion_tokens"],
+            (time.perf_counter() - started) * 1000
         )
         return response
     except Exception as e:
@@ -181,6 +415,84 @@ async def chat(request: ChatRequest, api_key: APIKeyModel = Depends(verify_api_k
             detail=f"Error during chat generation: {str(e)}"
         )
 
+class ScoreRequest(BaseModel):
+    prompt: str = Field(..., description="Shared context every candidate continues")
+    candidates: List[str] = Field(..., min_length=1, description="Continuations to score")
+
+class TokenLogprob(BaseModel):
+    token: str
+    logprob: float
+
+class CandidateScore(BaseModel):
+    text: str
+    logprob: float
+    tokens: List[TokenLogprob]
+
+class ScoreResponse(BaseModel):
+    candidates: List[CandidateScore]
+    best: int
+    usage: Dict[str, Any]
+
+@router.post("/score", response_model=ScoreResponse)
+async def score(request: ScoreRequest, api_key: APIKeyModel = Depends(enforce_quota)):
+    """
+    Log-likelihood of each candidate continuation of the prompt.
+    """
+    if not hasattr(model, "score"):
+        raise HTTPException(
+            status_code=status.HTTP_501_NOT_IMPLEMENTED,
+            detail="Scoring requires the llama_cpp backend"
+        )
+    settings = get_settings()
+    if len(request.candidates) > settings.SCORE_MAX_CANDIDATES:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"At most {settings.SCORE_MAX_CANDIDATES} candidates per request"
+        )
+    # Each candidate is evaluated after the shared prompt, so cost follows their total length
+    candidate_tokens = sum(estimate_tokens(candidate) for candidate in request.candidates)
+    if candidate_tokens > settings.SCORE_MAX_CANDIDATE_TOKENS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Candidates total about {candidate_tokens} tokens, at most {settings.SCORE_MAX_CANDIDATE_TOKENS} per request"
+        )
+    empty = [i for i, candidate in enumerate(request.candidates) if not candidate.strip()]
+    if empty:
+        # An empty continuation has no tokens to score, so its log-probability of 0 would always win
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Candidates must not be empty or whitespace only (index {', '.join(map(str, empty))})"
+        )
+    started = time.perf_counter()
+    if traffic_capture.enabled:
+        tag_request(capture=request_shape(
+            "score",
+            estimate_tokens(request.prompt),
+            key=api_key.key,
+            n=len(request.candidates),
+            cpt=round(sum(estimate_tokens(c) for c in request.candidates) / len(request.candidates))
+        ))
+    
+    try:
+        with reserve_memory(request.prompt + "".join(request.candidates), 0):
+            result = await model.score(request.prompt, request.candidates)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(e)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error during scoring: {str(e)}"
+        )
+    
+    usage = result["usage"]
+    tag_request(prompt_tokens=usage["prompt_tokens"], completion_tokens=0)
+    usage_meter.record(api_key.key, usage["prompt_tokens"], 0, (time.perf_counter() - started) * 1000)
+    best = max(range(len(result["candidates"])), key=lambda i: result["candidates"][i]["logprob"])
+    return ScoreResponse(best=best, **result)
+
 @router.get("/health")
 async def health_check():
     """
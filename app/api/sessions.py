@@ -0,0 +1,72 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from datetime import datetime
+import asyncio
+from app.api.routes import verify_api_key
+from app.models.database import APIKeyModel
+from app.models.sessions import ChatSession, session_store
+
+router = APIRouter()
+
+class SessionCreate(BaseModel):
+    title: Optional[str] = Field(None, description="Optional display name for the session")
+    system_prompt: Optional[str] = Field(None, description="System message kept at the start of the transcript")
+
+class SessionSummary(BaseModel):
+    id: str
+    title: str
+    preview: str
+    created_at: datetime
+    updated_at: datetime
+    messages: int
+
+class SessionMessage(BaseModel):
+    role: str
+    content: str
+
+class SessionDetail(SessionSummary):
+    transcript: List[SessionMessage]
+
+async def owned_session(session_id: str, api_key: Optional[str]) -> ChatSession:
+    """The session if `api_key` created it; other keys get the same 404 as a missing session"""
+    session = await asyncio.get_event_loop().run_in_executor(None, session_store.get, session_id)
+    if session is None or session.api_key != api_key:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Session not found"
+        )
+    return session
+
+@router.post("", response_model=SessionSummary)
+async def create_session(session_create: SessionCreate, api_key: APIKeyModel = Depends(verify_api_key)):
+    """Start a conversation whose history is kept on the server"""
+    session = await asyncio.get_event_loop().run_in_executor(
+        None,
+        lambda: session_store.create(title=session_create.title, system_prompt=session_create.system_prompt, api_key=api_key.key)
+    )
+    return SessionSummary(**session.summary())
+
+@router.get("", response_model=List[SessionSummary])
+async def list_sessions(api_key: APIKeyModel = Depends(verify_api_key)):
+    """List the caller's saved sessions, most recently updated first"""
+    summaries = await asyncio.get_event_loop().run_in_executor(None, session_store.list, api_key.key)
+    return [SessionSummary(**summary) for summary in summaries]
+
+@router.get("/{session_id}", response_model=SessionDetail)
+async def get_session(session_id: str, api_key: APIKeyModel = Depends(verify_api_key)):
+    """Get a session with its full transcript"""
+    session = await owned_session(session_id, api_key.key)
+    return SessionDetail(**session.summary(), transcript=session.messages())
+
+@router.delete("/{session_id}")
+async def delete_session(session_id: str, api_key: APIKeyModel = Depends(verify_api_key)):
+    """Delete a session"""
+    await owned_session(session_id, api_key.key)
+    removed = await asyncio.get_event_loop().run_in_executor(None, session_store.delete, session_id)
+    if not removed:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Session not found"
+        )
+    return {"status": "success", "message": "Session deleted"}
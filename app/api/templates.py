@@ -0,0 +1,71 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from app.api.routes import verify_admin_key
+from app.config import get_settings
+from app.models.backend import get_model
+from app.models.memory import estimate_tokens
+from app.models.templates import TemplateTooLongError, template_registry
+
+router = APIRouter()
+
+class TemplateCreate(BaseModel):
+    id: str = Field(..., description="Identifier clients pass as template_id")
+    name: Optional[str] = Field(None, description="Display name")
+    prefix: str = Field(..., description="Fixed text placed before the variable part of each prompt")
+
+class TemplateResponse(BaseModel):
+    id: str
+    name: str
+    prefix_tokens: Optional[int] = None
+
+@router.post("", response_model=TemplateResponse, dependencies=[Depends(verify_admin_key)])
+async def register_template(template_create: TemplateCreate):
+    """Register a template and evaluate its prefix snapshot if the model is loaded"""
+    model = get_model()
+    context_length = get_settings().CONTEXT_LENGTH
+    if not model._initialized and estimate_tokens(template_create.prefix) >= context_length:
+        # Without the tokenizer the estimate is all there is; the loaded model checks exactly below
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Template prefix is about {estimate_tokens(template_create.prefix)} tokens, the context holds {context_length}"
+        )
+    previous = template_registry.get(template_create.id)
+    template = template_registry.register(template_create.id, template_create.prefix, template_create.name)
+    if model._initialized:
+        try:
+            await model.warm_template(template)
+        except TemplateTooLongError as e:
+            template_registry.revert(template.id, previous)
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=str(e)
+            )
+        except Exception as e:
+            # Keep serving the template this one was meant to replace
+            template_registry.revert(template.id, previous)
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Failed to evaluate template prefix: {str(e)}"
+            )
+    return TemplateResponse(**template.to_dict())
+
+@router.get("", response_model=List[TemplateResponse])
+async def list_templates():
+    """List registered templates"""
+    return [TemplateResponse(**template.to_dict()) for template in template_registry.list()]
+
+@router.get("/stats")
+async def template_stats():
+    """Snapshot cache occupancy and hit counts"""
+    return template_registry.stats()
+
+@router.delete("/{template_id}", dependencies=[Depends(verify_admin_key)])
+async def delete_template(template_id: str):
+    """Remove a template and its snapshot"""
+    if not template_registry.unregister(template_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Template not found"
+        )
+    return {"status": "success", "message": "Template removed"}
@@ -0,0 +1,129 @@
+from fastapi import APIRouter, HTTPException, status, Depends, Query
+from pydantic import BaseModel
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timezone
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from app.models.database import get_db, APIKeyModel, UsageMinuteModel, UsageHourModel
+from app.api.routes import verify_api_key, is_admin_key
+from app.models.usage import usage_meter, MINUTE, HOUR
+
+router = APIRouter()
+
+DAY = 86400
+GRANULARITIES = {"minute": MINUTE, "hour": HOUR, "day": DAY}
+
+class UsageBucket(BaseModel):
+    start: datetime
+    requests: int
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+    avg_latency_ms: float
+
+class UsageResponse(BaseModel):
+    key: Optional[str] = None
+    granularity: str
+    start: datetime
+    end: datetime
+    buckets: List[UsageBucket]
+    totals: UsageBucket
+
+def _to_epoch(value: datetime) -> int:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+def _bucket(start: int, counters: List[float]) -> UsageBucket:
+    requests, prompt_tokens, completion_tokens, latency_ms_sum = counters
+    return UsageBucket(
+        start=datetime.fromtimestamp(start, tz=timezone.utc),
+        requests=int(requests),
+        prompt_tokens=int(prompt_tokens),
+        completion_tokens=int(completion_tokens),
+        total_tokens=int(prompt_tokens + completion_tokens),
+        avg_latency_ms=round(latency_ms_sum / requests, 2) if requests else 0.0
+    )
+
+@router.get("", response_model=UsageResponse)
+async def get_usage(
+    key: Optional[str] = Query(None, description="Only report usage for this API key; defaults to the caller's own, other keys need an admin key"),
+    start: Optional[datetime] = Query(None, description="Range start (defaults to 24h before end)"),
+    end: Optional[datetime] = Query(None, description="Range end (defaults to now)"),
+    granularity: str = Query("hour", description="Rollup size: minute, hour or day"),
+    all_keys: bool = Query(False, description="Report usage summed over every key (admin keys only)"),
+    api_key: APIKeyModel = Depends(verify_api_key),
+    db: Session = Depends(get_db)
+):
+    """Usage rollups served from the pre-aggregated minute and hour tables"""
+    if all_keys or (key and key != api_key.key):
+        if not is_admin_key(api_key):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Admin API key required for other keys' usage"
+            )
+        key = None if all_keys else key
+    else:
+        key = api_key.key
+    if granularity not in GRANULARITIES:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Invalid granularity '{granularity}'. Allowed: {', '.join(GRANULARITIES)}"
+        )
+    end_ts = _to_epoch(end) if end else int(datetime.now(timezone.utc).timestamp())
+    start_ts = _to_epoch(start) if start else end_ts - DAY
+    if start_ts >= end_ts:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Range start must be before range end"
+        )
+
+    step = GRANULARITIES[granularity]
+    # Minute rollups come from the minute table, anything coarser from the hour table
+    table = UsageMinuteModel if step == MINUTE else UsageHourModel
+    table_step = MINUTE if step == MINUTE else HOUR
+    bucket_expr = (table.bucket_start // step) * step
+
+    query = db.query(
+        bucket_expr.label("bucket"),
+        func.sum(table.requests),
+        func.sum(table.prompt_tokens),
+        func.sum(table.completion_tokens),
+        func.sum(table.latency_ms_sum)
+    ).filter(
+        table.bucket_start >= start_ts // table_step * table_step,
+        table.bucket_start < end_ts
+    )
+    if key:
+        query = query.filter(table.api_key == key)
+    rows = query.group_by("bucket").all()
+
+    rollup: Dict[int, List[float]] = {
+        int(bucket): [requests or 0, prompt or 0, completion or 0, latency or 0.0]
+        for bucket, requests, prompt, completion, latency in rows
+    }
+
+    # Fold in counters that have not been flushed yet so the view is current
+    pending: Dict[Tuple[str, int], List[float]] = usage_meter.snapshot()
+    for (api_key, bucket_start), counters in pending.items():
+        if key and api_key != key:
+            continue
+        if not start_ts // MINUTE * MINUTE <= bucket_start < end_ts:
+            continue
+        totals = rollup.setdefault(bucket_start // step * step, [0, 0, 0, 0.0])
+        for i, value in enumerate(counters):
+            totals[i] += value
+
+    totals = [0, 0, 0, 0.0]
+    for counters in rollup.values():
+        for i, value in enumerate(counters):
+            totals[i] += value
+
+    return UsageResponse(
+        key=key,
+        granularity=granularity,
+        start=datetime.fromtimestamp(start_ts, tz=timezone.utc),
+        end=datetime.fromtimestamp(end_ts, tz=timezone.utc),
+        buckets=[_bucket(bucket, rollup[bucket]) for bucket in sorted(rollup)],
+        totals=_bucket(start_ts, totals)
+    )
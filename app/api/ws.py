@@ -0,0 +1,310 @@
+"""
+Persistent WebSocket chat channel
+
+One connection authenticates once and then carries any number of
+generations, each tagged with a client-chosen id:
+
+    -> {"type": "auth", "api_key": "..."}        (or an Authorization header on the handshake)
+    <- {"type": "ready", "max_streams": 8}
+    -> {"type": "chat", "id": "a", "prompt": "...", "max_tokens": 64}
+    <- {"id": "a", "t": "Hel"}  {"id": "a", "t": "lo"}
+    <- {"id": "a", "done": true, "usage": {...}}
+    -> {"type": "cancel", "id": "a"}              <- {"id": "a", "cancelled": true}
+    <- {"id": "a", "error": "...", "code": 429, "retry_after": 3}
+
+A client that reads slowly gets its text merged into fewer, larger frames
+instead of an ever-growing frame queue; one that reads nothing for
+WS_SEND_TIMEOUT seconds is disconnected and its generations cancelled.
+"""
+import asyncio
+import json
+import logging
+import math
+import time
+import uuid
+from collections import deque
+from typing import Any, Dict, List, Optional
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect, status
+from pydantic import ValidationError
+from app.api.routes import ChatRequest, authenticate_key, chat_shape, resolve_adapter, resolve_grammar, resolve_template, stream_generation
+from app.config import get_settings
+from app.lifecycle import drain
+from app.models.capture import traffic_capture
+from app.models.database import APIKeyModel, SessionLocal
+from app.models.memory import estimate_tokens
+from app.models.request_log import request_log
+from app.models.usage import usage_meter
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# Close codes in the private-use range
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_SLOW_CLIENT = 4408
+# Client went away before the generation finished, as nginx logs it
+STATUS_CANCELLED = 499
+
+
+class _Outbox:
+    """Frames waiting for the client; pending text of one stream is merged rather than queued frame by frame
+
+    Memory stays bounded by the text of the streams in flight (each capped
+    by max_tokens), however slowly the client reads.
+    """
+
+    def __init__(self):
+        self._frames: deque = deque()
+        self._text: Dict[str, List[str]] = {}
+        self._wake = asyncio.Event()
+        self.sent = 0
+        self.merged = 0
+
+    def text(self, request_id: str, text: str):
+        parts = self._text.setdefault(request_id, [])
+        if parts:
+            self.merged += 1
+        parts.append(text)
+        self._wake.set()
+
+    def frame(self, frame: Dict[str, Any], request_id: Optional[str] = None):
+        # A stream's final frame must follow any of its text still waiting
+        if request_id is not None:
+            self._flush_text(request_id)
+        self._frames.append(frame)
+        self._wake.set()
+
+    def _flush_text(self, request_id: str):
+        parts = self._text.pop(request_id, None)
+        if parts:
+            self._frames.append({"id": request_id, "t": "".join(parts)})
+
+    async def drain(self) -> List[Dict[str, Any]]:
+        """Everything queued so far, waiting until there is something"""
+        await self._wake.wait()
+        self._wake.clear()
+        for request_id in list(self._text):
+            self._flush_text(request_id)
+        frames = list(self._frames)
+        self._frames.clear()
+        return frames
+
+
+def _encode(frame: Dict[str, Any]) -> str:
+    return json.dumps(frame, separators=(",", ":"))
+
+
+async def _writer(websocket: WebSocket, outbox: _Outbox, send_timeout: float):
+    # send_text waits on the transport's write buffer, which is what slows this loop for a slow reader
+    while True:
+        for frame in await outbox.drain():
+            await asyncio.wait_for(websocket.send_text(_encode(frame)), send_timeout)
+            outbox.sent += 1
+
+
+def _query_key(key: str) -> Optional[APIKeyModel]:
+    db = SessionLocal()
+    try:
+        api_key = authenticate_key(key, db)
+        if api_key is not None and api_key in db:
+            # Recording last_used expired the row; load it now, the connection outlives this session
+            db.refresh(api_key)
+            db.expunge(api_key)
+        return api_key
+    finally:
+        db.close()
+
+
+async def _lookup_key(key: str) -> Optional[APIKeyModel]:
+    # A synchronous SQLAlchemy query; keep it off the loop that serves every open connection
+    return await asyncio.get_event_loop().run_in_executor(None, _query_key, key)
+
+
+async def _authenticate(websocket: WebSocket, timeout: float) -> Optional[APIKeyModel]:
+    """Key from the handshake's Authorization header, or from the first frame"""
+    authorization = websocket.headers.get("authorization", "")
+    if authorization.startswith("Bearer "):
+        return await _lookup_key(authorization.split(" ")[1])
+    # Browsers cannot set headers on a WebSocket handshake
+    try:
+        message = json.loads(await asyncio.wait_for(websocket.receive_text(), timeout))
+    except (asyncio.TimeoutError, ValueError):
+        return None
+    if not isinstance(message, dict) or message.get("type") != "auth" or not message.get("api_key"):
+        return None
+    return await _lookup_key(str(message["api_key"]))
+
+
+async def _run_stream(request_id: str, request: ChatRequest, api_key: APIKeyModel, outbox: _Outbox, connection_id: str):
+    """Generate one request and push its frames; the outcome is logged like an HTTP request"""
+    started = time.perf_counter()
+    arrived = time.time()
+    status_code = status.HTTP_200_OK
+    usage: Dict[str, Any] = {}
+    template = None
+    generating = False
+    streamed = 0
+    try:
+        retry_after = usage_meter.check_quota(api_key.key)
+        if retry_after > 0:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Token quota exceeded",
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+        template = resolve_template(request.template_id)
+        adapter = resolve_adapter(request.adapter, api_key)
+        events = stream_generation(request, template, adapter, await resolve_grammar(request.response_format))
+        generating = True
+        try:
+            async for event in events:
+                if "text" in event:
+                    # Each text event is one decoded token, counted as it goes out
+                    streamed += 1
+                    outbox.text(request_id, event["text"])
+                else:
+                    usage = event["usage"]
+        finally:
+            # Stops the model and releases the memory reservation when cancelled mid-stream
+            await events.aclose()
+        outbox.frame({"id": request_id, "done": True, "usage": usage}, request_id)
+    except asyncio.CancelledError:
+        status_code = STATUS_CANCELLED
+        outbox.frame({"id": request_id, "cancelled": True}, request_id)
+    except HTTPException as e:
+        status_code = e.status_code
+        frame = {"id": request_id, "error": e.detail, "code": e.status_code}
+        if e.headers and "Retry-After" in e.headers:
+            frame["retry_after"] = int(e.headers["Retry-After"])
+        outbox.frame(frame, request_id)
+    except Exception as e:
+        status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        logger.error(f"WebSocket generation {request_id} failed: {e}", exc_info=True)
+        outbox.frame({"id": request_id, "error": f"Error during chat generation: {str(e)}", "code": status_code}, request_id)
+    finally:
+        drain.release()
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+        if generating:
+            # A client that cancels or disconnects before the usage event still pays for what it received
+            if prompt_tokens is None:
+                prompt_tokens = estimate_tokens((template.prefix if template else "") + request.prompt)
+                completion_tokens = streamed
+            usage_meter.record(api_key.key, prompt_tokens, completion_tokens, (time.perf_counter() - started) * 1000)
+        request_log.record(
+            uuid.uuid4().hex,
+            api_key.key,
+            "WS",
+            "/ws/chat",
+            status_code,
+            prompt_tokens,
+            completion_tokens,
+            (time.perf_counter() - started) * 1000
+        )
+        if traffic_capture.enabled:
+            traffic_capture.record(
+                chat_shape("ws_chat", request, template, api_key.key, conn=connection_id),
+                arrived,
+                status_code,
+                (time.perf_counter() - started) * 1000,
+                prompt_tokens,
+                completion_tokens
+            )
+
+
+def _start_stream(
+    message: Dict[str, Any],
+    api_key: APIKeyModel,
+    outbox: _Outbox,
+    streams: Dict[str, asyncio.Task],
+    connection_id: str
+):
+    request_id = message.get("id")
+    if not isinstance(request_id, str) or not request_id:
+        outbox.frame({"type": "error", "error": "chat frames need a string id"})
+        return
+    if request_id in streams:
+        outbox.frame({"id": request_id, "error": "A generation with this id is already running", "code": status.HTTP_409_CONFLICT})
+        return
+    if len(streams) >= get_settings().WS_MAX_STREAMS:
+        outbox.frame({"id": request_id, "error": "Too many concurrent generations on this connection", "code": status.HTTP_429_TOO_MANY_REQUESTS})
+        return
+    try:
+        request = ChatRequest(**{k: v for k, v in message.items() if k not in ("type", "id")})
+    except ValidationError as e:
+        outbox.frame({"id": request_id, "error": json.loads(e.json(include_url=False)), "code": status.HTTP_422_UNPROCESSABLE_ENTITY})
+        return
+    if not drain.admit():
+        outbox.frame({"id": request_id, "error": "Server is draining", "code": status.HTTP_503_SERVICE_UNAVAILABLE, "retry_after": 1})
+        return
+    task = asyncio.ensure_future(_run_stream(request_id, request, api_key, outbox, connection_id))
+    streams[request_id] = task
+
+    def forget(finished: asyncio.Task):
+        # The id may already belong to a newer generation started after this one finished
+        if streams.get(request_id) is finished:
+            del streams[request_id]
+
+    task.add_done_callback(forget)
+
+
+@router.websocket("/chat")
+async def chat_socket(websocket: WebSocket):
+    """Multiplexed streaming chat over one authenticated connection"""
+    settings = get_settings()
+    await websocket.accept()
+    api_key = await _authenticate(websocket, settings.WS_AUTH_TIMEOUT)
+    if api_key is None:
+        await websocket.close(code=CLOSE_UNAUTHORIZED, reason="Invalid API key")
+        return
+
+    outbox = _Outbox()
+    streams: Dict[str, asyncio.Task] = {}
+    connection_id = uuid.uuid4().hex
+    writer = asyncio.ensure_future(_writer(websocket, outbox, settings.WS_SEND_TIMEOUT))
+    outbox.frame({"type": "ready", "max_streams": settings.WS_MAX_STREAMS})
+    try:
+        while True:
+            receive = asyncio.ensure_future(websocket.receive())
+            await asyncio.wait({receive, writer}, return_when=asyncio.FIRST_COMPLETED)
+            if writer.done():
+                receive.cancel()
+                if isinstance(writer.exception(), asyncio.TimeoutError):
+                    logger.info(f"Closing WebSocket for {api_key.name}: client stopped reading")
+                    await websocket.close(code=CLOSE_SLOW_CLIENT, reason="Client is not reading")
+                break
+            received = receive.result()
+            if received["type"] == "websocket.disconnect":
+                break
+            if received.get("text") is None:
+                await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA, reason="Frames must be text")
+                break
+            try:
+                message = json.loads(received["text"])
+            except ValueError:
+                outbox.frame({"type": "error", "error": "Frames must be JSON"})
+                continue
+            if not isinstance(message, dict):
+                outbox.frame({"type": "error", "error": "Frames must be JSON objects"})
+                continue
+
+            kind = message.get("type")
+            if kind == "chat":
+                _start_stream(message, api_key, outbox, streams, connection_id)
+            elif kind == "cancel":
+                task = streams.get(message.get("id"))
+                if task is not None:
+                    task.cancel()
+            elif kind == "ping":
+                outbox.frame({"type": "pong"})
+            else:
+                outbox.frame({"type": "error", "error": f"Unknown frame type {kind!r}"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # A dropped connection must not keep the model generating for nobody
+        for task in list(streams.values()):
+            task.cancel()
+        if streams:
+            await asyncio.gather(*streams.values(), return_exceptions=True)
+        writer.cancel()
@@ -10,11 +10,43 @@ DEFAULT_MODEL_PATH = "/tmp/model.gguf"
 
 class Settings(BaseModel):
     # Model settings
+    BACKEND: str = os.getenv("BACKEND", "llama_cpp")  # llama_cpp, transformers or stub
     MODEL_URL: str = os.getenv("MODEL_URL", "https://huggingface.co/TheBloke/Llama-2-7B-Chat-GGUF/resolve/main/llama-2-7b-chat.Q2_K.gguf")
     MODEL_PATH: str = os.getenv("MODEL_PATH", DEFAULT_MODEL_PATH)
+    MODEL_SHA256: str = os.getenv("MODEL_SHA256", "")  # Expected digest of the GGUF file
+    MODEL_MANIFEST: str = os.getenv("MODEL_MANIFEST", "")  # JSON manifest of file name -> sha256
+    MODEL_AUTO_DOWNLOAD: bool = os.getenv("MODEL_AUTO_DOWNLOAD", "true").lower() == "true"
+    DOWNLOAD_CONNECTIONS: int = int(os.getenv("DOWNLOAD_CONNECTIONS", "8"))
+    DOWNLOAD_CHUNK_MB: int = int(os.getenv("DOWNLOAD_CHUNK_MB", "32"))
     CONTEXT_LENGTH: int = int(os.getenv("CONTEXT_LENGTH", "2048"))
     GPU_LAYERS: int = int(os.getenv("GPU_LAYERS", "0"))  # Disable GPU layers for minimal resource usage
     THREADS: int = int(os.getenv("THREADS", "4"))  # Reduce threads for smaller footprint
+    THREADS_BATCH: int = int(os.getenv("THREADS_BATCH", "0"))  # Prompt-eval threads, 0 means THREADS
+    N_BATCH: int = int(os.getenv("N_BATCH", "512"))  # Prompt tokens evaluated per llama_decode call
+    USE_MMAP: bool = os.getenv("USE_MMAP", "true").lower() == "true"
+    USE_MLOCK: bool = os.getenv("USE_MLOCK", "false").lower() == "true"  # Pin weights in RAM, needs memlock limit
+    KV_CACHE_TYPE_K: str = os.getenv("KV_CACHE_TYPE_K", "f16")  # f16, q8_0 or q4_0; quantized K needs head size % 32 == 0
+    KV_CACHE_TYPE_V: str = os.getenv("KV_CACHE_TYPE_V", "f16")  # Quantized V needs FLASH_ATTENTION and a build that has it
+    FLASH_ATTENTION: bool = os.getenv("FLASH_ATTENTION", "false").lower() == "true"  # Ignored where llama.cpp lacks it
+    AUTOTUNE: bool = os.getenv("AUTOTUNE", "false").lower() == "true"  # Benchmark threads/batch on first boot
+    AUTOTUNE_PROFILE_PATH: str = os.getenv("AUTOTUNE_PROFILE_PATH", "/app/data/tuning_profiles.json")
+    
+    # Transformers backend settings
+    TRANSFORMERS_MODEL: str = os.getenv("TRANSFORMERS_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+    TRANSFORMERS_DTYPE: str = os.getenv("TRANSFORMERS_DTYPE", "auto")  # auto, float32 or bfloat16
+    BATCH_WINDOW_MS: float = float(os.getenv("BATCH_WINDOW_MS", "5"))  # How long to collect requests into a batch
+    BATCH_MAX_SIZE: int = int(os.getenv("BATCH_MAX_SIZE", "8"))
+    
+    # Stub backend settings (BACKEND=stub, for replaying captured traffic)
+    STUB_PREFILL_MS: float = float(os.getenv("STUB_PREFILL_MS", "0.5"))  # Simulated cost per prompt token
+    STUB_DECODE_MS: float = float(os.getenv("STUB_DECODE_MS", "20"))  # Simulated cost per generated token
+    
+    # LoRA adapter settings (llama_cpp backend)
+    LORA_ENABLED: bool = os.getenv("LORA_ENABLED", "false").lower() == "true"  # Disables mmap on builds that can only merge adapters
+    LORA_ADAPTERS_FILE: str = os.getenv("LORA_ADAPTERS_FILE", "")  # JSON list of {name, path, scale, api_keys} registered at startup
+    LORA_CACHE_MB: int = int(os.getenv("LORA_CACHE_MB", "1024"))  # Resident adapter budget, LRU evicted beyond it
+    LORA_MAX_CONSECUTIVE: int = int(os.getenv("LORA_MAX_CONSECUTIVE", "8"))  # Requests for the active adapter served ahead of older ones
+    LORA_BASE_MODEL: str = os.getenv("LORA_BASE_MODEL", "")  # f16/f32 GGUF of MODEL_PATH's weights that merged adapters are rebuilt from; required when MODEL_PATH is quantized and the build can only merge
     
     # Generation settings
     MAX_TOKENS: int = int(os.getenv("MAX_TOKENS", "1024"))  # Reduced from 2048
@@ -22,11 +54,89 @@ class Settings(BaseModel):
     TOP_P: float = float(os.getenv("TOP_P", "0.95"))
     TOP_K: int = int(os.getenv("TOP_K", "40"))
     REPEAT_PENALTY: float = float(os.getenv("REPEAT_PENALTY", "1.1"))
+    SCORE_MAX_CANDIDATES: int = int(os.getenv("SCORE_MAX_CANDIDATES", "1000"))  # Candidates per /api/score call
+    SCORE_MAX_CANDIDATE_TOKENS: int = int(os.getenv("SCORE_MAX_CANDIDATE_TOKENS", "32768"))  # Estimated candidate tokens per call, which is what scoring costs
+    
+    # Context shift settings (llama_cpp backend)
+    CONTEXT_SHIFT: bool = os.getenv("CONTEXT_SHIFT", "false").lower() == "true"  # Roll the context instead of stopping when it fills
+    CONTEXT_SHIFT_DISCARD: int = int(os.getenv("CONTEXT_SHIFT_DISCARD", "0"))  # Oldest tokens dropped per shift; 0 drops half of what follows the system prefix
+    
+    # Step scheduler settings (llama_cpp backend)
+    STEP_TOKEN_BUDGET: int = int(os.getenv("STEP_TOKEN_BUDGET", "0"))  # Tokens per decode step shared by running streams and prompt chunks; 0 runs requests one at a time
+    MAX_ACTIVE_SEQUENCES: int = int(os.getenv("MAX_ACTIVE_SEQUENCES", "4"))  # Generations interleaved at once; they share CONTEXT_LENGTH
+    
+    # Grammar settings (llama_cpp backend)
+    GRAMMAR_CACHE_SIZE: int = int(os.getenv("GRAMMAR_CACHE_SIZE", "128"))  # Compiled response_format grammars kept, least recently used evicted
     
     # Server settings
     HOST: str = os.getenv("HOST", "0.0.0.0")
     PORT: int = int(os.getenv("PORT", "8000"))
     
+    # WebSocket chat settings
+    WS_MAX_STREAMS: int = int(os.getenv("WS_MAX_STREAMS", "8"))  # Concurrent generations per connection
+    WS_AUTH_TIMEOUT: float = float(os.getenv("WS_AUTH_TIMEOUT", "10"))  # Seconds to send the auth frame
+    WS_SEND_TIMEOUT: float = float(os.getenv("WS_SEND_TIMEOUT", "30"))  # A client that reads nothing this long is disconnected
+    
+    # Conversation session settings
+    SESSION_MAX_COUNT: int = int(os.getenv("SESSION_MAX_COUNT", "1000"))  # Sessions kept in memory
+    SESSION_TTL_SECONDS: int = int(os.getenv("SESSION_TTL_SECONDS", "3600"))  # Idle time before in-memory eviction
+    SESSION_PERSIST: bool = os.getenv("SESSION_PERSIST", "false").lower() == "true"  # Write sessions to SQLite
+    
+    # Prompt template settings
+    TEMPLATES_FILE: str = os.getenv("TEMPLATES_FILE", "")  # JSON list of {id, name, prefix} registered at startup
+    TEMPLATE_SNAPSHOT_MAX_MB: int = int(os.getenv("TEMPLATE_SNAPSHOT_MAX_MB", "512"))  # In-memory snapshot budget
+    TEMPLATE_SNAPSHOT_DIR: str = os.getenv("TEMPLATE_SNAPSHOT_DIR", "")  # Persist snapshots here when set
+    
+    # Usage metering and quota settings
+    USAGE_FLUSH_INTERVAL: float = float(os.getenv("USAGE_FLUSH_INTERVAL", "10"))  # Seconds between batch flushes
+    USAGE_RETENTION_DAYS: int = int(os.getenv("USAGE_RETENTION_DAYS", "7"))  # Minute buckets kept this long
+    QUOTA_TOKENS_PER_MINUTE: int = int(os.getenv("QUOTA_TOKENS_PER_MINUTE", "0"))  # 0 disables quotas
+    QUOTA_BURST_TOKENS: int = int(os.getenv("QUOTA_BURST_TOKENS", "0"))  # Defaults to one minute of tokens
+    
+    # Tracing settings
+    SLOW_REQUEST_MS: float = float(os.getenv("SLOW_REQUEST_MS", "10000"))  # Log span breakdown above this latency
+    SLOW_REQUEST_SAMPLE_RATE: float = float(os.getenv("SLOW_REQUEST_SAMPLE_RATE", "1.0"))  # Fraction of slow requests logged
+    
+    # Shutdown and restart settings
+    DRAIN_TIMEOUT_SECONDS: float = float(os.getenv("DRAIN_TIMEOUT_SECONDS", "30"))  # Max wait for in-flight requests on SIGTERM
+    WARM_STATE_PATH: str = os.getenv("WARM_STATE_PATH", "")  # Save/restore KV, template and session state here when set
+    
+    # Request log settings
+    REQUEST_LOG_DIR: str = os.getenv("REQUEST_LOG_DIR", "/app/data/request_logs")  # One SQLite partition per UTC day
+    REQUEST_LOG_BUFFER: int = int(os.getenv("REQUEST_LOG_BUFFER", "10000"))  # Ring capacity between flushes
+    REQUEST_LOG_FLUSH_INTERVAL: float = float(os.getenv("REQUEST_LOG_FLUSH_INTERVAL", "2"))  # Seconds between batch flushes
+    REQUEST_LOG_RETENTION_DAYS: int = int(os.getenv("REQUEST_LOG_RETENTION_DAYS", "14"))  # Older daily partitions are deleted
+    
+    # Traffic capture settings
+    CAPTURE_PATH: str = os.getenv("CAPTURE_PATH", "")  # Append anonymized request shapes here when set
+    CAPTURE_SAMPLE_RATE: float = float(os.getenv("CAPTURE_SAMPLE_RATE", "1.0"))  # Fraction of requests captured
+    
+    # Profiling settings
+    ADMIN_API_KEYS: str = os.getenv("ADMIN_API_KEYS", "")  # Comma-separated keys allowed to use /debug endpoints
+    PROFILE_MAX_SECONDS: float = float(os.getenv("PROFILE_MAX_SECONDS", "60"))  # Longest /debug/profile run
+    PROFILE_INTERVAL_MS: float = float(os.getenv("PROFILE_INTERVAL_MS", "10"))  # Time between stack samples
+    LOOP_LAG_MONITOR: bool = os.getenv("LOOP_LAG_MONITOR", "true").lower() == "true"  # Record event loop stalls with their stacks
+    LOOP_LAG_THRESHOLD_MS: float = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "100"))  # Stalls longer than this are recorded
+    
+    # Memory governor settings
+    MEMORY_LIMIT_MB: int = int(os.getenv("MEMORY_LIMIT_MB", "0"))  # 0 uses the cgroup limit or physical RAM
+    MEMORY_HEADROOM: float = float(os.getenv("MEMORY_HEADROOM", "0.9"))  # Fraction of the limit requests may project into
+    MEMORY_SHRINK_AT: float = float(os.getenv("MEMORY_SHRINK_AT", "0.85"))  # Fraction of the budget at which caches are shrunk
+    REQUEST_OVERHEAD_MB: int = int(os.getenv("REQUEST_OVERHEAD_MB", "32"))  # Working memory per request besides KV
+    
+    # Router settings (python -m app.router)
+    ROUTER_BACKENDS: str = os.getenv("ROUTER_BACKENDS", "")  # Comma-separated backend base URLs
+    ROUTER_VNODES: int = int(os.getenv("ROUTER_VNODES", "64"))  # Hash ring points per backend
+    ROUTER_RETRIES: int = int(os.getenv("ROUTER_RETRIES", "1"))  # Other backends tried after a failure
+    ROUTER_HEALTH_INTERVAL: float = float(os.getenv("ROUTER_HEALTH_INTERVAL", "2"))  # Seconds between health polls
+    
+    # CPU placement settings
+    CPU_PINNING: bool = os.getenv("CPU_PINNING", "false").lower() == "true"  # Pin inference and event loop threads to dedicated cores
+    CPU_PIN_NODE: int = int(os.getenv("CPU_PIN_NODE", "-1"))  # NUMA node for inference, -1 picks one by worker index
+    CPU_PIN_LOOP_CORES: int = int(os.getenv("CPU_PIN_LOOP_CORES", "1"))  # Physical cores kept for the event loop
+    CPU_PIN_WORKER: int = int(os.getenv("CPU_PIN_WORKER", "0"))  # This process's index when several share a host
+    CPU_PIN_WORKERS: int = int(os.getenv("CPU_PIN_WORKERS", "1"))  # Processes sharing the host's cores
+    
     # Email settings
     SENDGRID_API_KEY: str = os.getenv("SENDGRID_API_KEY", "")
     FROM_EMAIL: str = os.getenv("FROM_EMAIL", "noreply@huggingmind.fyi")
@@ -0,0 +1,89 @@
+"""
+Drain mode: stop admitting work on SIGTERM and exit once in-flight requests finish
+"""
+import asyncio
+import logging
+import signal
+import time
+from fastapi.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+# Probes and the index page are still answered while draining
+EXEMPT_PATHS = {"/", "/health", "/health/ready"}
+
+class DrainController:
+    def __init__(self):
+        self.draining = False
+        self.in_flight = 0
+        self.drain_started = None
+
+    def exempt(self, path: str) -> bool:
+        return path in EXEMPT_PATHS
+
+    def admit(self) -> bool:
+        """Count a request as in flight, or refuse it if draining"""
+        if self.draining:
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+
+    def install(self, timeout: float):
+        """Take over SIGTERM so it starts a drain instead of an immediate shutdown"""
+        loop = asyncio.get_event_loop()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self.begin_drain, timeout)
+        except (NotImplementedError, RuntimeError):
+            logger.warning("Signal handlers unavailable, SIGTERM will not drain")
+
+    def begin_drain(self, timeout: float):
+        if self.draining:
+            return
+        self.draining = True
+        self.drain_started = time.monotonic()
+        logger.info(f"SIGTERM received, draining {self.in_flight} in-flight requests (deadline {timeout}s)")
+        asyncio.ensure_future(self._drain_then_exit(timeout))
+
+    async def _drain_then_exit(self, timeout: float):
+        deadline = self.drain_started + timeout
+        while self.in_flight > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.in_flight > 0:
+            logger.warning(f"Drain deadline reached with {self.in_flight} requests still running")
+        else:
+            logger.info(f"Drained in {time.monotonic() - self.drain_started:.1f}s")
+        # Hand over to the server's own graceful shutdown, which runs the shutdown hooks
+        signal.raise_signal(signal.SIGINT)
+
+drain = DrainController()
+
+class DrainMiddleware:
+    """Refuse new work while draining and track what is still in flight
+    
+    Plain ASGI rather than an http middleware: the app call only returns once the
+    response is fully sent or the client has gone, so the release below runs exactly
+    once even for streams the client drops before the first chunk.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or drain.exempt(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        if not drain.admit():
+            response = JSONResponse(
+                status_code=503,
+                content={"detail": "Server is shutting down. Please retry."},
+                headers={"Retry-After": "1", "Connection": "close"}
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            drain.release()
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Response
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Response, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
@@ -6,14 +6,36 @@ import os
 import sys
 import logging
 import asyncio
+import math
 from app.config import get_settings
-from app.models.llama_model import LlamaModel
-from app.api.routes import router as api_router
+from app.models.backend import get_model
+from app.api.routes import router as api_router, optional_api_key
 from app.api.api_keys import router as api_key_router
+from app.api.usage import router as usage_router
+from app.api.sessions import router as sessions_router
+from app.api.templates import router as templates_router
+from app.api.adapters import router as adapters_router
+from app.api.diagnostics import router as diagnostics_router
+from app.api.logs import router as logs_router
+from app.api.ws import router as ws_router
+from app.api.debug import router as debug_router
+from app.models.usage import usage_meter
+from app.models.request_log import request_log
+from app.models.capture import traffic_capture, request_shape
+from app.models.sessions import session_store
+from app.models.database import APIKeyModel
+from app.models.templates import template_registry
+from app.models.adapters import adapter_registry
+from app.models.coalescing import single_flight
+from app.models.memory import memory_governor, MemoryPressureError, estimate_tokens
+from app.models.warmstate import save_warm_state, restore_warm_state
 from app.startup import startup
+from app.tracing import start_trace, log_if_slow, tag_request
+from app.lifecycle import drain, DrainMiddleware
+from app.placement import cpu_placement
+from app.profiling import loop_monitor
 import time
 import psutil
-import gc
 
 # Configure logging
 logging.basicConfig(
@@ -44,6 +66,7 @@ logger.info(f"Configuring server with HOST={HOST} and PORT={PORT}")
 # Application state
 server_started = False
 startup_time = None
+warm_start = None  # How long this process took to become warm, and whether state was restored
 
 app = FastAPI(
     title="HuggingMind AI - LLaMA 2 Chat API",
@@ -60,9 +83,58 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Collect per-request spans and report them as a Server-Timing header"""
+    trace = start_trace(request.method, request.url.path)
+    response = await call_next(request)
+    response.headers["Server-Timing"] = trace.server_timing()
+    response.headers["X-Request-ID"] = trace.request_id
+    
+    # Log once the body is sent, so streamed responses report their full latency, tokens and decode spans
+    body = response.body_iterator
+    async def logged_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            log_if_slow(trace, response.status_code, settings.SLOW_REQUEST_MS, settings.SLOW_REQUEST_SAMPLE_RATE)
+            request_log.record(
+                trace.request_id,
+                trace.api_key,
+                trace.method,
+                trace.path,
+                response.status_code,
+                trace.prompt_tokens,
+                trace.completion_tokens,
+                trace.elapsed_ms()
+            )
+            if trace.capture is not None:
+                traffic_capture.record(
+                    trace.capture,
+                    trace.arrived,
+                    response.status_code,
+                    trace.elapsed_ms(),
+                    trace.prompt_tokens,
+                    trace.completion_tokens
+                )
+    response.body_iterator = logged_body()
+    return response
+
+# Added last so it is outermost: draining refuses requests before any other work
+app.add_middleware(DrainMiddleware)
+
 # Include API routes
 app.include_router(api_router, prefix="/api")
 app.include_router(api_key_router, prefix="/api/keys")
+app.include_router(usage_router, prefix="/api/usage")
+app.include_router(logs_router, prefix="/api/logs")
+app.include_router(sessions_router, prefix="/sessions")
+app.include_router(templates_router, prefix="/api/templates")
+app.include_router(adapters_router, prefix="/api/adapters")
+app.include_router(diagnostics_router, prefix="/diagnostics")
+app.include_router(ws_router, prefix="/ws")
+app.include_router(debug_router, prefix="/debug")
 
 # Track application start time
 start_time = time.time()
@@ -72,7 +144,9 @@ class Message(BaseModel):
     content: str
 
 class ChatRequest(BaseModel):
-    messages: List[Message]
+    messages: List[Message] = []
+    session_id: Optional[str] = None  # Continue a server-side session instead of sending history
+    message: Optional[str] = None  # New user message when session_id is set
     max_tokens: Optional[int] = None
     temperature: Optional[float] = None
     top_p: Optional[float] = None
@@ -81,36 +155,88 @@ class ChatRequest(BaseModel):
 
 class ChatResponse(BaseModel):
     response: str
+    session_id: Optional[str] = None
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, api_key: Optional[APIKeyModel] = Depends(optional_api_key)):
     try:
-        # Check system resources
-        memory = psutil.virtual_memory()
-        if memory.percent > 90:  # If memory usage is above 90%
-            logger.warning(f"High memory usage: {memory.percent}%")
-            gc.collect()
-        
         # Initialize model (uses singleton pattern)
-        model = LlamaModel()
+        model = get_model()
         
-        # Convert messages to list of dicts
-        messages = [msg.dict() for msg in request.messages]
+        if request.session_id:
+            # Reads SQLite when the session is not in memory
+            session = await asyncio.get_event_loop().run_in_executor(None, session_store.get, request.session_id)
+            # Sessions belong to the key that created them, like on the /sessions routes
+            if session is None or session.api_key != (api_key.key if api_key else None):
+                raise HTTPException(status_code=404, detail="Session not found")
+            if not request.message:
+                raise HTTPException(status_code=422, detail="message is required when session_id is set")
+            prompt_text = "".join(turn.content for turn in session.turns) + request.message
+        else:
+            prompt_text = "".join(msg.content for msg in request.messages)
         
-        # Generate response with timeout
+        shape = None
+        if traffic_capture.enabled:
+            shape = request_shape(
+                "chat",
+                estimate_tokens(prompt_text),
+                request.max_tokens,
+                request.temperature,
+                request.top_p,
+                request.top_k,
+                sess=request.session_id,
+                # Session turns carry only the new message; the replay rebuilds the history
+                mpt=estimate_tokens(request.message) if request.session_id else None,
+                turn=sum(turn.role == "user" for turn in session.turns) if request.session_id else None,
+                msgs=None if request.session_id else len(request.messages)
+            )
+            tag_request(capture=shape)
+        
+        # Admit against projected memory instead of reacting once the system is short
         try:
-            response = await asyncio.wait_for(
-                model.chat(
-                    messages=messages,
-                    max_tokens=request.max_tokens,
-                    temperature=request.temperature,
-                    top_p=request.top_p,
-                    top_k=request.top_k,
-                    repeat_penalty=request.repeat_penalty
-                ),
-                timeout=45.0  # 45 second timeout
+            reservation = memory_governor.reserve(estimate_tokens(prompt_text), request.max_tokens)
+        except MemoryPressureError as e:
+            raise HTTPException(
+                status_code=503,
+                detail=str(e),
+                headers={"Retry-After": str(math.ceil(e.retry_after))}
+            )
+        
+        if request.session_id:
+            generation = model.chat_session(
+                session,
+                request.message,
+                max_tokens=request.max_tokens,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                top_k=request.top_k,
+                repeat_penalty=request.repeat_penalty
+            )
+        else:
+            # Convert messages to list of dicts
+            messages = [msg.dict() for msg in request.messages]
+            generation = model.chat(
+                messages=messages,
+                max_tokens=request.max_tokens,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                top_k=request.top_k,
+                repeat_penalty=request.repeat_penalty
             )
-            return ChatResponse(response=response)
+        
+        # Generate response with timeout
+        try:
+            with reservation:
+                response = await asyncio.wait_for(
+                    generation,
+                    timeout=45.0  # 45 second timeout
+                )
+            if request.session_id:
+                await asyncio.get_event_loop().run_in_executor(None, session_store.save, session)
+            if shape is not None:
+                # This endpoint reports no usage, so the completion length is estimated
+                shape["ct"] = estimate_tokens(response)
+            return ChatResponse(response=response, session_id=request.session_id)
         except asyncio.TimeoutError:
             logger.error("Chat request timed out")
             raise HTTPException(
@@ -118,15 +244,16 @@ async def chat(request: ChatRequest):
                 detail="Request timed out. Please try again."
             )
         
+    except HTTPException:
+        raise
+    except MemoryError:
+        logger.error("Allocation failed during chat generation", exc_info=True)
+        raise HTTPException(
+            status_code=503,
+            detail="Server is temporarily out of resources. Please try again in a moment."
+        )
     except Exception as e:
         logger.error(f"Error in chat endpoint: {e}", exc_info=True)
-        if "out of memory" in str(e).lower():
-            # Try to recover from OOM
-            gc.collect()
-            raise HTTPException(
-                status_code=503,
-                detail="Server is temporarily out of resources. Please try again in a moment."
-            )
         raise HTTPException(
             status_code=500,
             detail=f"Internal server error: {str(e)}"
@@ -134,7 +261,7 @@ async def chat(request: ChatRequest):
 
 @app.get("/")
 async def root():
-    model = LlamaModel()
+    model = get_model()
     return {
         "name": "HuggingMind AI - LLaMA 2 Chat API",
         "version": "1.0.0",
@@ -142,7 +269,21 @@ async def root():
         "model_status": "initialized" if model._initialized else "initializing",
         "endpoints": {
             "/api/chat": "Chat with the model",
+            "/ws/chat": "Multiplexed streaming chat over one WebSocket",
             "/api/keys": "API key management",
+            "/api/usage": "Per-key usage rollups",
+            "/api/logs": "Structured request log",
+            "/sessions": "Server-side conversation sessions",
+            "/api/templates": "Prompt templates with cached prefixes",
+            "/api/adapters": "Per-tenant LoRA adapters (admin keys only)",
+            "/diagnostics/memory": "Memory budget breakdown",
+            "/diagnostics/placement": "CPU and NUMA placement",
+            "/diagnostics/kv": "KV cache types and per-sequence usage",
+            "/diagnostics/adapters": "LoRA adapter cache, load and switch times",
+            "/diagnostics/scheduler": "Step scheduler and inter-token latency",
+            "/diagnostics/grammars": "Compiled grammar cache and JSON early stops",
+            "/debug/profile": "Sampling profile of the live process (admin keys only)",
+            "/debug/loop": "Event loop lag and recent stalls (admin keys only)",
             "/": "This help message"
         }
     }
@@ -156,7 +297,7 @@ async def health_check():
         cpu_percent = psutil.cpu_percent()
         
         # Get model status
-        model = LlamaModel()
+        model = get_model()
         model_status = "initialized" if model._initialized else "initializing"
         if model._last_error:
             model_status = f"error: {model._last_error}"
@@ -177,9 +318,24 @@ async def health_check():
             "memory_usage": f"{memory.percent}%",
             "cpu_usage": f"{cpu_percent}%",
             "model_status": model_status,
-            "initialization_attempts": model._initialization_attempts
+            "initialization_attempts": model._initialization_attempts,
+            "in_flight": drain.in_flight  # Queue depth seen by load balancers
         }
         
+        # Requests served by joining an identical in-flight generation
+        response["coalescing"] = single_flight.stats()
+        
+        response["backend"] = settings.BACKEND
+        response["event_loop"] = loop_monitor.summary()
+        if hasattr(model, "batch_stats"):
+            response["batching"] = model.batch_stats()
+        
+        # Chosen thread/batch profile and its measured throughput
+        if model._runtime_params is not None:
+            response["runtime"] = {
+                name: value for name, value in model._runtime_params.items() if name != "candidates"
+            }
+        
         if not is_healthy:
             raise HTTPException(status_code=503, detail=response)
         
@@ -197,7 +353,19 @@ async def readiness_check(response: Response):
     """Full health check that includes model status"""
     global server_started
     try:
-        model = LlamaModel()
+        model = get_model()
+        
+        if drain.draining:
+            response.status_code = 503
+            return {
+                "status": "draining",
+                "details": {
+                    "server": "draining",
+                    "in_flight": drain.in_flight,
+                    "port": PORT,
+                    "host": HOST
+                }
+            }
         
         if not server_started:
             response.status_code = 503
@@ -237,7 +405,8 @@ async def readiness_check(response: Response):
                 "host": HOST,
                 "pid": os.getpid(),
                 "cwd": os.getcwd(),
-                "uptime": f"{(asyncio.get_event_loop().time() - startup_time):.1f}s"
+                "uptime": f"{(asyncio.get_event_loop().time() - startup_time):.1f}s",
+                "warm_start": warm_start
             }
         }
     except Exception as e:
@@ -254,11 +423,36 @@ async def readiness_check(response: Response):
 
 async def initialize_model():
     """Initialize the model in the background"""
+    global warm_start
     try:
         logger.info("Starting model initialization in background...")
-        model = LlamaModel()
+        model = get_model()
+        load_started = time.time()
         await model.initialize()
+        model_load_seconds = time.time() - load_started
         logger.info("Model initialization complete!")
+        
+        # Pick up caches left by the previous process before serving
+        restored = await asyncio.get_event_loop().run_in_executor(None, restore_warm_state)
+        
+        # Evaluate (or restore from disk) the prefix snapshot of every startup template
+        if settings.TEMPLATES_FILE:
+            template_registry.load_file(settings.TEMPLATES_FILE)
+            for template in template_registry.list():
+                await model.warm_template(template)
+            logger.info(f"Warmed {len(template_registry.list())} prompt templates")
+        
+        # Adapters are loaded onto the model by the first request that uses each one
+        if settings.LORA_ENABLED and settings.LORA_ADAPTERS_FILE:
+            adapter_registry.load_file(settings.LORA_ADAPTERS_FILE)
+            logger.info(f"Registered {len(adapter_registry.list())} LoRA adapters")
+        
+        warm_start = {
+            **restored,
+            "model_load_seconds": round(model_load_seconds, 3),
+            "time_to_warm_seconds": round(time.time() - start_time, 3)
+        }
+        logger.info(f"Time to warm: {warm_start['time_to_warm_seconds']}s (state restored: {restored['restored']})")
     except Exception as e:
         logger.error(f"Failed to initialize model: {e}", exc_info=True)
         raise
@@ -280,15 +474,42 @@ async def on_startup():
         server_started = True
         logger.info("Server marked as started")
         
+        # Keep the event loop off the inference cores before any executor thread is started
+        cpu_placement.pin_event_loop()
+        
         # Start model initialization in the background
         asyncio.create_task(initialize_model())
         
+        # Record callbacks that block the event loop, with the stack they blocked in
+        if settings.LOOP_LAG_MONITOR:
+            loop_monitor.start(settings.LOOP_LAG_THRESHOLD_MS)
+        
+        # Start batched usage and request log flushing
+        usage_meter.start()
+        request_log.start()
+        traffic_capture.start()
+        
+        # SIGTERM drains in-flight requests before shutting down
+        drain.install(settings.DRAIN_TIMEOUT_SECONDS)
+        
         logger.info("Application startup complete! Model initialization continuing in background...")
         logger.info(f"Server should be accessible at http://{HOST}:{PORT}")
     except Exception as e:
         logger.error(f"Critical error during startup: {e}", exc_info=True)
         sys.exit(1)
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Flush buffered state before the process exits"""
+    await usage_meter.stop()
+    await request_log.stop()
+    await traffic_capture.stop()
+    loop_monitor.stop()
+    try:
+        await asyncio.get_event_loop().run_in_executor(None, save_warm_state)
+    except Exception as e:
+        logger.error(f"Failed to save warm state: {e}", exc_info=True)
+
 if __name__ == "__main__":
     import uvicorn
     logger.info(f"Running app directly with HOST={HOST} PORT={PORT}")
@@ -0,0 +1,324 @@
+"""
+LoRA adapters on the shared base model
+
+Adapters are registered by name, optionally for specific API keys, and loaded
+the first time a request needs one. Two llama.cpp capabilities are supported:
+
+- Builds with the LoRA adapter API (llama_lora_adapter_init, or
+  llama_adapter_lora_init in newer releases) keep several adapters resident
+  next to the base weights and attach one to the context per generation.
+  Resident adapters are evicted least recently used beyond LORA_CACHE_MB.
+- Older builds can only merge an adapter into the weights in place, a pass
+  over every adapted tensor, and the base weights must be in RAM rather than
+  mmapped. With LORA_BASE_MODEL set llama.cpp writes base + delta over each
+  adapted tensor, so a switch first rewrites the previous adapter's tensors
+  from the base file. Without it the previous delta is subtracted, which is
+  only exact enough on f32/f16 weights; quantized models need the base file.
+
+Either way a switch invalidates the evaluated prompt, so the request queue
+serves requests for the active adapter first, within LORA_MAX_CONSECUTIVE.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+# GGUF general.file_type values of unquantized weights: all f32, mostly f16, mostly bf16
+FULL_PRECISION_FILE_TYPES = ("0", "1", "32")
+
+
+class LoraAdapter:
+    """A LoRA file and the keys allowed to use it; no keys means any key may name it"""
+
+    def __init__(self, name: str, path: str, scale: float = 1.0, api_keys: Optional[List[str]] = None):
+        self.name = name
+        self.path = path
+        self.scale = scale
+        self.api_keys = list(api_keys or [])
+        self.size_bytes = os.path.getsize(path)
+
+    def allowed(self, api_key: str) -> bool:
+        return not self.api_keys or api_key in self.api_keys
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "path": self.path,
+            "scale": self.scale,
+            "api_keys": len(self.api_keys),
+            "size_bytes": self.size_bytes,
+        }
+
+
+class AdapterRegistry:
+    def __init__(self):
+        self._adapters: Dict[str, LoraAdapter] = {}
+
+    def register(self, name: str, path: str, scale: float = 1.0, api_keys: Optional[List[str]] = None) -> LoraAdapter:
+        """Add or replace an adapter; raises FileNotFoundError if `path` does not exist"""
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"LoRA file not found: {path}")
+        adapter = LoraAdapter(name, path, scale, api_keys)
+        self._adapters[name] = adapter
+        return adapter
+
+    def unregister(self, name: str) -> bool:
+        return self._adapters.pop(name, None) is not None
+
+    def get(self, name: str) -> Optional[LoraAdapter]:
+        return self._adapters.get(name)
+
+    def list(self) -> List[LoraAdapter]:
+        return list(self._adapters.values())
+
+    def for_key(self, api_key: str) -> Optional[LoraAdapter]:
+        """The adapter registered for this key, used when a request names none"""
+        return next((adapter for adapter in self._adapters.values() if api_key in adapter.api_keys), None)
+
+    def load_file(self, path: str):
+        """Register adapters from a JSON list of {name, path, scale, api_keys}"""
+        with open(path) as f:
+            for entry in json.load(f):
+                self.register(str(entry["name"]), entry["path"], float(entry.get("scale", 1.0)), entry.get("api_keys"))
+
+
+def _adapter_api() -> Optional[Tuple[Any, Any, Any, Any]]:
+    """init, set, clear and free of the resident adapter API, or None on builds that only merge"""
+    import llama_cpp
+    if hasattr(llama_cpp, "llama_adapter_lora_init"):
+        return (
+            llama_cpp.llama_adapter_lora_init,
+            llama_cpp.llama_set_adapter_lora,
+            llama_cpp.llama_clear_adapter_lora,
+            llama_cpp.llama_adapter_lora_free,
+        )
+    if hasattr(llama_cpp, "llama_lora_adapter_init"):
+        return (
+            llama_cpp.llama_lora_adapter_init,
+            llama_cpp.llama_lora_adapter_set,
+            llama_cpp.llama_lora_adapter_clear,
+            llama_cpp.llama_lora_adapter_free,
+        )
+    return None
+
+
+def hot_swap_supported() -> bool:
+    return _adapter_api() is not None
+
+
+class LoraRuntime:
+    """The adapter applied to the model and the adapters kept loaded; activate() needs the generation lock"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.active: Optional[str] = None
+        self._merged: Optional[LoraAdapter] = None
+        self._resident: "OrderedDict[str, Tuple[LoraAdapter, Any]]" = OrderedDict()
+        self.resident_bytes = 0
+        self.loads = 0
+        self.load_ms = 0.0
+        self.switches = 0
+        self.switch_ms = 0.0
+        self.last_switch_ms: Optional[float] = None
+        self.evictions = 0
+
+    def activate(self, llm, adapter: Optional[LoraAdapter]) -> Optional[float]:
+        """Apply `adapter` (None for the base model); returns milliseconds spent, or None if it was already applied"""
+        name = adapter.name if adapter is not None else None
+        with self._lock:
+            if name == self.active:
+                return None
+            started = time.perf_counter()
+            api = _adapter_api()
+            if api is not None:
+                self._attach(llm, adapter, api)
+            else:
+                self._merge(llm, adapter)
+            # Evaluated tokens came from the previous weights and cannot be reused as a prefix
+            llm.reset()
+            self.active = name
+            elapsed = (time.perf_counter() - started) * 1000
+            self.switches += 1
+            self.switch_ms += elapsed
+            self.last_switch_ms = elapsed
+            return elapsed
+
+    def _attach(self, llm, adapter: Optional[LoraAdapter], api):
+        init, set_adapter, clear, free = api
+        clear(llm._ctx.ctx)
+        if adapter is None:
+            return
+        entry = self._resident.get(adapter.name)
+        if entry is not None and entry[0] is not adapter:
+            # Re-registered under the same name with a different file or scale
+            self._evict(adapter.name, free)
+            entry = None
+        if entry is None:
+            started = time.perf_counter()
+            handle = init(llm._model.model, adapter.path.encode("utf-8"))
+            if not handle:
+                raise RuntimeError(f"Failed to load LoRA adapter {adapter.name} from {adapter.path}")
+            self._record_load(adapter, started)
+            entry = (adapter, handle)
+            self._resident[adapter.name] = entry
+            self.resident_bytes += adapter.size_bytes
+            budget = get_settings().LORA_CACHE_MB << 20
+            # Evict least recently used adapters, but always keep the one being attached
+            while self.resident_bytes > budget and len(self._resident) > 1:
+                self._evict(next(iter(self._resident)), free)
+        self._resident.move_to_end(adapter.name)
+        if set_adapter(llm._ctx.ctx, entry[1], adapter.scale) != 0:
+            raise RuntimeError(f"Failed to attach LoRA adapter {adapter.name}")
+
+    def _evict(self, name: str, free):
+        adapter, handle = self._resident.pop(name)
+        free(handle)
+        self.resident_bytes -= adapter.size_bytes
+        self.evictions += 1
+        logger.info(f"Evicted LoRA adapter {name}")
+
+    def _merge(self, llm, adapter: Optional[LoraAdapter]):
+        base = get_settings().LORA_BASE_MODEL
+        if not base and str(llm.metadata.get("general.file_type", "0")) not in FULL_PRECISION_FILE_TYPES:
+            raise RuntimeError(
+                "Merging LoRA adapters into a quantized model needs LORA_BASE_MODEL, "
+                "otherwise every switch requantizes the weights and the error accumulates"
+            )
+        if self._merged is not None:
+            if base:
+                # Merging from the base file overwrites tensors with base + scale * delta, so scale 0 restores them
+                self._apply(llm, self._merged, 0.0)
+            else:
+                # Full precision weights: subtracting the same delta restores them up to float rounding
+                self._apply(llm, self._merged, -self._merged.scale)
+            self._merged = None
+        if adapter is not None:
+            started = time.perf_counter()
+            self._apply(llm, adapter, adapter.scale)
+            self._record_load(adapter, started)
+            self._merged = adapter
+
+    @staticmethod
+    def _apply(llm, adapter: LoraAdapter, scale: float):
+        import llama_cpp
+        base = get_settings().LORA_BASE_MODEL
+        result = llama_cpp.llama_model_apply_lora_from_file(
+            llm._model.model,
+            adapter.path.encode("utf-8"),
+            scale,
+            base.encode("utf-8") if base else None,
+            llm.context_params.n_threads
+        )
+        if result != 0:
+            raise RuntimeError(f"Failed to apply LoRA adapter {adapter.name} from {adapter.path}")
+
+    def _record_load(self, adapter: LoraAdapter, started: float):
+        elapsed = (time.perf_counter() - started) * 1000
+        self.loads += 1
+        self.load_ms += elapsed
+        logger.info(f"Loaded LoRA adapter {adapter.name} in {elapsed:.1f}ms")
+
+    def shrink(self, nbytes: int) -> int:
+        """Free resident adapters other than the active one; returns bytes freed"""
+        api = _adapter_api()
+        if api is None:
+            return 0
+        freed = 0
+        with self._lock:
+            for name in [name for name in self._resident if name != self.active]:
+                if freed >= nbytes:
+                    break
+                freed += self._resident[name][0].size_bytes
+                self._evict(name, api[3])
+        return freed
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": "resident" if hot_swap_supported() else "merge",
+            "active": self.active,
+            "resident": list(self._resident) if self._resident else ([self._merged.name] if self._merged else []),
+            "resident_bytes": self.resident_bytes,
+            "budget_bytes": get_settings().LORA_CACHE_MB << 20,
+            "loads": self.loads,
+            "avg_load_ms": round(self.load_ms / self.loads, 2) if self.loads else None,
+            "switches": self.switches,
+            "avg_switch_ms": round(self.switch_ms / self.switches, 2) if self.switches else None,
+            "last_switch_ms": round(self.last_switch_ms, 2) if self.last_switch_ms is not None else None,
+            "evictions": self.evictions,
+        }
+
+
+class AdapterQueue:
+    """Hands the model to one generation at a time, preferring waiters for the adapter that is applied
+
+    A waiter for another adapter is passed over at most LORA_MAX_CONSECUTIVE
+    times in a row, so one busy tenant cannot starve the rest.
+    """
+
+    def __init__(self):
+        self._waiting: List[Tuple[Optional[str], asyncio.Future]] = []
+        self._busy = False
+        self._current: Optional[str] = None
+        self._streak = 0
+        self.grants = 0
+        self.regrouped = 0
+
+    def _grant(self, adapter: Optional[str]):
+        self._busy = True
+        self.grants += 1
+        if adapter == self._current:
+            self._streak += 1
+        else:
+            self._current = adapter
+            self._streak = 1
+
+    def _release(self):
+        self._busy = False
+        if not self._waiting:
+            return
+        chosen = self._waiting[0]
+        if self._streak < get_settings().LORA_MAX_CONSECUTIVE and chosen[0] != self._current:
+            same = next((entry for entry in self._waiting if entry[0] == self._current), None)
+            if same is not None:
+                chosen = same
+                self.regrouped += 1
+        self._waiting.remove(chosen)
+        self._grant(chosen[0])
+        chosen[1].set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, adapter: Optional[str]):
+        if self._busy or self._waiting:
+            entry = (adapter, asyncio.get_event_loop().create_future())
+            self._waiting.append(entry)
+            try:
+                await entry[1]
+            except asyncio.CancelledError:
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                elif entry[1].done() and not entry[1].cancelled():
+                    # Granted just as the waiter was cancelled; pass the model on
+                    self._release()
+                raise
+        else:
+            self._grant(adapter)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"waiting": len(self._waiting), "grants": self.grants, "regrouped": self.regrouped}
+
+
+adapter_registry = AdapterRegistry()
+lora_runtime = LoraRuntime()
+adapter_queue = AdapterQueue()
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import os
+import platform
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+import psutil
+from app.config import Settings
+
+logger = logging.getLogger(__name__)
+
+BENCH_TEXT = "The quick brown fox jumps over the lazy dog while the scheduler measures throughput. "
+BENCH_DECODE_TOKENS = 16
+BATCH_CANDIDATES = [64, 128, 256, 512]
+# At least one full batch of the largest candidate, otherwise the larger candidates all evaluate the prompt in one call
+BENCH_PROMPT_TOKENS = max(BATCH_CANDIDATES)
+
+
+def cpu_model() -> str:
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def usable_cpus() -> int:
+    """CPUs this process may run on, which inside containers is often fewer than the host has"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return psutil.cpu_count() or 1
+
+
+def cpu_topology() -> Dict:
+    return {
+        "cpu_model": cpu_model(),
+        "physical_cores": psutil.cpu_count(logical=False) or usable_cpus(),
+        "logical_cpus": psutil.cpu_count() or usable_cpus(),
+        "usable_cpus": usable_cpus(),
+    }
+
+
+def model_fingerprint(model_path: str) -> str:
+    """Hash of the model's size and first and last MiB; hashing several GB on every boot is too slow"""
+    size = os.path.getsize(model_path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(model_path, "rb") as f:
+        digest.update(f.read(1 << 20))
+        f.seek(max(0, size - (1 << 20)))
+        digest.update(f.read(1 << 20))
+    return digest.hexdigest()[:16]
+
+
+def thread_candidates(topology: Dict) -> List[int]:
+    physical = min(topology["physical_cores"], topology["usable_cpus"])
+    usable = topology["usable_cpus"]
+    candidates = {max(1, physical // 2), max(1, physical - 1), physical, usable}
+    return sorted(c for c in candidates if c <= usable)
+
+
+def _bench(settings: Settings, n_threads: int, n_threads_batch: int, n_batch: int) -> Dict[str, float]:
+    """Prompt-eval and decode tokens/sec for one configuration"""
+    # Imported here so model_fingerprint stays usable by backends without llama.cpp
+    from llama_cpp import Llama
+    llm = Llama(
+        model_path=settings.MODEL_PATH,
+        n_ctx=max(settings.CONTEXT_LENGTH, BENCH_PROMPT_TOKENS + BENCH_DECODE_TOKENS + 8),
+        n_gpu_layers=0,
+        n_threads=n_threads,
+        n_threads_batch=n_threads_batch,
+        n_batch=n_batch,
+        use_mmap=True,
+        verbose=False
+    )
+    try:
+        tokens = llm.tokenize(BENCH_TEXT.encode("utf-8"), add_bos=True)
+        prompt = (tokens * (BENCH_PROMPT_TOKENS // len(tokens) + 1))[:BENCH_PROMPT_TOKENS]
+        # Warm-up pass so page faults on the mapped weights are not measured
+        llm.eval(prompt[:8])
+        llm.reset()
+
+        started = time.perf_counter()
+        llm.eval(prompt)
+        prompt_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for i in range(BENCH_DECODE_TOKENS):
+            llm.eval([tokens[1 + i % (len(tokens) - 1)]])
+        decode_seconds = time.perf_counter() - started
+    finally:
+        del llm
+
+    return {
+        "prompt_tps": round(BENCH_PROMPT_TOKENS / prompt_seconds, 2),
+        "decode_tps": round(BENCH_DECODE_TOKENS / decode_seconds, 2),
+    }
+
+
+def run_benchmark(settings: Settings, topology: Dict) -> Dict:
+    """Pick decode threads, prompt-eval threads and batch size from short measurements"""
+    results = []
+    best_decode = best_prompt = None
+    for threads in thread_candidates(topology):
+        result = _bench(settings, threads, threads, max(BATCH_CANDIDATES))
+        logger.info(f"Autotune threads={threads}: {result}")
+        results.append({"n_threads": threads, "n_batch": max(BATCH_CANDIDATES), **result})
+        if best_decode is None or result["decode_tps"] > best_decode[1]["decode_tps"]:
+            best_decode = (threads, result)
+        if best_prompt is None or result["prompt_tps"] > best_prompt[1]["prompt_tps"]:
+            best_prompt = (threads, result)
+
+    n_threads, n_threads_batch = best_decode[0], best_prompt[0]
+    best_batch = (max(BATCH_CANDIDATES), best_prompt[1])
+    for n_batch in BATCH_CANDIDATES:
+        if n_batch == max(BATCH_CANDIDATES):
+            continue
+        result = _bench(settings, n_threads, n_threads_batch, n_batch)
+        logger.info(f"Autotune n_batch={n_batch}: {result}")
+        results.append({"n_threads": n_threads_batch, "n_batch": n_batch, **result})
+        if result["prompt_tps"] > best_batch[1]["prompt_tps"]:
+            best_batch = (n_batch, result)
+
+    return {
+        "n_threads": n_threads,
+        "n_threads_batch": n_threads_batch,
+        "n_batch": best_batch[0],
+        "prompt_tps": best_batch[1]["prompt_tps"],
+        "decode_tps": best_decode[1]["decode_tps"],
+        "measured_at": datetime.utcnow().isoformat(),
+        "candidates": results,
+    }
+
+
+def _load_profiles(path: str) -> Dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_profiles(path: str, profiles: Dict):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def resolve_runtime_params(settings: Settings) -> Dict:
+    """Thread and batch settings for this host, from config, the profile cache or a fresh benchmark"""
+    params = {
+        "n_threads": settings.THREADS,
+        "n_threads_batch": settings.THREADS_BATCH or settings.THREADS,
+        "n_batch": settings.N_BATCH,
+        "source": "config",
+    }
+    if not settings.AUTOTUNE:
+        return params
+
+    topology = cpu_topology()
+    key = "|".join([
+        topology["cpu_model"],
+        str(topology["usable_cpus"]),
+        model_fingerprint(settings.MODEL_PATH),
+        str(settings.CONTEXT_LENGTH),
+    ])
+    profiles = _load_profiles(settings.AUTOTUNE_PROFILE_PATH)
+    profile = profiles.get(key)
+    if profile is not None:
+        logger.info(f"Using cached tuning profile: threads={profile['n_threads']} batch={profile['n_batch']}")
+        return {**profile, "source": "profile", "topology": topology}
+
+    logger.info(f"No tuning profile for {key}, benchmarking...")
+    started = time.perf_counter()
+    profile = run_benchmark(settings, topology)
+    profile["benchmark_seconds"] = round(time.perf_counter() - started, 1)
+    profiles[key] = profile
+    try:
+        _save_profiles(settings.AUTOTUNE_PROFILE_PATH, profiles)
+    except OSError as e:
+        logger.warning(f"Could not save tuning profile: {e}")
+    return {**profile, "source": "benchmark", "topology": topology}
@@ -0,0 +1,13 @@
+from app.config import get_settings
+
+def get_model():
+    """The configured inference backend; all expose the same generation interface"""
+    if get_settings().BACKEND == "transformers":
+        # Imported lazily so llama.cpp-only deployments don't need torch
+        from app.models.inference import ModelManager
+        return ModelManager()
+    if get_settings().BACKEND == "stub":
+        from app.models.stub import StubModel
+        return StubModel()
+    from app.models.llama_model import LlamaModel
+    return LlamaModel()
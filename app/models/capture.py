@@ -0,0 +1,135 @@
+"""
+Opt-in capture of production request shapes for replay
+
+Only the shape of each generation request is kept: when it arrived, how
+long its prompt was, its sampling parameters and how it was served. Prompt
+and completion text are never written. Session, template, connection and
+API key ids are replaced by keyed hashes with a per-process random key, so
+reuse within one capture survives but the ids themselves cannot be recovered.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_VERSION = 1
+# Fields holding ids that are hashed before they are captured
+ANONYMIZED_FIELDS = ("key", "tpl", "sess", "conn")
+
+
+class TrafficCapture:
+    """Buffers request shapes and appends them to a JSON Lines file, one compact object per request"""
+
+    def __init__(self):
+        self._buffer: deque = deque(maxlen=100000)
+        self._key = os.urandom(16)
+        self._flush_task: Optional[asyncio.Task] = None
+        self.captured = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(get_settings().CAPTURE_PATH)
+
+    def anonymize(self, value: Optional[str]) -> Optional[str]:
+        if value is None:
+            return None
+        return hmac.new(self._key, value.encode("utf-8"), hashlib.sha256).hexdigest()[:12]
+
+    def record(
+        self,
+        shape: Dict[str, Any],
+        arrived: float,
+        status_code: int,
+        latency_ms: float,
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+    ):
+        """Queue one finished request; `shape` holds the fields the handler knew about it"""
+        if not self.enabled or random.random() >= get_settings().CAPTURE_SAMPLE_RATE:
+            return
+        entry = {"ts": round(arrived, 3), **shape, "st": status_code, "lat": round(latency_ms, 1)}
+        # Measured token counts replace the handler's estimate when the backend reported them
+        if prompt_tokens is not None:
+            entry["pt"] = prompt_tokens
+        if completion_tokens is not None:
+            entry["ct"] = completion_tokens
+        self._buffer.append({name: value for name, value in entry.items() if value is not None})
+        self.captured += 1
+
+    def flush(self):
+        records: List[Dict[str, Any]] = []
+        try:
+            while True:
+                records.append(self._buffer.popleft())
+        except IndexError:
+            pass
+        if not records:
+            return
+        path = get_settings().CAPTURE_PATH
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+            with open(path, "a") as f:
+                if new_file:
+                    f.write(json.dumps({"capture": CAPTURE_VERSION, "started": time.time()}) + "\n")
+                for record in records:
+                    f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        except OSError as e:
+            logger.error(f"Failed to write {len(records)} captured requests to {path}: {e}")
+
+    async def _flush_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(1.0)
+            await loop.run_in_executor(None, self.flush)
+
+    def start(self):
+        if self.enabled and self._flush_task is None:
+            logger.info(f"Capturing request shapes to {get_settings().CAPTURE_PATH}")
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await asyncio.get_event_loop().run_in_executor(None, self.flush)
+
+
+traffic_capture = TrafficCapture()
+
+
+def request_shape(
+    endpoint: str,
+    prompt_tokens: int,
+    max_tokens: Optional[int] = None,
+    temperature: Optional[float] = None,
+    top_p: Optional[float] = None,
+    top_k: Optional[int] = None,
+    seed: Optional[int] = None,
+    stream: bool = False,
+    **fields
+) -> Dict[str, Any]:
+    """Compact capture record for a generation request; `fields` named in ANONYMIZED_FIELDS are hashed"""
+    shape = {
+        "ep": endpoint,
+        "pt": prompt_tokens,
+        "mt": max_tokens,
+        "temp": temperature,
+        "top_p": top_p,
+        "top_k": top_k,
+        # Whether the request was seeded matters for coalescing; the seed itself does not
+        "seeded": seed is not None or None,
+        "stream": stream or None,
+    }
+    for name, value in fields.items():
+        shape[name] = traffic_capture.anonymize(value) if name in ANONYMIZED_FIELDS else value
+    return shape
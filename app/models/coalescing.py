@@ -0,0 +1,129 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(**params: Any) -> str:
+    """Stable key over everything that determines the generated output"""
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def is_deterministic(temperature: Optional[float], seed: Optional[int]) -> bool:
+    """Only requests that must produce identical output may share one generation"""
+    return temperature == 0 or seed is not None
+
+
+class Flight:
+    """One running generation whose events are replayed to every subscriber"""
+
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Future] = None
+        self._changed = asyncio.Condition()
+
+    async def publish(self, event: Dict[str, Any]):
+        async with self._changed:
+            self.events.append(event)
+            self._changed.notify_all()
+
+    async def finish(self, error: Optional[BaseException] = None):
+        async with self._changed:
+            self.done = True
+            self.error = error
+            self._changed.notify_all()
+
+    async def subscribe(self) -> AsyncIterator[Dict[str, Any]]:
+        """Events published so far, then new ones as they arrive"""
+        position = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: position < len(self.events) or self.done)
+                batch = self.events[position:]
+                position = len(self.events)
+                done, error = self.done, self.error
+            for event in batch:
+                yield event
+            if done:
+                if error is not None:
+                    raise error
+                return
+
+
+class SingleFlight:
+    """Runs identical in-flight generations once and fans the events out to all callers"""
+
+    def __init__(self):
+        self._inflight: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def _forget(self, key: str, flight: Flight):
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+
+    async def _drive(self, key: str, flight: Flight, producer: Callable[[], AsyncIterator[Dict[str, Any]]]):
+        error: Optional[BaseException] = None
+        events = producer()
+        try:
+            async for event in events:
+                await flight.publish(event)
+        except asyncio.CancelledError:
+            error = RuntimeError("Generation was cancelled")
+            raise
+        except Exception as e:
+            error = e
+        finally:
+            self._forget(key, flight)
+            try:
+                # Stops the model and releases the memory reservation if the generation was cut short
+                await events.aclose()
+            finally:
+                await flight.finish(error)
+
+    async def _subscribe(self, key: str, flight: Flight) -> AsyncIterator[Dict[str, Any]]:
+        try:
+            async for event in flight.subscribe():
+                yield event
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # Every caller has gone, so nobody would read the rest of the generation
+                self._forget(key, flight)
+                self.abandoned += 1
+                flight.task.cancel()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._inflight
+
+    def join(self, key: str, producer: Callable[[], AsyncIterator[Dict[str, Any]]]) -> AsyncIterator[Dict[str, Any]]:
+        """Subscribe to the running flight for `key`, starting one with `producer` if there is none"""
+        flight = self._inflight.get(key)
+        if flight is None:
+            flight = self._inflight[key] = Flight()
+            self.leaders += 1
+            # The generation runs as its own task so it survives the first caller disconnecting
+            flight.task = asyncio.ensure_future(self._drive(key, flight, producer))
+        else:
+            self.coalesced += 1
+        # Counted on join rather than on first read, so a caller that has not started reading keeps it alive
+        flight.subscribers += 1
+        return self._subscribe(key, flight)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+            "in_flight": len(self._inflight),
+        }
+
+
+single_flight = SingleFlight()
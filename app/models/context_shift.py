@@ -0,0 +1,155 @@
+"""
+Rolling context for generations longer than the KV cache
+
+llama-cpp-python stops a completion when prompt plus output reach n_ctx.
+RollingCompletion decodes token by token instead, and when the cache is full
+it removes a span of the oldest tokens after the kept prefix (the system
+prompt) with llama_kv_cache_seq_rm, then moves the remaining cells back with
+llama_kv_cache_seq_shift. RoPE models re-rotate the shifted keys inside
+llama.cpp, so nothing that was kept is evaluated again.
+"""
+import logging
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+import llama_cpp
+from llama_cpp import Llama
+from app.models.stops import StopFilter
+
+logger = logging.getLogger(__name__)
+
+
+class RollingCompletion:
+    """Completion of `prompt_tokens` that shifts the KV cache instead of stopping at n_ctx
+
+    Iterating yields text as it is decoded, holding back anything that could
+    still turn into a stop sequence. Afterwards `shifts`, `discarded_tokens`,
+    `prompt_tokens`, `completion_tokens` and `finish_reason` describe the run.
+    """
+
+    def __init__(
+        self,
+        llm: Llama,
+        prompt_tokens: Sequence[int],
+        n_keep: int,
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        repeat_penalty: float = 1.1,
+        stop: Sequence[str] = (),
+        seed: Optional[int] = None,
+        n_discard: int = 0
+    ):
+        self._llm = llm
+        self._n_ctx = llm.n_ctx()
+        # At least half the window stays free for the text that follows the kept prefix
+        self._n_keep = max(0, min(n_keep, self._n_ctx // 2))
+        self._n_discard = n_discard
+        self._max_tokens = max_tokens
+        self._sampling = dict(temp=temperature, top_p=top_p, top_k=top_k, repeat_penalty=repeat_penalty)
+        self._stop = stop
+        self._seed = seed
+        self._prompt = self._fit_prompt(list(prompt_tokens))
+        self.prompt_tokens = len(prompt_tokens)
+        self.truncated_tokens = len(prompt_tokens) - len(self._prompt)
+        self.completion_tokens = 0
+        self.shifts = 0
+        self.discarded_tokens = 0
+        self.finish_reason: Optional[str] = None
+
+    def _fit_prompt(self, tokens: List[int]) -> List[int]:
+        """Drop the oldest tokens after the kept prefix from a prompt that alone overflows the context"""
+        if len(tokens) < self._n_ctx:
+            return tokens
+        tail = (self._n_ctx - self._n_keep) // 2
+        return tokens[:self._n_keep] + tokens[-tail:]
+
+    def _shift(self):
+        """Forget the oldest tokens after the kept prefix and slide the rest of the cache back over them"""
+        llm = self._llm
+        n_past = llm.n_tokens
+        n_free = n_past - self._n_keep
+        n_discard = min(self._n_discard or n_free // 2, n_free - 1)
+        if n_discard <= 0:
+            raise RuntimeError(f"Context of {self._n_ctx} tokens is full and only the kept prefix is left")
+        ctx = llm._ctx.ctx
+        llama_cpp.llama_kv_cache_seq_rm(ctx, 0, self._n_keep, self._n_keep + n_discard)
+        llama_cpp.llama_kv_cache_seq_shift(ctx, 0, self._n_keep + n_discard, n_past, -n_discard)
+        # Keep the Python-side token history in step with the cache for prefix reuse and repeat penalty
+        llm.input_ids[self._n_keep:n_past - n_discard] = llm.input_ids[self._n_keep + n_discard:n_past].copy()
+        llm.n_tokens = n_past - n_discard
+        self.shifts += 1
+        self.discarded_tokens += n_discard
+
+    def _eval_prompt(self) -> List[int]:
+        """Reuse the evaluated prefix the cache already holds; returns the prompt tokens still to evaluate"""
+        llm = self._llm
+        cached = llm.input_ids[:llm.n_tokens].tolist()
+        common = 0
+        for cached_token, token in zip(cached, self._prompt):
+            if cached_token != token:
+                break
+            common += 1
+        # Re-evaluate at least the last prompt token so its logits are fresh
+        llm.n_tokens = min(common, len(self._prompt) - 1)
+        return self._prompt[llm.n_tokens:]
+
+    def __iter__(self) -> Iterator[str]:
+        llm = self._llm
+        if self._seed is not None:
+            llm.set_seed(self._seed)
+        eos = llm.token_eos()
+        pending = self._eval_prompt()
+        stops = StopFilter(self._stop)
+        self.finish_reason = "length"
+        while self.completion_tokens < self._max_tokens:
+            if llm.n_tokens + len(pending) > self._n_ctx:
+                self._shift()
+            llm.eval(pending)
+            token = llm.sample(**self._sampling)
+            if token == eos:
+                self.finish_reason = "stop"
+                break
+            self.completion_tokens += 1
+            pending = [token]
+            text = stops.feed(llm.detokenize([token]))
+            if text:
+                yield text
+            if stops.stopped:
+                self.finish_reason = "stop"
+                break
+        text = stops.flush()
+        if text:
+            yield text
+        if self.shifts:
+            logger.info(
+                f"Shifted the context {self.shifts} times ({self.discarded_tokens} tokens discarded, "
+                f"{self._n_keep} kept) over {self.completion_tokens} generated tokens"
+            )
+
+
+class ContextShiftStats:
+    """Totals over every rolling completion since startup"""
+
+    def __init__(self):
+        self.completions = 0
+        self.shifts = 0
+        self.discarded_tokens = 0
+        self.truncated_prompts = 0
+
+    def record(self, completion: RollingCompletion):
+        self.completions += 1
+        self.shifts += completion.shifts
+        self.discarded_tokens += completion.discarded_tokens
+        if completion.truncated_tokens:
+            self.truncated_prompts += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rolling_completions": self.completions,
+            "shifts": self.shifts,
+            "discarded_tokens": self.discarded_tokens,
+            "truncated_prompts": self.truncated_prompts,
+        }
+
+
+context_shift_stats = ContextShiftStats()
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, String, DateTime, Boolean
+from sqlalchemy import create_engine, Column, String, DateTime, Boolean, Integer, Float, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
@@ -26,6 +26,36 @@ class APIKeyModel(Base):
     last_used = Column(DateTime, nullable=True)
     is_active = Column(Boolean, default=True)
 
+class ChatSessionModel(Base):
+    __tablename__ = "chat_sessions"
+
+    id = Column(String, primary_key=True, index=True)
+    api_key = Column(String, nullable=True, index=True)
+    title = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+    messages = Column(Text, nullable=False, default="[]")  # JSON list of {role, content}
+
+class UsageMinuteModel(Base):
+    __tablename__ = "usage_minute"
+
+    api_key = Column(String, primary_key=True)
+    bucket_start = Column(Integer, primary_key=True, index=True)  # Unix seconds, minute aligned
+    requests = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+    latency_ms_sum = Column(Float, nullable=False, default=0.0)
+
+class UsageHourModel(Base):
+    __tablename__ = "usage_hour"
+
+    api_key = Column(String, primary_key=True)
+    bucket_start = Column(Integer, primary_key=True, index=True)  # Unix seconds, hour aligned
+    requests = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+    latency_ms_sum = Column(Float, nullable=False, default=0.0)
+
 # Dependency to get database session
 def get_db():
     db = SessionLocal()
@@ -0,0 +1,236 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Set
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = "HuggingMind-Provisioner/1.0"
+BUFFER_SIZE = 1 << 20  # 1 MiB reads from the socket
+HASH_BUFFER_SIZE = 8 << 20
+
+
+class DownloadError(RuntimeError):
+    pass
+
+
+class ChecksumMismatch(DownloadError):
+    pass
+
+
+def load_expected_sha256(url: str, manifest_path: Optional[str] = None, sha256: Optional[str] = None) -> Optional[str]:
+    """Resolve the expected digest from an explicit value or a JSON manifest keyed by file name"""
+    if sha256:
+        return sha256.lower()
+    if not manifest_path:
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    name = os.path.basename(urlparse(url).path)
+    entry = manifest.get(name)
+    if entry is None:
+        raise DownloadError(f"No manifest entry for {name} in {manifest_path}")
+    digest = entry["sha256"] if isinstance(entry, dict) else entry
+    return digest.lower()
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(HASH_BUFFER_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ModelDownloader:
+    """Parallel, resumable HTTP range downloader writing atomically into place
+
+    The file is fetched into `<destination>.part` in fixed-size chunks, with the
+    indices of finished chunks recorded in `<destination>.part.json` so an
+    interrupted download only refetches the chunks that were not completed.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        destination: str,
+        sha256: Optional[str] = None,
+        connections: int = 8,
+        chunk_size: int = 32 << 20,
+        timeout: float = 60.0,
+        progress: Optional[Callable[[int, int], None]] = None,
+    ):
+        self.url = url
+        self.destination = destination
+        self.sha256 = sha256.lower() if sha256 else None
+        self.connections = max(1, connections)
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.progress = progress
+        self.part_path = destination + ".part"
+        self.state_path = destination + ".part.json"
+        self._lock = threading.Lock()
+        self._downloaded = 0
+        self._total = 0
+
+    def _probe(self, session: requests.Session):
+        """Return (size, supports_ranges, validator) for the remote file"""
+        response = session.head(self.url, allow_redirects=True, timeout=self.timeout)
+        response.raise_for_status()
+        size = int(response.headers.get("Content-Length", 0))
+        ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified") or ""
+        # Follow redirects once so every range request goes straight to the final host
+        self.url = response.url
+        return size, ranges, validator
+
+    def _load_state(self, size: int, validator: str) -> Set[int]:
+        if not (os.path.exists(self.state_path) and os.path.exists(self.part_path)):
+            return set()
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if state.get("size") != size or state.get("chunk_size") != self.chunk_size or state.get("validator") != validator:
+            logger.info("Remote file changed since the partial download started, restarting")
+            return set()
+        return set(state.get("done", []))
+
+    def _save_state(self, size: int, validator: str, done: Set[int]):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"size": size, "chunk_size": self.chunk_size, "validator": validator, "done": sorted(done)}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _advance(self, count: int):
+        with self._lock:
+            self._downloaded += count
+            if self.progress:
+                self.progress(self._downloaded, self._total)
+
+    def _fetch_chunk(self, session: requests.Session, fd: int, index: int, size: int):
+        start = index * self.chunk_size
+        end = min(start + self.chunk_size, size) - 1
+        headers = {"Range": f"bytes={start}-{end}", "User-Agent": USER_AGENT}
+        with session.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code != 206:
+                raise DownloadError(f"Expected 206 for range {start}-{end}, got {response.status_code}")
+            offset = start
+            for data in response.iter_content(chunk_size=BUFFER_SIZE):
+                os.pwrite(fd, data, offset)
+                offset += len(data)
+                self._advance(len(data))
+        if offset != end + 1:
+            raise DownloadError(f"Short read for range {start}-{end}: got {offset - start} bytes")
+
+    def _download_ranges(self, session: requests.Session, size: int, validator: str):
+        chunks = (size + self.chunk_size - 1) // self.chunk_size
+        done = self._load_state(size, validator)
+        if not done and os.path.exists(self.part_path):
+            os.remove(self.part_path)
+        self._downloaded = sum(min(self.chunk_size, size - i * self.chunk_size) for i in done)
+        pending = [i for i in range(chunks) if i not in done]
+        if done:
+            logger.info(f"Resuming download: {len(done)}/{chunks} chunks already present")
+
+        fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+
+            def worker(index: int):
+                self._fetch_chunk(session, fd, index, size)
+                with self._lock:
+                    done.add(index)
+                    self._save_state(size, validator, done)
+
+            with ThreadPoolExecutor(max_workers=min(self.connections, max(1, len(pending)))) as pool:
+                for future in [pool.submit(worker, i) for i in pending]:
+                    future.result()
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _download_stream(self, session: requests.Session):
+        headers = {"User-Agent": USER_AGENT}
+        with session.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            self._downloaded = 0
+            with open(self.part_path, "wb") as f:
+                for data in response.iter_content(chunk_size=BUFFER_SIZE):
+                    f.write(data)
+                    self._advance(len(data))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def download(self) -> str:
+        """Download, verify and atomically move the file to its destination"""
+        directory = os.path.dirname(os.path.abspath(self.destination))
+        os.makedirs(directory, exist_ok=True)
+
+        with requests.Session() as session:
+            adapter = HTTPAdapter(pool_maxsize=self.connections)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["User-Agent"] = USER_AGENT
+
+            size, ranges, validator = self._probe(session)
+            self._total = size
+            if ranges and size > 0:
+                logger.info(f"Downloading {size} bytes with {self.connections} connections to {self.destination}")
+                self._download_ranges(session, size, validator)
+            else:
+                logger.info(f"Server does not support ranges, downloading {self.url} as a single stream")
+                self._download_stream(session)
+
+        if self.sha256:
+            actual = sha256_file(self.part_path)
+            if actual != self.sha256:
+                # A corrupt file must never be resumed from
+                os.remove(self.part_path)
+                if os.path.exists(self.state_path):
+                    os.remove(self.state_path)
+                raise ChecksumMismatch(f"SHA256 mismatch for {self.url}: expected {self.sha256}, got {actual}")
+            logger.info("SHA256 verified")
+
+        os.replace(self.part_path, self.destination)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        # Persist the rename itself
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        return self.destination
+
+
+def provision_model(destination: Optional[str] = None, url: Optional[str] = None, progress: Optional[Callable[[int, int], None]] = None) -> str:
+    """Download the configured model into MODEL_PATH unless it is already there"""
+    settings = get_settings()
+    destination = destination or settings.MODEL_PATH
+    url = url or settings.MODEL_URL
+    if os.path.exists(destination):
+        return destination
+    sha256 = load_expected_sha256(url, settings.MODEL_MANIFEST or None, settings.MODEL_SHA256 or None)
+    if sha256 is None:
+        logger.warning("No SHA256 configured for the model, skipping verification")
+    downloader = ModelDownloader(
+        url,
+        destination,
+        sha256=sha256,
+        connections=settings.DOWNLOAD_CONNECTIONS,
+        chunk_size=settings.DOWNLOAD_CHUNK_MB << 20,
+        progress=progress,
+    )
+    return downloader.download()
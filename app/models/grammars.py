@@ -0,0 +1,238 @@
+"""
+Grammar-constrained output for response_format
+
+A JSON schema is converted to GBNF and every grammar is parsed into
+llama.cpp rules once, then kept in an LRU keyed by the hash of its source,
+so repeated calls with the same schema skip both steps. Each generation gets
+its own llama_grammar parse state built from the cached rules.
+
+JSON output stops as soon as the top-level object, array or string closes.
+The grammar would otherwise let the model pad the value with whitespace
+until max_tokens.
+"""
+import ctypes
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp.llama_grammar import JSON_GBNF, LlamaGrammar, const_char_p, json_schema_to_gbnf, llama_gretype, parse
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_FORMATS = ("json_object", "json_schema", "grammar")
+
+
+class GrammarError(ValueError):
+    """Raised when a response_format schema or grammar cannot be compiled"""
+
+
+class _GrammarState(LlamaGrammar):
+    """A parse state over rules converted once; reset re-initializes it without converting them again"""
+
+    def init(self) -> None:
+        self.grammar = llama_cpp.llama_grammar_init(
+            self._rules, ctypes.c_size_t(self._n_rules), ctypes.c_size_t(self._start_rule_index)
+        )
+
+
+class CompiledGrammar:
+    """Parsed rules of one grammar, shared by every request that uses it"""
+
+    def __init__(self, key: str, kind: str, grammar: LlamaGrammar, compile_ms: float):
+        self.key = key
+        self.kind = kind
+        self.json_output = kind != "grammar"
+        self.compile_ms = compile_ms
+        self._grammar = grammar
+
+    def instance(self) -> LlamaGrammar:
+        """A grammar with its own parse state; llama_grammar_init copies the shared rules"""
+        grammar = _GrammarState.__new__(_GrammarState)
+        grammar.__dict__.update(self._grammar.__dict__)
+        grammar.init()
+        return grammar
+
+
+class ResponseGrammar:
+    """A compiled grammar as one request uses it"""
+
+    def __init__(self, compiled: CompiledGrammar, cache_hit: bool):
+        self.compiled = compiled
+        self.cache_hit = cache_hit
+
+    @property
+    def key(self) -> str:
+        return self.compiled.key
+
+
+class JsonCloseTracker:
+    """Watches generated text and reports when the top-level JSON value has closed
+
+    Called as a llama-cpp-python stopping criterion it reads new tokens from
+    input_ids; the scheduler feeds it text directly.
+    """
+
+    def __init__(self, llm: Llama):
+        self._llm = llm
+        self._seen: Optional[int] = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._started = False
+        self.closed = False
+
+    def feed(self, text: str) -> bool:
+        for char in text:
+            if self.closed:
+                break
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    self.closed = self._depth == 0
+            elif char == '"':
+                self._in_string = True
+                self._started = True
+            elif char in "{[":
+                self._depth += 1
+                self._started = True
+            elif char in "}]":
+                self._depth -= 1
+                self.closed = self._depth == 0
+            elif not char.isspace() and not self._started:
+                # A bare number or literal has no closing character; the grammar ends it
+                self._started = True
+        return self.closed
+
+    def __call__(self, input_ids: np.ndarray, logits: np.ndarray) -> bool:
+        # Called after each sample with the tokens evaluated so far, the prompt on the first call
+        if self._seen is None:
+            self._seen = len(input_ids)
+        elif len(input_ids) > self._seen and not self.closed:
+            # Structural characters are ASCII, so a split multi-byte character cannot hide one
+            self.feed(self._llm.detokenize(input_ids[self._seen:].tolist()).decode("utf-8", errors="ignore"))
+            self._seen = len(input_ids)
+        return self.closed
+
+
+def _gbnf(kind: str, schema: Optional[Dict[str, Any]], grammar: Optional[str]) -> str:
+    if kind == "json_object":
+        return JSON_GBNF
+    if kind == "json_schema":
+        if not isinstance(schema, dict):
+            raise GrammarError("response_format json_schema needs a schema object")
+        try:
+            return json_schema_to_gbnf(json.dumps(schema))
+        except Exception as e:
+            raise GrammarError(f"Unsupported JSON schema: {e}")
+    if kind == "grammar":
+        if not grammar:
+            raise GrammarError("response_format grammar needs a GBNF grammar")
+        return grammar
+    raise GrammarError(f"Unknown response_format type '{kind}', expected one of {', '.join(RESPONSE_FORMATS)}")
+
+
+def _parse(gbnf: str) -> LlamaGrammar:
+    """Check the parsed rules before building the grammar
+
+    LlamaGrammar.from_string constructs the object before looking up the root
+    rule, so a grammar without one leaves a half-built instance whose __del__
+    fails, and a reference to an undefined rule crashes llama_grammar_init.
+    """
+    state = parse(const_char_p(gbnf))
+    if state.rules.empty():
+        raise ValueError("it does not parse")
+    if "root" not in state.symbol_ids:
+        raise ValueError("there is no root rule")
+    names = {rule_id: name for name, rule_id in state.symbol_ids.items()}
+    for rule in state.rules:
+        for element in rule:
+            if element.type is llama_gretype.LLAMA_GRETYPE_RULE_REF and (element.value >= len(state.rules) or not state.rules[element.value]):
+                raise ValueError(f"rule '{names.get(element.value, element.value)}' is not defined")
+    return LlamaGrammar(state)
+
+
+class GrammarCache:
+    """Compiled grammars by source hash, least recently used evicted beyond GRAMMAR_CACHE_SIZE"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._grammars: "OrderedDict[str, CompiledGrammar]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.compile_ms = 0.0
+        self.evictions = 0
+        self.constrained = 0
+        self.closed_early = 0
+        self.tokens_saved = 0
+
+    def resolve(self, kind: str, schema: Optional[Dict[str, Any]] = None, grammar: Optional[str] = None) -> ResponseGrammar:
+        """The compiled grammar for a response_format; raises GrammarError if it does not compile"""
+        source = json.dumps(schema, separators=(",", ":")) if kind == "json_schema" else (grammar or "")
+        key = hashlib.sha256(f"{kind}\0{source}".encode("utf-8")).hexdigest()
+        with self._lock:
+            compiled = self._grammars.get(key)
+            if compiled is not None:
+                self._grammars.move_to_end(key)
+                self.hits += 1
+                return ResponseGrammar(compiled, True)
+        started = time.perf_counter()
+        gbnf = _gbnf(kind, schema, grammar)
+        try:
+            parsed = _parse(gbnf)
+        except Exception as e:
+            raise GrammarError(f"Invalid grammar: {e}")
+        compiled = CompiledGrammar(key, kind, parsed, (time.perf_counter() - started) * 1000)
+        with self._lock:
+            self.misses += 1
+            self.compile_ms += compiled.compile_ms
+            self._grammars[key] = compiled
+            while len(self._grammars) > max(get_settings().GRAMMAR_CACHE_SIZE, 1):
+                self._grammars.popitem(last=False)
+                self.evictions += 1
+        logger.info(f"Compiled {kind} grammar {key[:12]} in {compiled.compile_ms:.1f}ms")
+        return ResponseGrammar(compiled, False)
+
+    def record(self, grammar: ResponseGrammar, closed: bool, max_tokens: int, completion_tokens: int) -> Dict[str, Any]:
+        """Count a finished constrained generation; returns the grammar block of its usage"""
+        saved = max(max_tokens - completion_tokens, 0) if closed else 0
+        with self._lock:
+            self.constrained += 1
+            if closed:
+                self.closed_early += 1
+                self.tokens_saved += saved
+        return {
+            "type": grammar.compiled.kind,
+            "cache_hit": grammar.cache_hit,
+            "compile_ms": 0.0 if grammar.cache_hit else round(grammar.compiled.compile_ms, 2),
+            "stopped_at_close": closed,
+            "tokens_saved": saved,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "cached": len(self._grammars),
+            "capacity": get_settings().GRAMMAR_CACHE_SIZE,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "compile_ms_total": round(self.compile_ms, 2),
+            "evictions": self.evictions,
+            "constrained_generations": self.constrained,
+            "stopped_at_close": self.closed_early,
+            "tokens_saved": self.tokens_saved,
+        }
+
+
+grammar_cache = GrammarCache()
@@ -1,103 +1,342 @@
-from typing import Dict, Any, Optional
+import asyncio
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from app.config import get_settings
+from app.models.memory import kv_bytes_per_token
+from app.models.sessions import ChatSession
+from app.models.templates import PromptTemplate
+from app.placement import cpu_placement
+from app.tracing import record_span, span
+
+logger = logging.getLogger(__name__)
+
+
+def cpu_dtype(name: str) -> torch.dtype:
+    """float16 matmuls are emulated (slow or unsupported) on CPU; use bfloat16 only with native support"""
+    if name == "float32":
+        return torch.float32
+    if name == "bfloat16":
+        return torch.bfloat16
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+        if "avx512_bf16" in flags or "amx_bf16" in flags:
+            return torch.bfloat16
+    except OSError:
+        pass
+    return torch.float32
+
+
+class _PendingRequest:
+    __slots__ = ("prompt", "max_new_tokens", "sampling", "future", "submitted")
+
+    def __init__(self, prompt: str, max_new_tokens: int, sampling: Tuple, future: asyncio.Future):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.sampling = sampling
+        self.future = future
+        self.submitted = time.perf_counter()
+
 
 class ModelManager:
+    """HuggingFace transformers backend with dynamic batching, interchangeable with LlamaModel"""
+
     _instance = None
     _model = None
     _tokenizer = None
-    _is_vllm = False
+    _initialized = False
+    _init_lock = asyncio.Lock()
+    _last_error = None
+    _initialization_attempts = 0
+    _runtime_params: Optional[Dict[str, Any]] = None
+    _memory_profile: Optional[Dict[str, Any]] = None
+    _running_tokens: List[int] = []  # KV length each sequence of the running batch can reach
+    _queue: Optional[asyncio.Queue] = None
+    _batcher: Optional[asyncio.Task] = None
+    _batches = 0
+    _batched_requests = 0
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(ModelManager, cls).__new__(cls)
         return cls._instance
 
-    def __init__(self):
-        if self._model is None:
-            self._initialize_model()
+    @classmethod
+    async def initialize(cls):
+        """Load the model and tokenizer and start the batching loop"""
+        if cls._initialized:
+            return
+
+        async with cls._init_lock:
+            if cls._initialized:
+                return
+            settings = get_settings()
+            try:
+                dtype = cpu_dtype(settings.TRANSFORMERS_DTYPE)
+                n_threads = cpu_placement.thread_limit(settings.THREADS)
+                torch.set_num_threads(n_threads)
+
+                def load():
+                    tokenizer = AutoTokenizer.from_pretrained(settings.TRANSFORMERS_MODEL)
+                    # Left padding keeps every prompt adjacent to its generated tokens
+                    tokenizer.padding_side = "left"
+                    if tokenizer.pad_token_id is None:
+                        tokenizer.pad_token = tokenizer.eos_token
+                    # torch's intra-op pool starts with the first parallel op and keeps the mask it started with
+                    with cpu_placement.inference():
+                        model = AutoModelForCausalLM.from_pretrained(settings.TRANSFORMERS_MODEL, torch_dtype=dtype)
+                    model.eval()
+                    return tokenizer, model
+
+                logger.info(f"Loading {settings.TRANSFORMERS_MODEL} with transformers ({dtype})")
+                cls._tokenizer, cls._model = await asyncio.get_event_loop().run_in_executor(None, load)
+                cls._runtime_params = {
+                    "source": "config",
+                    "backend": "transformers",
+                    "dtype": str(dtype).replace("torch.", ""),
+                    "n_threads": n_threads,
+                    "max_batch_size": settings.BATCH_MAX_SIZE,
+                    "batch_window_ms": settings.BATCH_WINDOW_MS,
+                }
+                cls._queue = asyncio.Queue()
+                cls._batcher = asyncio.ensure_future(cls._batch_loop())
+                cls._initialized = True
+                cls._last_error = None
+                logger.info("Transformers model initialized successfully!")
+            except Exception as e:
+                cls._initialization_attempts += 1
+                cls._last_error = str(e)
+                logger.error(f"Transformers model initialization failed: {e}", exc_info=True)
+                raise
+
+    @classmethod
+    async def ensure_initialized(cls):
+        if not cls._initialized:
+            await cls.initialize()
+
+    @classmethod
+    def batch_stats(cls) -> Dict[str, float]:
+        return {
+            "batches": cls._batches,
+            "requests": cls._batched_requests,
+            "avg_batch_size": round(cls._batched_requests / cls._batches, 2) if cls._batches else 0.0,
+        }
 
-    def _initialize_model(self):
+    @classmethod
+    def memory_profile(cls) -> Dict[str, Any]:
+        """Weights are resident once; KV grows with each sequence in a batch"""
+        if cls._memory_profile is not None:
+            return cls._memory_profile
+        config = cls._model.config
+        n_head = config.num_attention_heads
+        element_size = next(cls._model.parameters()).element_size()
+        cls._memory_profile = {
+            "weights_bytes": sum(p.numel() * p.element_size() for p in cls._model.parameters()),
+            "kv_cache_bytes": 0,
+            "logits_bytes": 0,
+            "kv_bytes_per_token": kv_bytes_per_token(
+                config.num_hidden_layers,
+                config.hidden_size,
+                n_head,
+                getattr(config, "num_key_value_heads", None) or n_head,
+                element_size
+            ),
+            "kv_per_request": True,
+        }
+        return cls._memory_profile
+
+    @classmethod
+    def kv_usage(cls) -> Dict[str, Any]:
+        """Upper bound of KV bytes for each sequence in the batch that is running now"""
+        per_token = cls.memory_profile()["kv_bytes_per_token"]
+        running = list(cls._running_tokens)
+        return {
+            "type_k": cls._runtime_params["dtype"],
+            "type_v": cls._runtime_params["dtype"],
+            "flash_attn": False,
+            "notes": ["KV cache types apply to the llama_cpp backend only"],
+            "kv_bytes_per_token": per_token,
+            "capacity_bytes": None,
+            "used_cells": sum(running),
+            "used_bytes": sum(running) * per_token,
+            "sequences": [
+                {"seq_id": i, "cells": tokens, "bytes": tokens * per_token}
+                for i, tokens in enumerate(running)
+            ],
+            "measured_at": time.time(),
+        }
+
+    @classmethod
+    async def _batch_loop(cls):
+        """Collect requests for up to BATCH_WINDOW_MS and run each compatible group as one generate call"""
         settings = get_settings()
+        loop = asyncio.get_event_loop()
+        window = settings.BATCH_WINDOW_MS / 1000
+        while True:
+            batch = [await cls._queue.get()]
+            deadline = loop.time() + window
+            while len(batch) < settings.BATCH_MAX_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(cls._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # One generate call takes one set of sampling parameters
+            groups: Dict[Tuple, List[_PendingRequest]] = {}
+            for request in batch:
+                groups.setdefault(request.sampling, []).append(request)
+            for sampling, group in groups.items():
+                started = time.perf_counter()
+                try:
+                    results = await loop.run_in_executor(None, cls._generate_batch, group, sampling)
+                except Exception as e:
+                    for request in group:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    continue
+                cls._batches += 1
+                cls._batched_requests += len(group)
+                for request, result in zip(group, results):
+                    if not request.future.done():
+                        request.future.set_result((started, result))
+
+    @classmethod
+    def _generate_batch(cls, group: List[_PendingRequest], sampling: Tuple) -> List[Dict[str, Any]]:
+        temperature, top_p, top_k, seed = sampling
+        tokenizer = cls._tokenizer
+        inputs = tokenizer([request.prompt for request in group], return_tensors="pt", padding=True)
+        max_new_tokens = max(request.max_new_tokens for request in group)
+        kwargs = {"max_new_tokens": max_new_tokens, "pad_token_id": tokenizer.pad_token_id}
+        if temperature > 0:
+            kwargs.update(do_sample=True, temperature=temperature, top_p=top_p, top_k=top_k)
+        else:
+            kwargs.update(do_sample=False)
+        if seed is not None:
+            torch.manual_seed(seed)
+
+        # Left padding gives every sequence the longest prompt's length in the cache
+        cls._running_tokens = [inputs["input_ids"].shape[1] + max_new_tokens] * len(group)
         try:
-            # Try to import and use vLLM
-            from vllm import LLM, SamplingParams
-            self._model = LLM(
-                model=settings.MODEL_NAME,
-                trust_remote_code=True,
-                tensor_parallel_size=1
-            )
-            self._is_vllm = True
-        except (ImportError, ModuleNotFoundError):
-            # Fallback to regular transformers
-            print("Falling back to standard HuggingFace transformers implementation")
-            self._model = AutoModelForCausalLM.from_pretrained(
-                settings.MODEL_NAME,
-                torch_dtype=torch.float16,
-                device_map="auto"
-            )
-            self._tokenizer = AutoTokenizer.from_pretrained(settings.MODEL_NAME)
-            self._is_vllm = False
-
-    def generate(
+            with torch.inference_mode(), cpu_placement.inference():
+                outputs = cls._model.generate(**inputs, **kwargs)
+        finally:
+            cls._running_tokens = []
+
+        prompt_length = inputs["input_ids"].shape[1]
+        prompt_counts = inputs["attention_mask"].sum(dim=1).tolist()
+        eos_token_id = tokenizer.eos_token_id
+        results = []
+        for i, request in enumerate(group):
+            generated = outputs[i, prompt_length:].tolist()
+            # Sequences that finished early are padded out to the longest one in the batch
+            finish_reason = "length"
+            if eos_token_id in generated[:request.max_new_tokens]:
+                generated = generated[:generated.index(eos_token_id)]
+                finish_reason = "stop"
+            generated = generated[:request.max_new_tokens]
+            results.append({
+                "text": tokenizer.decode(generated, skip_special_tokens=True).strip(),
+                "finish_reason": finish_reason,
+                "usage": {
+                    "prompt_tokens": int(prompt_counts[i]),
+                    "completion_tokens": len(generated),
+                    "total_tokens": int(prompt_counts[i]) + len(generated),
+                },
+            })
+        return results
+
+    async def _submit(
+        self,
+        prompt: str,
+        max_tokens: Optional[int],
+        temperature: Optional[float],
+        top_p: Optional[float],
+        top_k: Optional[int],
+        seed: Optional[int]
+    ) -> Dict[str, Any]:
+        await self.ensure_initialized()
+        settings = get_settings()
+        sampling = (
+            temperature if temperature is not None else settings.TEMPERATURE,
+            top_p or settings.TOP_P,
+            top_k or settings.TOP_K,
+            seed,
+        )
+        request = _PendingRequest(prompt, max_tokens or settings.MAX_TOKENS, sampling, asyncio.get_event_loop().create_future())
+        await self._queue.put(request)
+        started, result = await request.future
+        record_span("queue", (started - request.submitted) * 1000)
+        record_span("generate", (time.perf_counter() - started) * 1000)
+        return result
+
+    async def generate_response(
         self,
         prompt: str,
         max_tokens: Optional[int] = None,
         temperature: Optional[float] = None,
         top_p: Optional[float] = None,
-        top_k: Optional[int] = None
+        top_k: Optional[int] = None,
+        template: Optional[PromptTemplate] = None,
+        seed: Optional[int] = None
     ) -> Dict[str, Any]:
-        settings = get_settings()
-        
-        if self._is_vllm:
-            from vllm import SamplingParams
-            sampling_params = SamplingParams(
-                max_tokens=max_tokens or settings.MAX_TOKENS,
-                temperature=temperature or settings.TEMPERATURE,
-                top_p=top_p or settings.TOP_P,
-                top_k=top_k or settings.TOP_K
-            )
-            outputs = self._model.generate(prompt, sampling_params)
-            
-            return {
-                "text": outputs[0].outputs[0].text,
-                "finish_reason": "length" if len(outputs[0].outputs[0].text) >= max_tokens else "stop",
-                "usage": {
-                    "prompt_tokens": len(outputs[0].prompt_token_ids),
-                    "completion_tokens": len(outputs[0].outputs[0].token_ids),
-                    "total_tokens": len(outputs[0].prompt_token_ids) + len(outputs[0].outputs[0].token_ids)
-                }
-            }
-        else:
-            # Standard transformers implementation
-            inputs = self._tokenizer(prompt, return_tensors="pt").to(self._model.device)
-            outputs = self._model.generate(
-                **inputs,
-                max_new_tokens=max_tokens or settings.MAX_TOKENS,
-                temperature=temperature or settings.TEMPERATURE,
-                top_p=top_p or settings.TOP_P,
-                top_k=top_k or settings.TOP_K,
-                do_sample=True,
-                pad_token_id=self._tokenizer.pad_token_id
-            )
-            
-            response_text = self._tokenizer.decode(outputs[0], skip_special_tokens=True)[len(prompt):]
-            
-            return {
-                "text": response_text,
-                "finish_reason": "length" if len(response_text.split()) >= max_tokens else "stop",
-                "usage": {
-                    "prompt_tokens": len(inputs.input_ids[0]),
-                    "completion_tokens": len(outputs[0]) - len(inputs.input_ids[0]),
-                    "total_tokens": len(outputs[0])
-                }
-            }
-
-    def switch_model(self, model_name: str):
-        """Switch to a different model"""
-        self._model = LLM(
-            model=model_name,
-            trust_remote_code=True,
-            tensor_parallel_size=1
-        ) 
\ No newline at end of file
+        with span("format"):
+            formatted_prompt = f"[INST] {template.prefix if template else ''}{prompt} [/INST]"
+        return await self._submit(formatted_prompt, max_tokens, temperature, top_p, top_k, seed)
+
+    async def generate_stream(self, prompt: str, **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        """Batched generation finishes all at once, so the stream is one text event and the usage"""
+        result = await self.generate_response(prompt, **kwargs)
+        yield {"text": result["text"]}
+        yield {"usage": result["usage"]}
+
+    async def generate(self, prompt: str, **kwargs) -> str:
+        response = await self.generate_response(prompt, **kwargs)
+        return response["text"]
+
+    @staticmethod
+    def _format_chat(messages: List[dict]) -> str:
+        prompt = ""
+        for msg in messages:
+            role = msg["role"].capitalize()
+            if role in ("System", "User", "Assistant"):
+                prompt += f"{role}: {msg['content']}\n"
+        return prompt + "Assistant: "
+
+    async def chat(
+        self,
+        messages: List[dict],
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        top_k: Optional[int] = None,
+        repeat_penalty: Optional[float] = None,
+    ) -> str:
+        with span("format"):
+            prompt = self._format_chat(messages)
+        result = await self._submit(prompt, max_tokens, temperature, top_p, top_k, None)
+        # Match the llama.cpp backend, which stops at the end of the assistant's line
+        return result["text"].split("\n")[0].strip()
+
+    async def chat_session(self, session: ChatSession, content: str, **kwargs) -> str:
+        async with session.lock:
+            turn = session.append("user", content)
+            replied = False
+            try:
+                text = await self.chat(session.messages(), **kwargs)
+                session.append("assistant", text)
+                replied = True
+                return text
+            finally:
+                # Also covers cancellation, which is not an Exception
+                if not replied:
+                    session.turns.remove(turn)
+
+    async def warm_template(self, template: PromptTemplate):
+        """Prefix snapshots are a llama.cpp feature; nothing to precompute here"""
+        await self.ensure_initialized()
@@ -0,0 +1,150 @@
+"""
+KV cache element types and per-sequence KV accounting for the llama.cpp backend
+"""
+import ctypes
+import inspect
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Tuple
+import numpy as np
+import llama_cpp
+import llama_cpp.llama as llama_module
+from llama_cpp import Llama
+from app.models.memory import kv_bytes_per_token
+
+logger = logging.getLogger(__name__)
+
+# ggml_type ids and their storage cost per element (quantized types pack 32 values per block)
+KV_TYPES: Dict[str, Tuple[int, float]] = {
+    "f32": (0, 4.0),
+    "f16": (1, 2.0),
+    "q4_0": (2, 18 / 32),
+    "q4_1": (3, 20 / 32),
+    "q5_0": (6, 22 / 32),
+    "q5_1": (7, 24 / 32),
+    "q8_0": (8, 34 / 32),
+}
+QUANT_BLOCK_SIZE = 32
+
+_patch_lock = threading.Lock()
+
+
+def kv_type_id(name: str) -> int:
+    if name not in KV_TYPES:
+        raise ValueError(f"Unknown KV cache type {name!r}, expected one of {', '.join(KV_TYPES)}")
+    return KV_TYPES[name][0]
+
+
+def bytes_per_element(name: str) -> float:
+    return KV_TYPES[name][1]
+
+
+def model_kv_bytes_per_token(llm: Llama, type_k: str = "f16", type_v: str = "f16") -> int:
+    """KV bytes one token takes in this model's cache, from its GGUF shapes"""
+    metadata = getattr(llm, "metadata", None) or {}
+    arch = metadata.get("general.architecture", "llama")
+    # LLaMA 2 7B shapes when the GGUF metadata is unavailable
+    n_layer = int(metadata.get(f"{arch}.block_count", 32))
+    n_embd = int(metadata.get(f"{arch}.embedding_length", 4096))
+    n_head = int(metadata.get(f"{arch}.attention.head_count", 32))
+    n_head_kv = int(metadata.get(f"{arch}.attention.head_count_kv", n_head))
+    return kv_bytes_per_token(n_layer, n_embd, n_head, n_head_kv, bytes_per_element(type_k), bytes_per_element(type_v))
+
+
+def flash_attn_supported() -> bool:
+    """Whether this llama.cpp build has a flash-attention switch at all"""
+    return any(field[0] == "flash_attn" for field in llama_cpp.llama_context_params._fields_)
+
+
+def resolve_kv_types(type_k: str, type_v: str, flash_attn: bool, head_dim: Optional[int]) -> Dict[str, Any]:
+    """Types the context can actually run with, falling back to f16 instead of tripping a GGML_ASSERT"""
+    kv_type_id(type_k)
+    kv_type_id(type_v)
+    notes = []
+    flash_attn = flash_attn and flash_attn_supported()
+    unquantized = {"f32", "f16"}
+    if head_dim is not None and head_dim % QUANT_BLOCK_SIZE:
+        for which in ("K", "V"):
+            name = type_k if which == "K" else type_v
+            if name not in unquantized:
+                notes.append(f"{which} cache {name} needs a head size divisible by {QUANT_BLOCK_SIZE}, model has {head_dim}; using f16")
+        type_k = type_k if type_k in unquantized else "f16"
+        type_v = type_v if type_v in unquantized else "f16"
+    if type_v not in unquantized and not flash_attn:
+        # The non-flash attention path multiplies by a transposed V view, which ggml cannot do on quantized blocks
+        notes.append(f"V cache {type_v} needs flash attention, which this build {'has disabled' if flash_attn_supported() else 'does not support'}; using f16")
+        type_v = "f16"
+    return {"type_k": type_k, "type_v": type_v, "flash_attn": flash_attn, "notes": notes}
+
+
+def _head_dim(model) -> Optional[int]:
+    metadata = model.metadata()
+    arch = metadata.get("general.architecture", "llama")
+    n_head = metadata.get(f"{arch}.attention.head_count")
+    key_length = metadata.get(f"{arch}.attention.key_length")
+    if key_length:
+        return int(key_length)
+    return model.n_embd() // int(n_head) if n_head else None
+
+
+@contextmanager
+def _context_params_hook(type_k: str, type_v: str, flash_attn: bool, resolved: Dict[str, Any]):
+    """Set KV fields on the context params of a Llama built inside the block
+
+    llama-cpp-python builds without type_k/type_v arguments still pass a
+    llama_context_params struct to the context; wrapping the context class
+    lets the model's head size be checked before llama.cpp asserts on it.
+    """
+    original = llama_module._LlamaContext
+
+    def create_context(*, model, params, verbose=True):
+        resolved.update(resolve_kv_types(type_k, type_v, flash_attn, _head_dim(model)))
+        params.type_k = kv_type_id(resolved["type_k"])
+        params.type_v = kv_type_id(resolved["type_v"])
+        if resolved["flash_attn"]:
+            params.flash_attn = True
+        return original(model=model, params=params, verbose=verbose)
+
+    with _patch_lock:
+        llama_module._LlamaContext = create_context
+        try:
+            yield
+        finally:
+            llama_module._LlamaContext = original
+
+
+def load_llama(type_k: str = "f16", type_v: str = "f16", flash_attn: bool = False, **kwargs) -> Tuple[Llama, Dict[str, Any]]:
+    """A Llama with the requested KV cache types, and the types it actually got"""
+    resolved: Dict[str, Any] = {}
+    if "type_k" in inspect.signature(Llama.__init__).parameters:
+        # Newer llama-cpp-python takes the types directly; the model is not loaded yet, so head size is unknown
+        resolved.update(resolve_kv_types(type_k, type_v, flash_attn, None))
+        extra = {"type_k": kv_type_id(resolved["type_k"]), "type_v": kv_type_id(resolved["type_v"])}
+        if "flash_attn" in inspect.signature(Llama.__init__).parameters:
+            extra["flash_attn"] = resolved["flash_attn"]
+        llm = Llama(**kwargs, **extra)
+    else:
+        with _context_params_hook(type_k, type_v, flash_attn, resolved):
+            llm = Llama(**kwargs)
+    for note in resolved["notes"]:
+        logger.warning(note)
+    return llm, resolved
+
+
+def kv_cache_usage(llm: Llama, n_max_seq: int = 8) -> Dict[str, Any]:
+    """Occupied KV cells in total and per sequence id; call with the model's generation lock held"""
+    ctx = llm._ctx.ctx
+    view = llama_cpp.llama_kv_cache_view_init(ctx, n_max_seq)
+    try:
+        llama_cpp.llama_kv_cache_view_update(ctx, ctypes.byref(view))
+        n_cells = view.n_cells
+        sequences: Dict[int, int] = {}
+        if n_cells and view.used_cells:
+            seq_ids = np.ctypeslib.as_array(view.cells_sequences, shape=(n_cells * view.n_max_seq,))
+            seq_ids = seq_ids.reshape(n_cells, view.n_max_seq)
+            ids, counts = np.unique(seq_ids[seq_ids >= 0], return_counts=True)
+            sequences = {int(seq): int(count) for seq, count in zip(ids, counts)}
+        return {"n_cells": n_cells, "used_cells": int(view.used_cells), "sequences": sequences}
+    finally:
+        llama_cpp.llama_kv_cache_view_free(ctypes.byref(view))
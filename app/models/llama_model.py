@@ -2,21 +2,66 @@ import os
 import requests
 import asyncio
 import gc
-from typing import List, Optional, Dict, Any
-from llama_cpp import Llama
+import threading
+import time
+from contextlib import nullcontext
+from typing import AsyncIterator, Callable, List, Optional, Dict, Any, Tuple
+import llama_cpp
+from llama_cpp import Llama, StoppingCriteriaList
 from app.config import get_settings
+from app.models.adapters import LoraAdapter, adapter_queue, hot_swap_supported, lora_runtime
+from app.models.autotune import resolve_runtime_params
+from app.models.context_shift import RollingCompletion, context_shift_stats
+from app.models.downloader import provision_model
+from app.models.grammars import JsonCloseTracker, ResponseGrammar, grammar_cache
+from app.models.kv_cache import kv_cache_usage, load_llama, model_kv_bytes_per_token
+from app.models.scheduler import ScheduledSequence, decode_scheduler, stream_latency
+from app.models.scoring import continuation_tokens, score_continuations
+from app.models.sessions import ChatSession
+from app.models.templates import PromptTemplate, TemplateTooLongError, template_registry
+from app.placement import cpu_placement
+from app.tracing import current_trace, record_span, span
 import logging
 
 logger = logging.getLogger(__name__)
 
+def _reset_llama_timings(model: Llama):
+    try:
+        llama_cpp.llama_reset_timings(model._ctx.ctx)
+    except Exception:
+        pass
+
+def _read_llama_timings(model: Llama) -> Optional[Dict[str, float]]:
+    """llama.cpp's own prompt-eval and eval counters since the last reset"""
+    try:
+        timings = llama_cpp.llama_get_timings(model._ctx.ctx)
+    except Exception:
+        return None
+    n_p_eval = max(int(timings.n_p_eval), 1)
+    n_eval = max(int(timings.n_eval), 1)
+    return {
+        "prompt_eval_ms": timings.t_p_eval_ms,
+        "prompt_eval_tokens": int(timings.n_p_eval),
+        "prompt_eval_ms_per_token": timings.t_p_eval_ms / n_p_eval,
+        "eval_ms": timings.t_eval_ms,
+        "eval_tokens": int(timings.n_eval),
+        "eval_ms_per_token": timings.t_eval_ms / n_eval,
+        "sample_ms": timings.t_sample_ms,
+    }
+
 class LlamaModel:
     _instance = None
     _model = None
     _initialized = False
     _initializing = False
     _init_lock = asyncio.Lock()
+    # llama.cpp contexts are not thread-safe; one call (and any state restore) at a time
+    _generation_lock = threading.Lock()
     _last_error = None
     _initialization_attempts = 0
+    _runtime_params: Optional[Dict[str, Any]] = None
+    _kv_config: Optional[Dict[str, Any]] = None
+    _kv_usage: Optional[Dict[str, Any]] = None
     MAX_RETRIES = 3
     
     def __new__(cls):
@@ -64,30 +109,73 @@ class LlamaModel:
                         os.makedirs(model_dir, exist_ok=True)
                         logger.info(f"Created model directory: {model_dir}")
                     
-                    raise FileNotFoundError(f"Model file not found at {settings.MODEL_PATH}")
+                    if not settings.MODEL_AUTO_DOWNLOAD:
+                        raise FileNotFoundError(f"Model file not found at {settings.MODEL_PATH}")
+                    
+                    # Fetch the model off the event loop; partial downloads resume on retry
+                    logger.info(f"Model file missing, downloading from {settings.MODEL_URL}")
+                    await asyncio.get_event_loop().run_in_executor(None, provision_model)
                 
                 # Log file size and permissions
                 file_stat = os.stat(settings.MODEL_PATH)
                 logger.info(f"Model file size: {file_stat.st_size} bytes")
                 logger.info(f"Model file permissions: {oct(file_stat.st_mode)}")
                 
-                # Initialize model with conservative settings
-                cls._model = Llama(
-                    model_path=settings.MODEL_PATH,
-                    n_ctx=settings.CONTEXT_LENGTH,
-                    n_gpu_layers=0,  # Force CPU only
-                    n_threads=settings.THREADS,
-                    verbose=True
+                # Thread and batch settings from config, the cached tuning profile or a benchmark
+                if cls._runtime_params is None:
+                    cls._runtime_params = await asyncio.get_event_loop().run_in_executor(
+                        None, resolve_runtime_params, settings
+                    )
+                params = cls._runtime_params
+                n_threads = cpu_placement.thread_limit(params["n_threads"])
+                n_threads_batch = cpu_placement.thread_limit(params["n_threads_batch"])
+                logger.info(
+                    f"Runtime params ({params['source']}): threads={params['n_threads']} "
+                    f"threads_batch={params['n_threads_batch']} batch={params['n_batch']}"
                 )
                 
-                # Test the model with a simple prompt
-                test_response = cls._model.create_completion(
-                    prompt="Test.",
-                    max_tokens=5,
-                    temperature=0.7,
-                    stop=["User:", "\n"],
-                    echo=False
-                )
+                # Merging a LoRA adapter writes into the weights, which a read-only mapping does not allow
+                use_mmap = settings.USE_MMAP
+                if settings.LORA_ENABLED and use_mmap and not hot_swap_supported():
+                    logger.info("LoRA adapters are merged into the weights on this llama.cpp build; loading without mmap")
+                    use_mmap = False
+                
+                # Loading and the test completion take seconds; on a worker thread the loop keeps
+                # answering /health/ready, drain and diagnostics, and the inference pin lands on
+                # that thread rather than on the loop's
+                def load_and_test():
+                    # Initialize model with conservative settings and the configured KV cache types
+                    cls._model, cls._kv_config = load_llama(
+                        type_k=settings.KV_CACHE_TYPE_K,
+                        type_v=settings.KV_CACHE_TYPE_V,
+                        flash_attn=settings.FLASH_ATTENTION,
+                        model_path=settings.MODEL_PATH,
+                        n_ctx=settings.CONTEXT_LENGTH,
+                        n_gpu_layers=0,  # Force CPU only
+                        n_threads=n_threads,
+                        n_threads_batch=n_threads_batch,
+                        n_batch=params["n_batch"],
+                        use_mmap=use_mmap,
+                        use_mlock=settings.USE_MLOCK,
+                        verbose=True
+                    )
+                    logger.info(
+                        f"KV cache: K={cls._kv_config['type_k']} V={cls._kv_config['type_v']} "
+                        f"flash_attn={cls._kv_config['flash_attn']}"
+                    )
+                
+                    # Test the model with a simple prompt
+                    with cpu_placement.inference():
+                        test_response = cls._model.create_completion(
+                            prompt="Test.",
+                            max_tokens=5,
+                            temperature=0.7,
+                            stop=["User:", "\n"],
+                            echo=False
+                        )
+                    return test_response
+                
+                test_response = await asyncio.get_event_loop().run_in_executor(None, load_and_test)
                 
                 if not test_response or "choices" not in test_response:
                     raise RuntimeError("Model initialization test failed")
@@ -130,6 +218,248 @@ class LlamaModel:
             cls._initialized = False
             await cls.initialize()
 
+    async def _run_generation(
+        self,
+        fn: Callable[[], Any],
+        adapter: Optional[LoraAdapter] = None
+    ) -> Tuple[Any, Optional[Dict[str, float]]]:
+        """Run a llama.cpp call in the executor with `adapter` (or the base weights), recording queue, prompt eval and decode spans"""
+        settings = get_settings()
+        submitted = time.perf_counter()
+        
+        # Scheduled sequences stop being admitted while a call waits for the whole context
+        exclusive = decode_scheduler.exclusive() if decode_scheduler.enabled() else nullcontext()
+        
+        def run():
+            with exclusive, self._generation_lock, cpu_placement.inference():
+                switch_ms = lora_runtime.activate(self._model, adapter) if settings.LORA_ENABLED else None
+                started = time.perf_counter()
+                _reset_llama_timings(self._model)
+                result = fn()
+                finished = time.perf_counter()
+                # The view walks cells llama_decode mutates, so it is only read while the lock is held
+                LlamaModel._kv_usage = {**kv_cache_usage(self._model), "measured_at": time.time()}
+                return switch_ms, started, finished, result, _read_llama_timings(self._model)
+        
+        # With adapters in use, requests for the applied adapter go first to save switches
+        queue = adapter_queue.slot(adapter.name if adapter else None) if settings.LORA_ENABLED else nullcontext()
+        async with queue:
+            switch_ms, started, finished, result, timings = await asyncio.get_event_loop().run_in_executor(None, run)
+        if switch_ms is not None:
+            record_span("adapter_switch", switch_ms)
+            started -= switch_ms / 1000
+        record_span("queue", (started - submitted) * 1000)
+        if timings:
+            record_span("prompt_eval", timings["prompt_eval_ms"])
+            record_span("decode", timings["eval_ms"])
+        else:
+            record_span("generate", (finished - started) * 1000)
+        return result, timings
+
+    @staticmethod
+    def _usage_timings(timings: Optional[Dict[str, float]]) -> Dict[str, float]:
+        """Request span totals plus llama.cpp internals for the usage block"""
+        trace = current_trace()
+        result = {f"{name}_ms": round(ms, 2) for name, ms in trace.totals().items()} if trace else {}
+        if timings:
+            result.update({name: round(value, 3) for name, value in timings.items()})
+        return result
+
+    @staticmethod
+    def _format_message(role: str, content: str) -> str:
+        if role == "system":
+            return f"System: {content}\n"
+        elif role == "user":
+            return f"User: {content}\n"
+        elif role == "assistant":
+            return f"Assistant: {content}\n"
+        return ""
+
+    def memory_profile(self) -> Dict[str, Any]:
+        """Resident bytes of the loaded model; llama.cpp allocates the whole KV cache up front"""
+        settings = get_settings()
+        kv_config = self._kv_config or {"type_k": "f16", "type_v": "f16"}
+        per_token = model_kv_bytes_per_token(self._model, kv_config["type_k"], kv_config["type_v"])
+        n_ctx = self._model.n_ctx()
+        return {
+            "weights_bytes": os.path.getsize(settings.MODEL_PATH),
+            "kv_cache_bytes": per_token * n_ctx,
+            # llama-cpp-python keeps an n_ctx x n_vocab float32 score matrix
+            "logits_bytes": n_ctx * self._model.n_vocab() * 4,
+            "kv_bytes_per_token": per_token,
+            "kv_per_request": False,
+        }
+
+    def kv_usage(self) -> Dict[str, Any]:
+        """KV cache types and the cells and bytes each sequence held after the last call"""
+        per_token = self.memory_profile()["kv_bytes_per_token"]
+        # Whichever of the last exclusive call and the last scheduled sequence was measured more recently
+        measured = [usage for usage in (self._kv_usage, decode_scheduler.kv_usage) if usage is not None]
+        usage = max(measured, key=lambda usage: usage["measured_at"]) if measured else {
+            "n_cells": self._model.n_ctx(), "used_cells": 0, "sequences": {}, "measured_at": None
+        }
+        return {
+            **(self._kv_config or {}),
+            "kv_bytes_per_token": per_token,
+            "capacity_bytes": usage["n_cells"] * per_token,
+            "used_cells": usage["used_cells"],
+            "used_bytes": usage["used_cells"] * per_token,
+            # Cells shared between sequences (a branched prompt) count once per sequence here
+            "sequences": [
+                {"seq_id": seq_id, "cells": cells, "bytes": cells * per_token}
+                for seq_id, cells in sorted(usage["sequences"].items())
+            ],
+            "measured_at": usage["measured_at"],
+            "context_shift": {"enabled": get_settings().CONTEXT_SHIFT, **context_shift_stats.stats()},
+        }
+
+    def adapter_stats(self) -> Dict[str, Any]:
+        """Applied and resident LoRA adapters, load and switch times, and queue regrouping"""
+        return {
+            "enabled": get_settings().LORA_ENABLED,
+            **lora_runtime.stats(),
+            "queue": adapter_queue.stats(),
+        }
+
+    def scheduler_stats(self) -> Dict[str, Any]:
+        """Step scheduler counters with time-to-first-token and inter-token latency percentiles"""
+        return decode_scheduler.stats()
+
+    async def compile_grammar(
+        self,
+        kind: str,
+        schema: Optional[Dict[str, Any]] = None,
+        grammar: Optional[str] = None
+    ) -> ResponseGrammar:
+        """The cached grammar for a response_format, compiled off the event loop on first use"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, grammar_cache.resolve, kind, schema, grammar)
+
+    def grammar_stats(self) -> Dict[str, Any]:
+        """Compiled grammar cache hits and misses, and tokens saved by stopping at the JSON close"""
+        return grammar_cache.stats()
+
+    def _tokenize(self, text: str, add_bos: bool = False) -> List[int]:
+        return self._model.tokenize(text.encode("utf-8"), add_bos=add_bos)
+
+    def _rolling_completion(
+        self,
+        prompt_tokens: List[int],
+        n_keep: int,
+        sampling: Dict[str, Any],
+        repeat_penalty: float = 1.1
+    ) -> Optional[RollingCompletion]:
+        """A completion that shifts the context when this one would not fit, keeping the first `n_keep` tokens"""
+        if "grammar" in sampling:
+            # A constrained value cut off by a shift would no longer parse, so it stops at the context end
+            return None
+        if len(prompt_tokens) + sampling["max_tokens"] < self._model.n_ctx():
+            return None
+        return RollingCompletion(
+            self._model,
+            prompt_tokens,
+            n_keep,
+            sampling["max_tokens"],
+            sampling["temperature"],
+            sampling["top_p"],
+            sampling["top_k"],
+            repeat_penalty,
+            sampling["stop"],
+            sampling.get("seed"),
+            get_settings().CONTEXT_SHIFT_DISCARD
+        )
+
+    def _run_rolling(self, completion: RollingCompletion) -> Dict[str, Any]:
+        """Run a rolling completion to the end, shaped like a create_completion result"""
+        text = "".join(completion)
+        context_shift_stats.record(completion)
+        return {
+            "choices": [{"text": text, "finish_reason": completion.finish_reason}],
+            "usage": {
+                "prompt_tokens": completion.prompt_tokens,
+                "completion_tokens": completion.completion_tokens,
+                "total_tokens": completion.prompt_tokens + completion.completion_tokens,
+            },
+            "context_shifts": completion.shifts,
+        }
+
+    def _session_prompt(self, session: ChatSession, max_tokens: int) -> List[int]:
+        """Assemble cached turn tokens, dropping the oldest non-system turns to fit the context"""
+        settings = get_settings()
+        prefix = self._tokenize("", add_bos=True)
+        suffix = self._tokenize("Assistant: ")
+        budget = settings.CONTEXT_LENGTH - max_tokens - len(prefix) - len(suffix)
+        
+        system = [turn for turn in session.turns if turn.role == "system"]
+        history = [turn for turn in session.turns if turn.role != "system"]
+        used = sum(len(turn.tokens) for turn in system)
+        kept = []
+        for turn in reversed(history):
+            if used + len(turn.tokens) > budget and kept:
+                break
+            kept.append(turn)
+            used += len(turn.tokens)
+        
+        tokens = list(prefix)
+        for turn in system + kept[::-1]:
+            tokens.extend(turn.tokens)
+        tokens.extend(suffix)
+        return tokens
+
+    async def chat_session(
+        self,
+        session: ChatSession,
+        content: str,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        top_k: Optional[int] = None,
+        repeat_penalty: Optional[float] = None,
+    ) -> str:
+        """Continue a stored conversation, tokenizing only the new messages"""
+        await self.ensure_initialized()
+        settings = get_settings()
+        max_tokens = max_tokens or settings.MAX_TOKENS
+        
+        async with session.lock:
+            with span("format"):
+                # Turns restored from SQLite have no tokens yet
+                for turn in session.turns:
+                    if turn.tokens is None:
+                        turn.tokens = self._tokenize(self._format_message(turn.role, turn.content))
+                turn = session.append("user", content, self._tokenize(self._format_message("user", content)))
+                prompt_tokens = self._session_prompt(session, max_tokens)
+            
+            def generate():
+                return self._model.create_completion(
+                    prompt=prompt_tokens,
+                    max_tokens=max_tokens,
+                    temperature=temperature or settings.TEMPERATURE,
+                    top_p=top_p or settings.TOP_P,
+                    top_k=top_k or settings.TOP_K,
+                    repeat_penalty=repeat_penalty or settings.REPEAT_PENALTY,
+                    stop=["User:", "System:", "\n"],
+                    echo=False
+                )
+            
+            replied = False
+            try:
+                response, _ = await asyncio.wait_for(self._run_generation(generate), timeout=30.0)
+                if not response or "choices" not in response:
+                    raise RuntimeError("Model returned invalid response")
+                text = response["choices"][0]["text"].strip()
+                session.append("assistant", text, self._tokenize(self._format_message("assistant", text)))
+                replied = True
+                return text
+            except asyncio.TimeoutError:
+                logger.error("Model generation timed out")
+                raise RuntimeError("Response generation timed out")
+            finally:
+                # Leave the transcript as it was so the client can retry the turn, also when
+                # the request is cancelled (client gone, /chat timeout), which is not an Exception
+                if not replied:
+                    session.turns.remove(turn)
+
     async def chat(
         self,
         messages: List[dict],
@@ -151,20 +481,31 @@ class LlamaModel:
         
         try:
             # Format messages into a prompt
-            prompt = ""
-            for msg in messages:
-                role = msg["role"]
-                content = msg["content"]
-                if role == "system":
-                    prompt += f"System: {content}\n"
-                elif role == "user":
-                    prompt += f"User: {content}\n"
-                elif role == "assistant":
-                    prompt += f"Assistant: {content}\n"
-            prompt += "Assistant: "
+            with span("format"):
+                prompt = "".join(self._format_message(msg["role"], msg["content"]) for msg in messages)
+                prompt += "Assistant: "
             
             # Generate response with timeout protection
-            async def generate():
+            def generate():
+                if settings.CONTEXT_SHIFT:
+                    prompt_tokens = self._tokenize(prompt, add_bos=True)
+                    # System messages survive shifts; the oldest turns after them are discarded first
+                    system = self._tokenize("".join(
+                        self._format_message(msg["role"], msg["content"]) for msg in messages if msg["role"] == "system"
+                    ), add_bos=True)
+                    n_keep = 0
+                    for system_token, token in zip(system, prompt_tokens):
+                        if system_token != token:
+                            break
+                        n_keep += 1
+                    rolling = self._rolling_completion(
+                        prompt_tokens,
+                        n_keep,
+                        dict(max_tokens=max_tokens, temperature=temperature, top_p=top_p, top_k=top_k, stop=["User:", "System:", "\n"]),
+                        repeat_penalty
+                    )
+                    if rolling is not None:
+                        return self._run_rolling(rolling)
                 return self._model.create_completion(
                     prompt=prompt,
                     max_tokens=max_tokens,
@@ -177,8 +518,8 @@ class LlamaModel:
                 )
             
             try:
-                response = await asyncio.wait_for(
-                    asyncio.get_event_loop().run_in_executor(None, lambda: generate()),
+                response, _ = await asyncio.wait_for(
+                    self._run_generation(generate),
                     timeout=30.0  # 30 second timeout
                 )
                 
@@ -193,53 +534,334 @@ class LlamaModel:
                 
         except Exception as e:
             logger.error(f"Error during chat generation: {e}", exc_info=True)
-            # If we get a critical error, mark as uninitialized to force reinitialization
-            if "access violation" in str(e).lower() or "segmentation fault" in str(e).lower():
-                self._initialized = False
-                self._model = None
-                gc.collect()
             raise
 
+    def _template_prefix_tokens(self, template: PromptTemplate) -> List[int]:
+        if template.prefix_tokens is None:
+            template.prefix_tokens = self._tokenize(f"[INST] {template.prefix}", add_bos=True)
+        return template.prefix_tokens
+
+    async def warm_template(self, template: PromptTemplate):
+        """Evaluate (or load from disk) a template's prefix snapshot ahead of the first request"""
+        await self.ensure_initialized()
+        settings = get_settings()
+        
+        def warm():
+            n_ctx = self._model.n_ctx()
+            if len(self._template_prefix_tokens(template)) >= n_ctx:
+                raise TemplateTooLongError(
+                    f"Template prefix is {len(template.prefix_tokens)} tokens, the context holds {n_ctx}"
+                )
+            template_registry.restore(self._model, template, settings.MODEL_PATH)
+        
+        await self._run_generation(warm)
+
+    def _format_instruction(self, prompt: str, template: Optional[PromptTemplate]):
+        """LLaMA 2 Chat prompt, as token ids when the prompt has a template prefix"""
+        with span("format"):
+            if template is not None:
+                # Only the variable part is tokenized here; the prefix tokens are cached on the template
+                prefix_tokens = self._template_prefix_tokens(template)
+                return prefix_tokens + self._tokenize(f"{prompt} [/INST]")
+            return f"[INST] {prompt} [/INST]"
+
+    @staticmethod
+    def _sampling_kwargs(
+        max_tokens: Optional[int],
+        temperature: Optional[float],
+        top_p: Optional[float],
+        top_k: Optional[int],
+        seed: Optional[int]
+    ) -> Dict[str, Any]:
+        settings = get_settings()
+        kwargs = {
+            "max_tokens": max_tokens or settings.MAX_TOKENS,
+            # 0 is a meaningful temperature (greedy decoding), so only None falls back
+            "temperature": temperature if temperature is not None else settings.TEMPERATURE,
+            "top_p": top_p or settings.TOP_P,
+            "top_k": top_k or settings.TOP_K,
+            "echo": False,
+            "stop": ["[INST]", "</s>"],
+        }
+        if seed is not None:
+            kwargs["seed"] = seed
+        return kwargs
+
+    def _constrain(self, sampling: Dict[str, Any], grammar: Optional[ResponseGrammar]) -> Optional[JsonCloseTracker]:
+        """Add `grammar` to the sampling kwargs; JSON output also stops once its top-level value closes"""
+        if grammar is None:
+            return None
+        sampling["grammar"] = grammar.compiled.instance()
+        if not grammar.compiled.json_output:
+            return None
+        json_close = JsonCloseTracker(self._model)
+        sampling["stopping_criteria"] = StoppingCriteriaList([json_close])
+        return json_close
+
+    def _grammar_usage(
+        self,
+        grammar: ResponseGrammar,
+        json_close: Optional[JsonCloseTracker],
+        sampling: Dict[str, Any],
+        prompt_tokens: int,
+        completion_tokens: int
+    ) -> Dict[str, Any]:
+        # Saved tokens are the budget left when the value closed, which the grammar would have let whitespace fill
+        budget = min(sampling["max_tokens"], self._model.n_ctx() - prompt_tokens)
+        closed = json_close is not None and json_close.closed
+        return grammar_cache.record(grammar, closed, budget, completion_tokens)
+
+    def _schedulable(self, prompt_tokens: List[int], sampling: Dict[str, Any], adapter: Optional[LoraAdapter]) -> bool:
+        """Whether a generation can run as a scheduled sequence next to others"""
+        settings = get_settings()
+        if not decode_scheduler.enabled() or adapter is not None:
+            return False
+        # A rolling completion shifts the whole cache, so it needs the context to itself
+        return not (settings.CONTEXT_SHIFT and len(prompt_tokens) + sampling["max_tokens"] >= self._model.n_ctx())
+
+    async def _generate_scheduled(
+        self,
+        prompt_tokens: List[int],
+        sampling: Dict[str, Any],
+        template: Optional[PromptTemplate],
+        grammar: Optional[ResponseGrammar] = None,
+        json_close: Optional[JsonCloseTracker] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Generate as a scheduler sequence, yielding {"text": chunk} events and then one {"usage": ...} event"""
+        settings = get_settings()
+        
+        def prepare():
+            # Only runs while no other sequence is active, so the context can be rewritten
+            if settings.LORA_ENABLED:
+                lora_runtime.activate(self._model, None)
+            if template is not None:
+                template_registry.restore(self._model, template, settings.MODEL_PATH)
+        
+        sequence = ScheduledSequence(
+            prompt_tokens,
+            sampling["max_tokens"],
+            sampling["temperature"],
+            sampling["top_p"],
+            sampling["top_k"],
+            stop=sampling["stop"],
+            seed=sampling.get("seed"),
+            prepare=prepare,
+            grammar=sampling.get("grammar"),
+            json_close=json_close
+        )
+        decode_scheduler.submit(self._model, self._generation_lock, sequence)
+        try:
+            while True:
+                text = await sequence.queue.get()
+                if text is None:
+                    break
+                yield {"text": text}
+        finally:
+            # A client that stops reading should not keep its sequence running
+            sequence.cancelled.set()
+        if sequence.error is not None:
+            raise sequence.error
+        
+        record_span("queue", (sequence.admitted - sequence.submitted) * 1000)
+        first_token = sequence.first_token or sequence.finished
+        record_span("prompt_eval", (first_token - sequence.admitted) * 1000)
+        record_span("decode", (sequence.finished - first_token) * 1000)
+        completion_tokens = len(sequence.generated)
+        usage = {
+            "prompt_tokens": len(prompt_tokens),
+            "completion_tokens": completion_tokens,
+            "total_tokens": len(prompt_tokens) + completion_tokens,
+            "context_shifts": 0,
+            "shared_prefix_tokens": sequence.shared_tokens,
+            "timings": self._usage_timings(None)
+        }
+        if grammar is not None:
+            usage["grammar"] = self._grammar_usage(grammar, json_close, sampling, len(prompt_tokens), completion_tokens)
+        yield {"usage": usage}
+
     async def generate_response(
         self,
         prompt: str,
         max_tokens: Optional[int] = None,
         temperature: Optional[float] = None,
         top_p: Optional[float] = None,
-        top_k: Optional[int] = None
+        top_k: Optional[int] = None,
+        template: Optional[PromptTemplate] = None,
+        seed: Optional[int] = None,
+        adapter: Optional[LoraAdapter] = None,
+        grammar: Optional[ResponseGrammar] = None
     ) -> Dict[str, Any]:
         await self.ensure_initialized()
         settings = get_settings()
         
         # Format prompt for LLaMA 2 Chat
-        formatted_prompt = f"[INST] {prompt} [/INST]"
+        formatted_prompt = self._format_instruction(prompt, template)
+        sampling = self._sampling_kwargs(max_tokens, temperature, top_p, top_k, seed)
+        json_close = self._constrain(sampling, grammar)
+        
+        if decode_scheduler.enabled() and adapter is None:
+            prompt_tokens = formatted_prompt if template is not None else self._tokenize(formatted_prompt, add_bos=True)
+            if self._schedulable(prompt_tokens, sampling, adapter):
+                parts = []
+                async for event in self._generate_scheduled(prompt_tokens, sampling, template, grammar, json_close):
+                    if "text" in event:
+                        parts.append(event["text"])
+                    else:
+                        usage = event["usage"]
+                return {"text": "".join(parts).strip(), "usage": usage}
         
         # Generate response in a non-blocking way
         def generate():
-            return self._model(
-                formatted_prompt,
-                max_tokens=max_tokens or settings.MAX_TOKENS,
-                temperature=temperature or settings.TEMPERATURE,
-                top_p=top_p or settings.TOP_P,
-                top_k=top_k or settings.TOP_K,
-                echo=False,
-                stop=["[INST]", "</s>"]
-            )
+            if template is not None and adapter is None:
+                # The completion call skips the prefix it finds already evaluated
+                template_registry.restore(self._model, template, settings.MODEL_PATH)
+            if settings.CONTEXT_SHIFT:
+                prompt_tokens = formatted_prompt if template is not None else self._tokenize(formatted_prompt, add_bos=True)
+                # A single instruction has no history, so the whole prompt is kept and the oldest output rolls off
+                rolling = self._rolling_completion(prompt_tokens, len(prompt_tokens), sampling)
+                if rolling is not None:
+                    return self._run_rolling(rolling)
+            return self._model(formatted_prompt, **sampling)
         
-        response = await asyncio.get_event_loop().run_in_executor(None, generate)
+        response, timings = await self._run_generation(generate, adapter)
         
         # Extract completion text
         completion_text = response["choices"][0]["text"].strip()
         
+        usage = {
+            "prompt_tokens": response["usage"]["prompt_tokens"],
+            "completion_tokens": response["usage"]["completion_tokens"],
+            "total_tokens": response["usage"]["total_tokens"],
+            "context_shifts": response.get("context_shifts", 0),
+            "timings": self._usage_timings(timings)
+        }
+        if grammar is not None:
+            usage["grammar"] = self._grammar_usage(
+                grammar, json_close, sampling, usage["prompt_tokens"], usage["completion_tokens"]
+            )
+        return {"text": completion_text, "usage": usage}
+
+    async def score(self, prompt: str, candidates: List[str]) -> Dict[str, Any]:
+        """Log-probability of each candidate continuing `prompt`, evaluating the prompt once"""
+        await self.ensure_initialized()
+        
+        with span("format"):
+            prompt_tokens = self._tokenize(prompt, add_bos=True)
+            continuations = [continuation_tokens(self._model, prompt, prompt_tokens, c) for c in candidates]
+        
+        logprobs, timings = await self._run_generation(
+            lambda: score_continuations(self._model, prompt_tokens, continuations)
+        )
+        
+        results = []
+        for text, tokens, token_logprobs in zip(candidates, continuations, logprobs):
+            results.append({
+                "text": text,
+                "logprob": sum(token_logprobs),
+                "tokens": [
+                    {"token": self._model.detokenize([token]).decode("utf-8", errors="replace"), "logprob": logprob}
+                    for token, logprob in zip(tokens, token_logprobs)
+                ],
+            })
+        candidate_tokens = sum(len(tokens) for tokens in continuations)
         return {
-            "text": completion_text,
+            "candidates": results,
             "usage": {
-                "prompt_tokens": response["usage"]["prompt_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "total_tokens": response["usage"]["total_tokens"]
+                "prompt_tokens": len(prompt_tokens) + candidate_tokens,
+                "completion_tokens": 0,
+                "total_tokens": len(prompt_tokens) + candidate_tokens,
+                "timings": self._usage_timings(timings)
             }
         }
 
+    async def generate_stream(
+        self,
+        prompt: str,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        top_k: Optional[int] = None,
+        template: Optional[PromptTemplate] = None,
+        seed: Optional[int] = None,
+        adapter: Optional[LoraAdapter] = None,
+        grammar: Optional[ResponseGrammar] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Yield {"text": chunk} events as tokens are decoded, then one {"usage": ...} event"""
+        await self.ensure_initialized()
+        settings = get_settings()
+        
+        formatted_prompt = self._format_instruction(prompt, template)
+        sampling = self._sampling_kwargs(max_tokens, temperature, top_p, top_k, seed)
+        json_close = self._constrain(sampling, grammar)
+        if decode_scheduler.enabled() and adapter is None:
+            prompt_tokens = formatted_prompt if template is not None else self._tokenize(formatted_prompt, add_bos=True)
+            if self._schedulable(prompt_tokens, sampling, adapter):
+                async for event in self._generate_scheduled(prompt_tokens, sampling, template, grammar, json_close):
+                    yield event
+                return
+        
+        loop = asyncio.get_event_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+        submitted = time.perf_counter()
+        
+        def generate():
+            prompt_tokens = formatted_prompt
+            if template is None:
+                prompt_tokens = self._tokenize(formatted_prompt, add_bos=True)
+            elif adapter is None:
+                # Prefix snapshots hold base-model state, so adapted requests evaluate the prefix themselves
+                template_registry.restore(self._model, template, settings.MODEL_PATH)
+            rolling = self._rolling_completion(prompt_tokens, len(prompt_tokens), sampling) if settings.CONTEXT_SHIFT else None
+            if rolling is not None:
+                pieces = iter(rolling)
+            else:
+                pieces = (chunk["choices"][0]["text"] for chunk in self._model(prompt_tokens, stream=True, **sampling))
+            chunks = 0
+            last = None
+            try:
+                for text in pieces:
+                    if cancelled.is_set():
+                        break
+                    now = time.perf_counter()
+                    if last is None:
+                        stream_latency.record_ttft((now - submitted) * 1000)
+                    else:
+                        stream_latency.record_itl((now - last) * 1000)
+                    last = now
+                    chunks += 1
+                    loop.call_soon_threadsafe(queue.put_nowait, text)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+            if rolling is not None:
+                context_shift_stats.record(rolling)
+                return len(prompt_tokens), chunks, rolling.shifts
+            return len(prompt_tokens), chunks, 0
+        
+        task = asyncio.ensure_future(self._run_generation(generate, adapter))
+        try:
+            while True:
+                text = await queue.get()
+                if text is None:
+                    break
+                yield {"text": text}
+            (prompt_tokens, chunks, shifts), timings = await task
+        finally:
+            # A client that stops reading should not keep the model busy
+            cancelled.set()
+        
+        completion_tokens = timings["eval_tokens"] if timings else chunks
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "context_shifts": shifts,
+            "timings": self._usage_timings(timings)
+        }
+        if grammar is not None:
+            usage["grammar"] = self._grammar_usage(grammar, json_close, sampling, prompt_tokens, completion_tokens)
+        yield {"usage": usage}
+
     # Simple generate method for basic usage
     async def generate(self, 
                     prompt: str, 
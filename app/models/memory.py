@@ -0,0 +1,243 @@
+"""
+Memory governor: admit requests against a budget projected from what the
+process has committed, instead of reacting to system memory after the fact
+"""
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+import psutil
+from app.config import get_settings
+from app.models.adapters import lora_runtime
+from app.models.backend import get_model
+from app.models.sessions import session_store
+from app.models.templates import template_registry
+
+logger = logging.getLogger(__name__)
+
+# cgroup v1 reports "no limit" as a page-aligned LONG_MAX
+_CGROUP_UNLIMITED = 1 << 60
+_CGROUP_LIMIT_FILES = (
+    ("cgroup v2", "/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+    ("cgroup v1", "/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes"),
+)
+
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    if not value.isdigit():
+        return None  # "max" in cgroup v2
+    return int(value)
+
+
+def cgroup_memory() -> Tuple[Optional[str], Optional[int], Optional[int]]:
+    """(source, limit, usage) of the container's memory cgroup; limit is None when unbounded"""
+    for source, limit_path, usage_path in _CGROUP_LIMIT_FILES:
+        if not os.path.exists(usage_path):
+            continue
+        limit = _read_int(limit_path)
+        if limit is not None and limit >= _CGROUP_UNLIMITED:
+            limit = None
+        return source, limit, _read_int(usage_path)
+    return None, None, None
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count before tokenizing; LLaMA vocabularies average 3-4 characters per token"""
+    return len(text) // 3 + 1
+
+
+def kv_bytes_per_token(
+    n_layer: int,
+    n_embd: int,
+    n_head: int,
+    n_head_kv: int,
+    bytes_per_element: float = 2,
+    bytes_per_element_v: Optional[float] = None
+) -> int:
+    """K and V for every layer; grouped-query attention shrinks them by n_head_kv / n_head"""
+    if bytes_per_element_v is None:
+        bytes_per_element_v = bytes_per_element
+    return int(n_layer * (n_embd * n_head_kv // n_head) * (bytes_per_element + bytes_per_element_v))
+
+
+class MemoryPressureError(RuntimeError):
+    """The request would push projected memory past the budget"""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Reservation:
+    """Memory held for one admitted request until it finishes"""
+
+    def __init__(self, governor: "MemoryGovernor", nbytes: int):
+        self._governor = governor
+        self.nbytes = nbytes
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._governor._release(self.nbytes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def __del__(self):
+        # Backstop for streams whose body was never iterated
+        self.release()
+
+
+class MemoryGovernor:
+    """Tracks committed memory (runtime, weights, KV cache, caches) plus per-request reservations"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Interpreter, libraries and app state before any model is loaded
+        self._runtime_bytes = psutil.Process().memory_info().rss
+        self._reserved = 0
+        self._active = 0
+        self._session_bytes = 0
+        self._session_bytes_at = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.shrinks = 0
+
+    def limit(self) -> Tuple[int, str]:
+        """The tightest of MEMORY_LIMIT_MB, the cgroup limit and physical RAM"""
+        settings = get_settings()
+        total = psutil.virtual_memory().total
+        limit, source = total, "system"
+        cgroup_source, cgroup_limit, _ = cgroup_memory()
+        if cgroup_limit is not None and cgroup_limit < limit:
+            limit, source = cgroup_limit, cgroup_source
+        if settings.MEMORY_LIMIT_MB > 0 and settings.MEMORY_LIMIT_MB << 20 < limit:
+            limit, source = settings.MEMORY_LIMIT_MB << 20, "MEMORY_LIMIT_MB"
+        return limit, source
+
+    def budget(self) -> int:
+        return int(self.limit()[0] * get_settings().MEMORY_HEADROOM)
+
+    @staticmethod
+    def model_profile() -> Dict[str, int]:
+        """Resident model footprint; before the model loads, assume the weights file is fully mapped"""
+        model = get_model()
+        if model._initialized:
+            return model.memory_profile()
+        settings = get_settings()
+        try:
+            weights = os.path.getsize(settings.MODEL_PATH)
+        except OSError:
+            weights = 0
+        return {"weights_bytes": weights, "kv_cache_bytes": 0, "logits_bytes": 0, "kv_bytes_per_token": 0, "kv_per_request": False}
+
+    def _sessions_footprint(self) -> int:
+        # Walking every turn is linear in stored history, so refresh at most once a second
+        now = time.monotonic()
+        if now - self._session_bytes_at > 1.0:
+            self._session_bytes = session_store.footprint()
+            self._session_bytes_at = now
+        return self._session_bytes
+
+    def committed(self) -> Dict[str, int]:
+        profile = self.model_profile()
+        return {
+            "runtime": self._runtime_bytes,
+            "model_weights": profile["weights_bytes"],
+            "kv_cache": profile["kv_cache_bytes"],
+            "logits": profile["logits_bytes"],
+            "template_snapshots": template_registry.stats()["snapshot_bytes"],
+            "lora_adapters": lora_runtime.resident_bytes,
+            "sessions": self._sessions_footprint(),
+        }
+
+    def request_cost(self, prompt_tokens: int, max_tokens: Optional[int]) -> int:
+        """Working memory of one request; per-sequence KV only where the backend allocates it per request"""
+        settings = get_settings()
+        profile = self.model_profile()
+        cost = settings.REQUEST_OVERHEAD_MB << 20
+        if profile["kv_per_request"]:
+            tokens = min(prompt_tokens + (max_tokens if max_tokens is not None else settings.MAX_TOKENS), settings.CONTEXT_LENGTH)
+            cost += tokens * profile["kv_bytes_per_token"]
+        return cost
+
+    def relieve_pressure(self, nbytes: int) -> int:
+        """Shrink regenerable caches, cheapest to rebuild first, until `nbytes` are freed"""
+        freed = template_registry.shrink(nbytes)
+        if freed < nbytes:
+            freed += lora_runtime.shrink(nbytes - freed)
+        if freed < nbytes:
+            freed += session_store.shrink(nbytes - freed)
+            self._session_bytes_at = 0.0
+        if freed:
+            self.shrinks += 1
+            logger.info(f"Memory pressure: freed {freed >> 20} MB of cached state")
+        return freed
+
+    def reserve(self, prompt_tokens: int, max_tokens: Optional[int] = None) -> Reservation:
+        """Admit a request if its projected memory fits the budget, shrinking caches if needed"""
+        settings = get_settings()
+        cost = self.request_cost(prompt_tokens, max_tokens)
+        budget = self.budget()
+        projected = sum(self.committed().values()) + self._reserved + cost
+        if projected > budget * settings.MEMORY_SHRINK_AT:
+            self.relieve_pressure(projected - int(budget * settings.MEMORY_SHRINK_AT))
+            projected = sum(self.committed().values()) + self._reserved + cost
+        with self._lock:
+            if projected > budget and self._active > 0:
+                # A lone request is always let through, otherwise nothing could ever run
+                self.rejected += 1
+                raise MemoryPressureError(
+                    f"Projected memory {projected >> 20} MB exceeds budget {budget >> 20} MB",
+                    retry_after=1.0
+                )
+            self._reserved += cost
+            self._active += 1
+            self.admitted += 1
+        return Reservation(self, cost)
+
+    def _release(self, nbytes: int):
+        with self._lock:
+            self._reserved -= nbytes
+            self._active -= 1
+
+    def breakdown(self) -> Dict:
+        limit, source = self.limit()
+        budget = self.budget()
+        committed = self.committed()
+        profile = self.model_profile()
+        cgroup_source, _, cgroup_usage = cgroup_memory()
+        projected = sum(committed.values()) + self._reserved
+        return {
+            "limit_bytes": limit,
+            "limit_source": source,
+            "budget_bytes": budget,
+            "committed_bytes": committed,
+            "reserved_bytes": self._reserved,
+            "active_requests": self._active,
+            "projected_bytes": projected,
+            "available_bytes": budget - projected,
+            "kv_bytes_per_token": profile["kv_bytes_per_token"],
+            "kv_per_request": profile["kv_per_request"],
+            "measured": {
+                "process_rss_bytes": psutil.Process().memory_info().rss,
+                "cgroup_usage_bytes": cgroup_usage,
+                "cgroup": cgroup_source,
+            },
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "shrinks": self.shrinks,
+        }
+
+
+memory_governor = MemoryGovernor()
@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+COLUMNS = (
+    "ts", "request_id", "api_key", "method", "endpoint", "status",
+    "prompt_tokens", "completion_tokens", "latency_ms",
+)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS request_log (
+    ts REAL NOT NULL,
+    request_id TEXT NOT NULL,
+    api_key TEXT,
+    method TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    latency_ms REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_request_log_ts ON request_log (ts, request_id);
+CREATE INDEX IF NOT EXISTS ix_request_log_key ON request_log (api_key, ts);
+CREATE INDEX IF NOT EXISTS ix_request_log_endpoint ON request_log (endpoint, ts);
+CREATE INDEX IF NOT EXISTS ix_request_log_status ON request_log (status, ts);
+"""
+
+# One row as written to the partition, in COLUMNS order
+LogRecord = Tuple
+
+
+def key_id(api_key: Optional[str]) -> Optional[str]:
+    """Non-reversible id of an API key, stored and filtered on instead of the key itself"""
+    if api_key is None:
+        return None
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+class LogFilter:
+    """Query constraints shared by the SQL and in-memory paths"""
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        endpoint: Optional[str] = None,
+        status: Optional[int] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        before: Optional[Tuple[float, str]] = None,
+    ):
+        self.api_key = api_key
+        self.endpoint = endpoint
+        self.status = status
+        self.since = since
+        self.until = until
+        self.before = before  # Keyset cursor: rows strictly older than (ts, request_id)
+
+    def matches(self, record: LogRecord) -> bool:
+        ts, request_id, api_key, _, endpoint, status = record[:6]
+        return (
+            (self.api_key is None or api_key == self.api_key)
+            and (self.endpoint is None or endpoint == self.endpoint)
+            and (self.status is None or status == self.status)
+            and (self.since is None or ts >= self.since)
+            and (self.until is None or ts < self.until)
+            and (self.before is None or (ts, request_id) < self.before)
+        )
+
+    def where(self) -> Tuple[str, List]:
+        clauses, params = [], []
+        for column, value in (("api_key", self.api_key), ("endpoint", self.endpoint), ("status", self.status)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if self.since is not None:
+            clauses.append("ts >= ?")
+            params.append(self.since)
+        if self.until is not None:
+            clauses.append("ts < ?")
+            params.append(self.until)
+        if self.before is not None:
+            clauses.append("(ts < ? OR (ts = ? AND request_id < ?))")
+            params.extend([self.before[0], self.before[0], self.before[1]])
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+class RequestLog:
+    """Per-process ring buffer of request records, flushed in batches to daily SQLite partitions
+
+    The request path only appends to a bounded deque, which is atomic under
+    the GIL, so recording never waits on a lock or on disk. A background task
+    moves records into one append-only SQLite file per UTC day; retention
+    deletes whole files instead of rows.
+    """
+
+    def __init__(self, capacity: Optional[int] = None):
+        self._buffer: deque = deque(maxlen=capacity or get_settings().REQUEST_LOG_BUFFER)
+        self._flush_task: Optional[asyncio.Task] = None
+        self.recorded = 0
+        self.written = 0
+
+    def record(
+        self,
+        request_id: str,
+        api_key: Optional[str],
+        method: str,
+        endpoint: str,
+        status: int,
+        prompt_tokens: Optional[int],
+        completion_tokens: Optional[int],
+        latency_ms: float,
+    ):
+        self._buffer.append((time.time(), request_id, key_id(api_key), method, endpoint, status, prompt_tokens, completion_tokens, round(latency_ms, 2)))
+        self.recorded += 1
+
+    @property
+    def dropped(self) -> int:
+        """Records overwritten in the ring before a flush reached them"""
+        return self.recorded - self.written - len(self._buffer)
+
+    @staticmethod
+    def _partition_path(day: str) -> str:
+        return os.path.join(get_settings().REQUEST_LOG_DIR, f"requests-{day}.db")
+
+    @staticmethod
+    def _partition_day(ts: float) -> str:
+        return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y%m%d")
+
+    def partitions(self) -> List[str]:
+        """Days with a partition on disk, newest first"""
+        directory = get_settings().REQUEST_LOG_DIR
+        if not os.path.isdir(directory):
+            return []
+        days = [name[len("requests-"):-len(".db")] for name in os.listdir(directory)
+                if name.startswith("requests-") and name.endswith(".db")]
+        return sorted(days, reverse=True)
+
+    @staticmethod
+    def _connect(path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def flush(self):
+        """Drain the ring and append its records to their day partitions, one transaction each"""
+        batch: List[LogRecord] = []
+        try:
+            while True:
+                batch.append(self._buffer.popleft())
+        except IndexError:
+            pass
+        if not batch:
+            return
+
+        by_day: Dict[str, List[LogRecord]] = {}
+        for record in batch:
+            by_day.setdefault(self._partition_day(record[0]), []).append(record)
+
+        os.makedirs(get_settings().REQUEST_LOG_DIR, exist_ok=True)
+        for day, records in by_day.items():
+            try:
+                conn = self._connect(self._partition_path(day))
+                try:
+                    conn.executescript(SCHEMA)
+                    with conn:
+                        conn.executemany(
+                            f"INSERT INTO request_log ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                            records
+                        )
+                finally:
+                    conn.close()
+                self.written += len(records)
+            except sqlite3.Error as e:
+                logger.error(f"Failed to write {len(records)} request log records for {day}: {e}")
+        self._apply_retention()
+
+    def _apply_retention(self):
+        cutoff = self._partition_day(time.time() - get_settings().REQUEST_LOG_RETENTION_DAYS * DAY)
+        for day in self.partitions():
+            if day < cutoff:
+                for suffix in ("", "-wal", "-shm"):
+                    try:
+                        os.remove(self._partition_path(day) + suffix)
+                    except OSError:
+                        pass
+                logger.info(f"Dropped request log partition {day}")
+
+    def query(self, log_filter: LogFilter, limit: int) -> List[Dict]:
+        """Newest records first, including ones still waiting in the ring"""
+        rows = [record for record in list(self._buffer) if log_filter.matches(record)]
+        rows.sort(key=lambda record: (record[0], record[1]), reverse=True)
+        rows = rows[:limit]
+
+        where, params = log_filter.where()
+        # Partitions are whole UTC days, so only open the ones inside the time range
+        upper_bounds = [ts for ts in (log_filter.until, log_filter.before and log_filter.before[0]) if ts is not None]
+        newest_day = self._partition_day(min(upper_bounds)) if upper_bounds else None
+        oldest_day = self._partition_day(log_filter.since) if log_filter.since is not None else None
+        for day in self.partitions():
+            if len(rows) >= limit or (oldest_day is not None and day < oldest_day):
+                break
+            if newest_day is not None and day > newest_day:
+                continue
+            conn = sqlite3.connect(f"file:{self._partition_path(day)}?mode=ro", uri=True)
+            try:
+                rows.extend(conn.execute(
+                    f"SELECT {', '.join(COLUMNS)} FROM request_log{where} ORDER BY ts DESC, request_id DESC LIMIT ?",
+                    params + [limit - len(rows)]
+                ).fetchall())
+            except sqlite3.Error as e:
+                logger.warning(f"Skipping unreadable request log partition {day}: {e}")
+            finally:
+                conn.close()
+        return [dict(zip(COLUMNS, row)) for row in rows[:limit]]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "buffered": len(self._buffer),
+            "recorded": self.recorded,
+            "written": self.written,
+            "dropped": self.dropped,
+            "partitions": len(self.partitions()),
+        }
+
+    async def _flush_loop(self):
+        interval = get_settings().REQUEST_LOG_FLUSH_INTERVAL
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(None, self.flush)
+
+    def start(self):
+        """Start the periodic background flush"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Cancel the background flush and write out whatever is buffered"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await asyncio.get_event_loop().run_in_executor(None, self.flush)
+
+
+request_log = RequestLog()
@@ -0,0 +1,430 @@
+"""
+Step scheduler that interleaves chunked prompt evaluation with decoding
+
+Without it a generation holds the llama.cpp context from its first prompt
+token to its last output token, so one long prompt stalls every other
+stream for the whole prompt evaluation. With STEP_TOKEN_BUDGET set, plain
+generations become sequences (ids 1..MAX_ACTIVE_SEQUENCES) in the one
+context and advance together in steps. Each step is one llama_decode call of
+at most STEP_TOKEN_BUDGET tokens: one token for every sequence that is
+generating, then as much of the pending prompts as still fits. A long prompt
+is ingested over several steps while running streams keep getting a token
+per step.
+
+Sequence 0 stays Llama's own (the last exclusive completion or restored
+template snapshot). New sequences share whatever prefix of it they match
+through llama_kv_cache_seq_cp, which tags cells rather than copying them.
+Exclusive callers (scoring, sessions, adapters, context shifting) still take
+the generation lock; the scheduler stops admitting sequences while one
+waits and hands the lock over once its running sequences finish.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp.llama_grammar import LlamaGrammar
+try:
+    from llama_cpp._internals import _LlamaSamplingContext as SamplingContext, _LlamaSamplingParams as SamplingParams
+except ImportError:
+    # Later releases dropped the underscore
+    from llama_cpp._internals import LlamaSamplingContext as SamplingContext, LlamaSamplingParams as SamplingParams
+from app.config import get_settings
+from app.models.grammars import JsonCloseTracker
+from app.models.kv_cache import kv_cache_usage
+from app.models.stops import StopFilter
+from app.placement import cpu_placement
+
+logger = logging.getLogger(__name__)
+
+
+def _percentiles(values: Sequence[float]) -> Dict[str, Optional[float]]:
+    ordered = sorted(values)
+
+    def percentile(q: float) -> Optional[float]:
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)], 2) if ordered else None
+
+    return {
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": round(ordered[-1], 2) if ordered else None,
+    }
+
+
+class StreamLatency:
+    """Time to first token and the gaps between tokens of recent generations, scheduled or not"""
+
+    def __init__(self, size: int = 10000):
+        self._ttft: Deque[float] = deque(maxlen=size)
+        self._itl: Deque[float] = deque(maxlen=size)
+
+    def record_ttft(self, ms: float):
+        self._ttft.append(ms)
+
+    def record_itl(self, ms: float):
+        self._itl.append(ms)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ttft_ms": _percentiles(list(self._ttft)),
+            "inter_token_ms": _percentiles(list(self._itl)),
+            "samples": len(self._itl),
+        }
+
+
+class ScheduledSequence:
+    """One generation handed to the scheduler; text pieces arrive on `queue`, then None"""
+
+    def __init__(
+        self,
+        prompt_tokens: List[int],
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        repeat_penalty: float = 1.1,
+        stop: Sequence[str] = (),
+        seed: Optional[int] = None,
+        prepare: Optional[Callable[[], None]] = None,
+        grammar: Optional[LlamaGrammar] = None,
+        json_close: Optional[JsonCloseTracker] = None
+    ):
+        self.prompt_tokens = list(prompt_tokens)
+        self.max_tokens = max_tokens
+        self.sampling = SamplingParams(
+            top_k=top_k, top_p=top_p, temp=temperature, penalty_repeat=repeat_penalty
+        )
+        self.seed = seed
+        self.stop = stop
+        self.grammar = grammar
+        # Ends the sequence once its top-level JSON value closes
+        self.json_close = json_close
+        # Run before admission when no other sequence is active, e.g. to restore a template snapshot into sequence 0
+        self.prepare = prepare
+        self.loop = asyncio.get_event_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.cancelled = threading.Event()
+        self.error: Optional[Exception] = None
+        self.generated: List[int] = []
+        self.shared_tokens = 0
+        self.finish_reason: Optional[str] = None
+        self.submitted = time.perf_counter()
+        self.admitted: Optional[float] = None
+        self.first_token: Optional[float] = None
+        self.last_token: Optional[float] = None
+        self.finished: Optional[float] = None
+        # Set on admission
+        self.seq_id = 0
+        self.n_past = 0
+        self.reserved = 0
+        self._sampler: Optional[SamplingContext] = None
+        self._stops: Optional[StopFilter] = None
+
+    def emit(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    @property
+    def prefilling(self) -> bool:
+        return self.n_past < len(self.prompt_tokens)
+
+
+class DecodeScheduler:
+    """Runs scheduled sequences on a worker thread that holds the generation lock while any are active"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending: Deque[ScheduledSequence] = deque()
+        self._active: List[ScheduledSequence] = []
+        self._exclusive_waiting = 0
+        self._thread: Optional[threading.Thread] = None
+        self._llm: Optional[Llama] = None
+        self._lock: Optional[threading.Lock] = None
+        self.kv_usage: Optional[Dict[str, Any]] = None
+        self.steps = 0
+        self.step_tokens = 0
+        self.prefill_chunks = 0
+        self.sequences = 0
+        self.shared_tokens = 0
+        self.split_steps = 0
+        self.max_step_ms = 0.0
+
+    @staticmethod
+    def enabled() -> bool:
+        return get_settings().STEP_TOKEN_BUDGET > 0
+
+    def submit(self, llm: Llama, lock: threading.Lock, sequence: ScheduledSequence):
+        """Queue a sequence; its text arrives on sequence.queue"""
+        with self._cond:
+            self._llm = llm
+            self._lock = lock
+            self._pending.append(sequence)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="decode-scheduler", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        """Wrap acquiring the generation lock for a call that needs the whole context"""
+        with self._cond:
+            self._exclusive_waiting += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive_waiting -= 1
+                self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending or self._exclusive_waiting:
+                    self._cond.wait()
+            with self._lock, cpu_placement.inference():
+                try:
+                    while True:
+                        self._admit()
+                        if not self._active:
+                            break
+                        self._step()
+                except Exception as e:
+                    # Admission and steps fail the sequences they touch themselves; anything
+                    # else is reported to the running sequences, queued ones wait their turn
+                    logger.error(f"Decode scheduler failed: {e}", exc_info=True)
+                    for sequence in list(self._active):
+                        self._fail(sequence, e)
+
+    def _admit(self):
+        settings = get_settings()
+        while len(self._active) < settings.MAX_ACTIVE_SEQUENCES:
+            with self._cond:
+                if not self._pending or self._exclusive_waiting:
+                    return
+                sequence = self._pending[0]
+                if sequence.cancelled.is_set():
+                    self._pending.popleft()
+                    sequence.finish_reason = "cancelled"
+                    sequence.emit(None)
+                    continue
+            try:
+                if not self._admit_sequence(sequence):
+                    return
+            except Exception as e:
+                # Only the sequence being admitted is at fault; drop it rather than retrying forever
+                logger.error(f"Decode scheduler admission failed: {e}", exc_info=True)
+                with self._cond:
+                    if self._pending and self._pending[0] is sequence:
+                        self._pending.popleft()
+                if sequence.seq_id:
+                    llama_cpp.llama_kv_cache_seq_rm(self._llm._ctx.ctx, sequence.seq_id, -1, -1)
+                sequence.error = e
+                sequence.emit(None)
+
+    def _admit_sequence(self, sequence: ScheduledSequence) -> bool:
+        """Admit the head of the queue if it fits; False when it has to wait for running sequences"""
+        settings = get_settings()
+        llm = self._llm
+        ctx = llm._ctx.ctx
+        n_ctx = llm.n_ctx()
+        if not self._active:
+            if sequence.prepare is not None:
+                sequence.prepare()
+                sequence.prepare = None
+            # Llama.reset() only rewinds n_tokens; free the cells past it as Llama.eval would
+            llama_cpp.llama_kv_cache_seq_rm(ctx, -1, llm.n_tokens, -1)
+        tokens = sequence.prompt_tokens
+        if len(tokens) >= n_ctx:
+            with self._cond:
+                self._pending.popleft()
+            sequence.error = ValueError(f"Requested tokens ({len(tokens)}) exceed context window of {n_ctx}")
+            sequence.emit(None)
+            return True
+        cached = llm.input_ids[:llm.n_tokens].tolist()
+        shared = 0
+        for cached_token, token in zip(cached, tokens[:-1]):
+            if cached_token != token:
+                break
+            shared += 1
+        needed = len(tokens) - shared + sequence.max_tokens
+        free = n_ctx - llm.n_tokens - sum(active.reserved for active in self._active)
+        if needed > free:
+            if self._active:
+                # Wait for running sequences to release their cells
+                return False
+            if llm.n_tokens:
+                # Sequence 0 is the only thing in the way; a later exclusive call re-evaluates it
+                llama_cpp.llama_kv_cache_seq_rm(ctx, 0, -1, -1)
+                llm.n_tokens = 0
+                return True
+            # Alone in an empty context, generate what fits, as create_completion does
+            sequence.max_tokens = n_ctx - len(tokens)
+            needed = n_ctx - len(tokens)
+        with self._cond:
+            self._pending.popleft()
+        used = {active.seq_id for active in self._active}
+        sequence.seq_id = next(seq_id for seq_id in range(1, settings.MAX_ACTIVE_SEQUENCES + 1) if seq_id not in used)
+        llama_cpp.llama_kv_cache_seq_rm(ctx, sequence.seq_id, -1, -1)
+        if shared:
+            llama_cpp.llama_kv_cache_seq_cp(ctx, 0, sequence.seq_id, 0, shared)
+        sequence.shared_tokens = shared
+        sequence.n_past = shared
+        sequence.reserved = needed
+        sequence.admitted = time.perf_counter()
+        sequence._sampler = SamplingContext(params=sequence.sampling, grammar=sequence.grammar, prev=list(tokens))
+        sequence._sampler.params.penalty_last_n = llm.last_n_tokens_size
+        sequence._stops = StopFilter(sequence.stop)
+        self._active.append(sequence)
+        self.sequences += 1
+        self.shared_tokens += shared
+        return True
+
+    def _step(self):
+        llm = self._llm
+        budget = max(1, min(get_settings().STEP_TOKEN_BUDGET, llm.n_batch))
+        rows: List[Tuple[ScheduledSequence, int, int, bool]] = []  # (sequence, token, position, wants logits)
+        for sequence in list(self._active):
+            if sequence.cancelled.is_set():
+                self._finish(sequence, "cancelled")
+            elif not sequence.prefilling:
+                rows.append((sequence, sequence.generated[-1], sequence.n_past, True))
+        # Decode tokens go first; prompts in arrival order get what is left
+        budget -= len(rows)
+        for sequence in self._active:
+            if budget <= 0:
+                break
+            if not sequence.prefilling:
+                continue
+            end = min(len(sequence.prompt_tokens), sequence.n_past + budget)
+            for position in range(sequence.n_past, end):
+                rows.append((sequence, sequence.prompt_tokens[position], position, position == len(sequence.prompt_tokens) - 1))
+            budget -= end - sequence.n_past
+            self.prefill_chunks += 1
+        if not rows:
+            return
+        started = time.perf_counter()
+        try:
+            sampled = self._decode(rows)
+        except Exception as e:
+            # The cells of this step are in an unknown state; fail the sequences that had rows in it
+            logger.error(f"Decode scheduler step failed: {e}", exc_info=True)
+            for sequence in dict.fromkeys(sequence for sequence, _, _, _ in rows):
+                self._fail(sequence, e)
+            return
+        self.steps += 1
+        self.step_tokens += len(rows)
+        self.max_step_ms = max(self.max_step_ms, (time.perf_counter() - started) * 1000)
+        for sequence, _, position, _ in rows:
+            sequence.n_past = max(sequence.n_past, position + 1)
+        for sequence, logits in sampled:
+            try:
+                self._accept(sequence, logits)
+            except Exception as e:
+                logger.error(f"Decode scheduler sampling failed: {e}", exc_info=True)
+                self._fail(sequence, e)
+
+    def _decode(self, rows: List[Tuple[ScheduledSequence, int, int, bool]]) -> List[Tuple[ScheduledSequence, np.ndarray]]:
+        """Evaluate rows in one llama_decode call, splitting it when the cache has no contiguous slot that large"""
+        llm = self._llm
+        ctx = llm._ctx.ctx
+        n_vocab = llm.n_vocab()
+        batch = llama_cpp.llama_batch_init(len(rows), 0, 1)
+        try:
+            for r, (sequence, token, position, logits) in enumerate(rows):
+                batch.token[r] = token
+                batch.pos[r] = position
+                batch.n_seq_id[r] = 1
+                batch.seq_id[r][0] = sequence.seq_id
+                batch.logits[r] = int(logits)
+            batch.n_tokens = len(rows)
+            result = llama_cpp.llama_decode(ctx, batch)
+            if result == 1 and len(rows) > 1:
+                self.split_steps += 1
+                half = len(rows) // 2
+                return self._decode(rows[:half]) + self._decode(rows[half:])
+            if result != 0:
+                raise RuntimeError(f"llama_decode failed with {result} for a step of {len(rows)} tokens")
+            return [
+                (sequence, np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(ctx, r), shape=(n_vocab,)).copy())
+                for r, (sequence, _, _, logits) in enumerate(rows) if logits
+            ]
+        finally:
+            llama_cpp.llama_batch_free(batch)
+
+    def _accept(self, sequence: ScheduledSequence, logits: np.ndarray):
+        llm = self._llm
+        if sequence.finish_reason is not None:
+            return
+        if sequence.seed is not None:
+            # The RNG is shared by every sequence, so seeded ones reseed per token to stay reproducible
+            llama_cpp.llama_set_rng_seed(llm._ctx.ctx, (sequence.seed * 1000003 + len(sequence.generated)) & 0xFFFFFFFF)
+        token = sequence._sampler.sample(ctx_main=llm._ctx, logits_array=logits)
+        sequence._sampler.accept(ctx_main=llm._ctx, id=token, apply_grammar=sequence.grammar is not None)
+        now = time.perf_counter()
+        if sequence.first_token is None:
+            sequence.first_token = now
+            stream_latency.record_ttft((now - sequence.submitted) * 1000)
+        else:
+            stream_latency.record_itl((now - sequence.last_token) * 1000)
+        sequence.last_token = now
+        if token == llm.token_eos():
+            self._finish(sequence, "stop")
+            return
+        sequence.generated.append(token)
+        piece = llm.detokenize([token])
+        text = sequence._stops.feed(piece)
+        if text:
+            sequence.emit(text)
+        if sequence._stops.stopped:
+            self._finish(sequence, "stop")
+        elif sequence.json_close is not None and sequence.json_close.feed(piece.decode("utf-8", errors="ignore")):
+            self._finish(sequence, "stop")
+        elif len(sequence.generated) >= sequence.max_tokens:
+            self._finish(sequence, "length")
+
+    def _fail(self, sequence: ScheduledSequence, error: Exception):
+        if sequence in self._active:
+            sequence.error = error
+            self._finish(sequence, "error")
+
+    def _finish(self, sequence: ScheduledSequence, reason: str):
+        llm = self._llm
+        if reason != "error":
+            # Measured before the cells go, so diagnostics show the sequences at their largest
+            self.kv_usage = {**kv_cache_usage(llm), "measured_at": time.time()}
+        llama_cpp.llama_kv_cache_seq_rm(llm._ctx.ctx, sequence.seq_id, -1, -1)
+        self._active.remove(sequence)
+        sequence.finish_reason = reason
+        sequence.finished = time.perf_counter()
+        if reason != "error":
+            text = sequence._stops.flush()
+            if text:
+                sequence.emit(text)
+        sequence.emit(None)
+
+    def stats(self) -> Dict[str, Any]:
+        settings = get_settings()
+        return {
+            "enabled": self.enabled(),
+            "step_token_budget": settings.STEP_TOKEN_BUDGET,
+            "max_active_sequences": settings.MAX_ACTIVE_SEQUENCES,
+            "active": len(self._active),
+            "pending": len(self._pending),
+            "sequences": self.sequences,
+            "steps": self.steps,
+            "avg_step_tokens": round(self.step_tokens / self.steps, 1) if self.steps else None,
+            "max_step_ms": round(self.max_step_ms, 2),
+            "prefill_chunks": self.prefill_chunks,
+            "shared_prefix_tokens": self.shared_tokens,
+            "split_steps": self.split_steps,
+            **stream_latency.stats(),
+        }
+
+
+stream_latency = StreamLatency()
+decode_scheduler = DecodeScheduler()
@@ -0,0 +1,112 @@
+"""
+Log-likelihood scoring of candidate continuations against one shared prompt
+
+The prompt is evaluated once into sequence 0 of the KV cache. Each candidate
+then gets its own sequence id whose prompt cells are shared with sequence 0
+(llama_kv_cache_seq_cp only tags cells, it copies nothing), so many
+candidates are decoded side by side in one llama_decode call.
+"""
+from typing import List, Sequence, Tuple
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+
+
+def continuation_tokens(llm: Llama, prompt: str, prompt_tokens: List[int], continuation: str) -> List[int]:
+    """Tokens of `continuation` as they appear after `prompt`
+
+    SentencePiece merges across the boundary differently than it tokenizes
+    the continuation alone, so the joined text is tokenized when the prompt
+    tokens are still a prefix of it.
+    """
+    joined = llm.tokenize((prompt + continuation).encode("utf-8"), add_bos=True)
+    if joined[:len(prompt_tokens)] == prompt_tokens and len(joined) > len(prompt_tokens):
+        return joined[len(prompt_tokens):]
+    return llm.tokenize(continuation.encode("utf-8"), add_bos=False)
+
+
+def _log_softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = logits - logits.max()
+    return shifted - np.log(np.exp(shifted).sum())
+
+
+def _eval_prompt(llm: Llama, prompt_tokens: List[int]):
+    """Evaluate the prompt into sequence 0, reusing any prefix already in the cache"""
+    cached = llm.input_ids[:llm.n_tokens].tolist()
+    common = 0
+    for cached_token, token in zip(cached, prompt_tokens):
+        if cached_token != token:
+            break
+        common += 1
+    # Re-evaluate at least the last prompt token so its logits are fresh
+    llm.n_tokens = min(common, len(prompt_tokens) - 1)
+    llm.eval(prompt_tokens[llm.n_tokens:])
+
+
+def _groups(continuations: Sequence[List[int]], capacity: int) -> List[List[int]]:
+    """Indices of multi-token continuations packed so each group fits one decode call"""
+    groups, current, used = [], [], 0
+    for i, tokens in enumerate(continuations):
+        needed = len(tokens) - 1  # The last token is scored from the logits before it
+        if needed <= 0:
+            continue
+        if needed > capacity:
+            raise ValueError(f"Candidate {i} is {len(tokens)} tokens, longer than the {capacity + 1} a single pass can score")
+        if used + needed > capacity:
+            groups.append(current)
+            current, used = [], 0
+        current.append(i)
+        used += needed
+    if current:
+        groups.append(current)
+    return groups
+
+
+def score_continuations(llm: Llama, prompt_tokens: List[int], continuations: Sequence[List[int]]) -> List[List[float]]:
+    """Per-token log-probabilities of each continuation given the prompt
+
+    Must be called with the model's generation lock held. Leaves the prompt
+    in sequence 0, so a following completion reuses it.
+    """
+    ctx = llm._ctx.ctx
+    n_vocab = llm.n_vocab()
+    n_prompt = len(prompt_tokens)
+    _eval_prompt(llm, prompt_tokens)
+
+    # Every candidate's first token is scored from the prompt's last logits
+    first = _log_softmax(np.asarray(llm.scores[n_prompt - 1], dtype=np.float32))
+    logprobs = [[float(first[tokens[0]])] if tokens else [] for tokens in continuations]
+
+    capacity = min(llm.n_batch, llm.n_ctx() - n_prompt)
+    groups = _groups(continuations, capacity)
+    if not groups:
+        return logprobs
+
+    batch = llama_cpp.llama_batch_init(capacity, 0, 1)
+    try:
+        for group in groups:
+            rows: List[Tuple[int, int]] = []  # (candidate index, position within the candidate)
+            for seq, i in enumerate(group, start=1):
+                llama_cpp.llama_kv_cache_seq_cp(ctx, 0, seq, 0, n_prompt)
+                for j, token in enumerate(continuations[i][:-1]):
+                    r = len(rows)
+                    batch.token[r] = token
+                    batch.pos[r] = n_prompt + j
+                    batch.n_seq_id[r] = 1
+                    batch.seq_id[r][0] = seq
+                    batch.logits[r] = 1
+                    rows.append((i, j))
+            batch.n_tokens = len(rows)
+            try:
+                if llama_cpp.llama_decode(ctx, batch) != 0:
+                    raise RuntimeError("llama_decode failed while scoring candidates")
+                for r, (i, j) in enumerate(rows):
+                    logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(ctx, r), shape=(n_vocab,))
+                    logprobs[i].append(float(_log_softmax(logits)[continuations[i][j + 1]]))
+            finally:
+                # Drops only the candidate cells; the prompt cells still belong to sequence 0
+                for seq in range(1, len(group) + 1):
+                    llama_cpp.llama_kv_cache_seq_rm(ctx, seq, -1, -1)
+    finally:
+        llama_cpp.llama_batch_free(batch)
+    return logprobs
@@ -0,0 +1,246 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional
+from app.config import get_settings
+from app.models.database import SessionLocal, ChatSessionModel
+
+logger = logging.getLogger(__name__)
+
+
+class ChatTurn:
+    """One message of a conversation with its cached token ids"""
+
+    __slots__ = ("role", "content", "tokens")
+
+    def __init__(self, role: str, content: str, tokens: Optional[List[int]] = None):
+        self.role = role
+        self.content = content
+        self.tokens = tokens
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content}
+
+    def footprint(self) -> int:
+        # A list slot plus an int object per cached token
+        return 64 + len(self.content) + (len(self.tokens) * 36 if self.tokens else 0)
+
+
+class ChatSession:
+    """Server-side transcript so clients only send the newest message"""
+
+    def __init__(self, session_id: str, title: Optional[str] = None, api_key: Optional[str] = None):
+        self.id = session_id
+        self.title = title
+        self.api_key = api_key
+        self.created_at = datetime.utcnow()
+        self.updated_at = self.created_at
+        self.last_access = time.monotonic()
+        self.turns: List[ChatTurn] = []
+        # Serializes turns of one conversation so the transcript stays ordered
+        self.lock = asyncio.Lock()
+
+    def append(self, role: str, content: str, tokens: Optional[List[int]] = None) -> ChatTurn:
+        turn = ChatTurn(role, content, tokens)
+        self.turns.append(turn)
+        self.updated_at = datetime.utcnow()
+        return turn
+
+    def messages(self) -> List[Dict[str, str]]:
+        return [turn.to_dict() for turn in self.turns]
+
+    def summary(self) -> Dict:
+        first_user = next((turn.content for turn in self.turns if turn.role == "user"), "")
+        return {
+            "id": self.id,
+            "title": self.title or first_user[:60] or "New session",
+            "preview": first_user[:120],
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "messages": len(self.turns),
+        }
+
+
+class SessionStore:
+    """Bounded LRU of chat sessions with TTL eviction and optional SQLite persistence"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+
+    def _evict(self):
+        settings = get_settings()
+        cutoff = time.monotonic() - settings.SESSION_TTL_SECONDS
+        # Oldest access is at the front, so stop at the first live session
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.last_access >= cutoff and len(self._sessions) <= settings.SESSION_MAX_COUNT:
+                break
+            self._sessions.popitem(last=False)
+
+    def create(self, title: Optional[str] = None, system_prompt: Optional[str] = None, api_key: Optional[str] = None) -> ChatSession:
+        session = ChatSession(uuid.uuid4().hex, title=title, api_key=api_key)
+        if system_prompt:
+            session.append("system", system_prompt)
+        with self._lock:
+            self._sessions[session.id] = session
+            self._evict()
+        self.save(session)
+        return session
+
+    def get(self, session_id: str) -> Optional[ChatSession]:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_access = time.monotonic()
+                self._sessions.move_to_end(session_id)
+                return session
+        # Fall back to the persisted copy; tokens are rebuilt lazily on the next turn
+        session = self._load(session_id)
+        if session is not None:
+            with self._lock:
+                session = self._sessions.setdefault(session_id, session)
+                self._evict()
+        return session
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            removed = self._sessions.pop(session_id, None) is not None
+        if get_settings().SESSION_PERSIST:
+            db = SessionLocal()
+            try:
+                removed = db.query(ChatSessionModel).filter(ChatSessionModel.id == session_id).delete() > 0 or removed
+                db.commit()
+            finally:
+                db.close()
+        return removed
+
+    def list(self, api_key: Optional[str] = None) -> List[Dict]:
+        """Summaries of saved sessions, most recently updated first"""
+        summaries: Dict[str, Dict] = {}
+        if get_settings().SESSION_PERSIST:
+            db = SessionLocal()
+            try:
+                query = db.query(ChatSessionModel)
+                if api_key:
+                    query = query.filter(ChatSessionModel.api_key == api_key)
+                for row in query.all():
+                    summaries[row.id] = self._from_row(row).summary()
+            finally:
+                db.close()
+        with self._lock:
+            for session in self._sessions.values():
+                if api_key is None or session.api_key == api_key:
+                    summaries[session.id] = session.summary()
+        return sorted(summaries.values(), key=lambda s: s["updated_at"], reverse=True)
+
+    def footprint(self) -> int:
+        """Approximate bytes held by in-memory sessions"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return sum(turn.footprint() for session in sessions for turn in session.turns)
+
+    def shrink(self, nbytes: int) -> int:
+        """Free memory from least recently used sessions; returns approximate bytes freed
+
+        Cached turn tokens are dropped first since they are rebuilt on the next
+        turn. Whole sessions are only evicted when they are persisted to SQLite.
+        
+        Sessions whose lock is held are mid-turn and left alone, in both passes.
+        This runs synchronously on the event loop (memory admission), so a lock
+        seen free here cannot be taken by a turn until shrink returns; that is
+        as good as holding it for the mutation, without an await in a sync path.
+        """
+        freed = 0
+        with self._lock:
+            idle = [session for session in self._sessions.values() if not session.lock.locked()]
+            for session in idle:
+                if freed >= nbytes:
+                    return freed
+                for turn in session.turns:
+                    if turn.tokens:
+                        freed += len(turn.tokens) * 36
+                        turn.tokens = None
+            if get_settings().SESSION_PERSIST:
+                # Evicting a busy session would orphan its reply and let the next
+                # request load a second copy with its own lock
+                for session in idle:
+                    if freed >= nbytes:
+                        break
+                    del self._sessions[session.id]
+                    freed += sum(turn.footprint() for turn in session.turns)
+        return freed
+
+    def export_state(self) -> List[Dict]:
+        """In-memory sessions including cached turn tokens, for warm restarts"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return [{
+            "id": session.id,
+            "title": session.title,
+            "api_key": session.api_key,
+            "created_at": session.created_at,
+            "updated_at": session.updated_at,
+            "turns": [(turn.role, turn.content, turn.tokens) for turn in session.turns],
+        } for session in sessions]
+
+    def import_state(self, exported: List[Dict]):
+        """Re-add sessions produced by `export_state`, oldest access first so LRU order is kept"""
+        for entry in exported:
+            session = ChatSession(entry["id"], title=entry["title"], api_key=entry["api_key"])
+            session.created_at = entry["created_at"]
+            for role, content, tokens in entry["turns"]:
+                session.append(role, content, tokens)
+            session.updated_at = entry["updated_at"]
+            with self._lock:
+                self._sessions.setdefault(session.id, session)
+        with self._lock:
+            self._evict()
+
+    def save(self, session: ChatSession):
+        """Write the session through to SQLite when persistence is enabled"""
+        if not get_settings().SESSION_PERSIST:
+            return
+        db = SessionLocal()
+        try:
+            db.merge(ChatSessionModel(
+                id=session.id,
+                api_key=session.api_key,
+                title=session.title,
+                created_at=session.created_at,
+                updated_at=session.updated_at,
+                messages=json.dumps(session.messages()),
+            ))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Failed to persist session {session.id}: {e}", exc_info=True)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _from_row(row: ChatSessionModel) -> ChatSession:
+        session = ChatSession(row.id, title=row.title, api_key=row.api_key)
+        session.created_at = row.created_at
+        for message in json.loads(row.messages or "[]"):
+            session.append(message["role"], message["content"])
+        session.updated_at = row.updated_at
+        return session
+
+    def _load(self, session_id: str) -> Optional[ChatSession]:
+        if not get_settings().SESSION_PERSIST:
+            return None
+        db = SessionLocal()
+        try:
+            row = db.query(ChatSessionModel).filter(ChatSessionModel.id == session_id).first()
+            return self._from_row(row) if row else None
+        finally:
+            db.close()
+
+
+session_store = SessionStore()
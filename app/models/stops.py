@@ -0,0 +1,58 @@
+"""
+Stop sequences for generation loops that decode token by token
+"""
+from typing import Sequence
+
+
+class StopFilter:
+    """Turns generated token bytes into text, holding back anything that could still become a stop sequence
+
+    `stopped` is set once a stop sequence appears; the text before it has
+    been returned and nothing after it is.
+    """
+
+    def __init__(self, stop: Sequence[str] = ()):
+        self._stop = [s for s in stop if s]
+        self._bytes = b""
+        self._emitted = 0
+        self.stopped = False
+
+    def _held_back(self, text: str) -> int:
+        """Length of the longest tail of `text` that begins a stop sequence"""
+        longest = 0
+        for stop in self._stop:
+            for length in range(min(len(stop) - 1, len(text)), longest, -1):
+                if text.endswith(stop[:length]):
+                    longest = length
+                    break
+        return longest
+
+    def feed(self, piece: bytes) -> str:
+        """Add the bytes of one token; returns the text that is now safe to send"""
+        if self.stopped:
+            return ""
+        self._bytes += piece
+        try:
+            text = self._bytes.decode("utf-8")
+        except UnicodeDecodeError:
+            # Part of a multi-byte character; wait for the rest
+            return ""
+        positions = [text.find(stop, max(self._emitted - len(stop), 0)) for stop in self._stop]
+        positions = [position for position in positions if position >= 0]
+        if positions:
+            self.stopped = True
+            end = max(min(positions), self._emitted)
+        else:
+            end = len(text) - self._held_back(text)
+        if end <= self._emitted:
+            return ""
+        safe, self._emitted = text[self._emitted:end], end
+        return safe
+
+    def flush(self) -> str:
+        """Text held back for a stop sequence that never completed"""
+        if self.stopped:
+            return ""
+        text = self._bytes.decode("utf-8", errors="ignore")
+        rest, self._emitted = text[self._emitted:], len(text)
+        return rest
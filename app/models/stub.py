@@ -0,0 +1,175 @@
+"""
+Deterministic stand-in for the model, for replaying captured traffic
+
+Generates filler text whose content depends only on the prompt and seed and
+whose timing is a fixed cost per prompt token and per generated token, with
+one generation at a time like a single llama.cpp context. Latency measured
+against it isolates queueing and server overhead from model variance.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+from app.config import get_settings
+from app.models.memory import estimate_tokens
+from app.models.sessions import ChatSession
+from app.models.templates import PromptTemplate
+from app.tracing import record_span, span
+
+logger = logging.getLogger(__name__)
+
+WORDS = ["the", "model", "answer", "is", "a", "short", "reply", "to", "your", "question", "with", "some", "words"]
+
+
+class StubModel:
+    """Backend with the LlamaModel interface and no weights"""
+
+    _instance = None
+    _model = None
+    _initialized = False
+    _last_error = None
+    _initialization_attempts = 0
+    _runtime_params: Optional[Dict[str, Any]] = None
+    _lock: Optional[asyncio.Lock] = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(StubModel, cls).__new__(cls)
+        return cls._instance
+
+    @classmethod
+    async def initialize(cls):
+        settings = get_settings()
+        cls._lock = asyncio.Lock()
+        cls._runtime_params = {
+            "source": "config",
+            "backend": "stub",
+            "prefill_ms_per_token": settings.STUB_PREFILL_MS,
+            "decode_ms_per_token": settings.STUB_DECODE_MS,
+        }
+        cls._initialized = True
+        logger.info(f"Stub backend ready ({settings.STUB_PREFILL_MS}ms per prompt token, {settings.STUB_DECODE_MS}ms per generated token)")
+
+    @classmethod
+    async def ensure_initialized(cls):
+        if not cls._initialized:
+            await cls.initialize()
+
+    def memory_profile(self) -> Dict[str, Any]:
+        return {"weights_bytes": 0, "kv_cache_bytes": 0, "logits_bytes": 0, "kv_bytes_per_token": 0, "kv_per_request": False}
+
+    def kv_usage(self) -> Dict[str, Any]:
+        return {
+            "notes": ["The stub backend has no KV cache"],
+            "kv_bytes_per_token": 0,
+            "capacity_bytes": 0,
+            "used_cells": 0,
+            "used_bytes": 0,
+            "sequences": [],
+            "measured_at": None,
+        }
+
+    @staticmethod
+    def _words(prompt: str, seed: Optional[int], count: int) -> List[str]:
+        digest = hashlib.sha256(f"{seed}:{prompt}".encode("utf-8")).digest()
+        return [WORDS[digest[i % len(digest)] % len(WORDS)] for i in range(count)]
+
+    async def _stream(self, prompt: str, max_tokens: Optional[int], seed: Optional[int]) -> AsyncIterator[Dict[str, Any]]:
+        await self.ensure_initialized()
+        settings = get_settings()
+        completion_tokens = max_tokens or settings.MAX_TOKENS
+        prompt_tokens = estimate_tokens(prompt)
+        submitted = time.perf_counter()
+        async with self._lock:
+            started = time.perf_counter()
+            record_span("queue", (started - submitted) * 1000)
+            await asyncio.sleep(prompt_tokens * settings.STUB_PREFILL_MS / 1000)
+            record_span("prompt_eval", (time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            for i, word in enumerate(self._words(prompt, seed, completion_tokens)):
+                await asyncio.sleep(settings.STUB_DECODE_MS / 1000)
+                yield {"text": word if i == 0 else f" {word}"}
+            record_span("decode", (time.perf_counter() - started) * 1000)
+        yield {
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+        }
+
+    async def generate_stream(
+        self,
+        prompt: str,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        top_k: Optional[int] = None,
+        template: Optional[PromptTemplate] = None,
+        seed: Optional[int] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        with span("format"):
+            formatted_prompt = f"[INST] {template.prefix if template else ''}{prompt} [/INST]"
+        async for event in self._stream(formatted_prompt, max_tokens, seed):
+            yield event
+
+    async def generate_response(self, prompt: str, **kwargs) -> Dict[str, Any]:
+        parts = []
+        async for event in self.generate_stream(prompt, **kwargs):
+            if "text" in event:
+                parts.append(event["text"])
+            else:
+                usage = event["usage"]
+        return {"text": "".join(parts), "finish_reason": "length", "usage": usage}
+
+    async def generate(self, prompt: str, **kwargs) -> str:
+        response = await self.generate_response(prompt, **kwargs)
+        return response["text"]
+
+    async def chat(
+        self,
+        messages: List[dict],
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        top_k: Optional[int] = None,
+        repeat_penalty: Optional[float] = None,
+    ) -> str:
+        prompt = "".join(f"{msg['role'].capitalize()}: {msg['content']}\n" for msg in messages) + "Assistant: "
+        parts = []
+        async for event in self._stream(prompt, max_tokens, None):
+            parts.append(event.get("text", ""))
+        return "".join(parts)
+
+    async def chat_session(self, session: ChatSession, content: str, **kwargs) -> str:
+        async with session.lock:
+            turn = session.append("user", content)
+            replied = False
+            try:
+                text = await self.chat(session.messages(), **kwargs)
+                session.append("assistant", text)
+                replied = True
+                return text
+            finally:
+                # Also covers cancellation, which is not an Exception
+                if not replied:
+                    session.turns.remove(turn)
+
+    async def score(self, prompt: str, candidates: List[str]) -> Dict[str, Any]:
+        """Prefill cost for the prompt and every candidate, with made-up log-probabilities"""
+        await self.ensure_initialized()
+        settings = get_settings()
+        prompt_tokens = estimate_tokens(prompt) + sum(estimate_tokens(candidate) for candidate in candidates)
+        async with self._lock:
+            await asyncio.sleep(prompt_tokens * settings.STUB_PREFILL_MS / 1000)
+        return {
+            "candidates": [
+                {"text": candidate, "logprob": -float(estimate_tokens(candidate)), "tokens": []}
+                for candidate in candidates
+            ],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 0, "total_tokens": prompt_tokens},
+        }
+
+    async def warm_template(self, template: PromptTemplate):
+        await self.ensure_initialized()
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+class TemplateTooLongError(ValueError):
+    """Raised when a template prefix does not leave room in the context for the prompt"""
+
+
+class PromptTemplate:
+    """A prompt whose fixed prefix is evaluated once and reused from a state snapshot"""
+
+    def __init__(self, template_id: str, prefix: str, name: Optional[str] = None):
+        self.id = template_id
+        self.name = name or template_id
+        self.prefix = prefix
+        self.prefix_tokens: Optional[List[int]] = None
+
+    def digest(self, model_path: str, n_ctx: int) -> str:
+        """Identifies a snapshot: the same prefix on a different model or context is a different state"""
+        try:
+            stat = os.stat(model_path)
+            model_id = f"{model_path}:{stat.st_size}:{int(stat.st_mtime)}"
+        except OSError:
+            model_id = model_path
+        return hashlib.sha256(f"{model_id}\0{n_ctx}\0{self.prefix}".encode("utf-8")).hexdigest()[:32]
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "prefix_tokens": len(self.prefix_tokens) if self.prefix_tokens is not None else None,
+        }
+
+
+class TemplateRegistry:
+    """Templates plus an LRU of llama.cpp state snapshots bounded by TEMPLATE_SNAPSHOT_MAX_MB
+
+    Snapshot methods take the Llama instance and must be called with the
+    model's generation lock held, since they reset and evaluate its context.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._templates: Dict[str, PromptTemplate] = {}
+        self._snapshots: "OrderedDict[str, object]" = OrderedDict()
+        self._snapshot_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, template_id: str, prefix: str, name: Optional[str] = None) -> PromptTemplate:
+        template = PromptTemplate(template_id, prefix, name)
+        with self._lock:
+            previous = self._templates.get(template_id)
+            self._templates[template_id] = template
+            if previous is not None and previous.prefix != prefix:
+                self._drop_snapshot(template_id)
+        return template
+
+    def revert(self, template_id: str, previous: Optional[PromptTemplate]):
+        """Undo a register whose prefix could not be evaluated, putting back what it replaced"""
+        with self._lock:
+            current = self._templates.get(template_id)
+            if previous is None:
+                self._templates.pop(template_id, None)
+                self._drop_snapshot(template_id)
+                return
+            self._templates[template_id] = previous
+            if current is not None and current.prefix != previous.prefix:
+                self._drop_snapshot(template_id)
+
+    def unregister(self, template_id: str) -> bool:
+        with self._lock:
+            self._drop_snapshot(template_id)
+            return self._templates.pop(template_id, None) is not None
+
+    def get(self, template_id: str) -> Optional[PromptTemplate]:
+        return self._templates.get(template_id)
+
+    def list(self) -> List[PromptTemplate]:
+        return list(self._templates.values())
+
+    def load_file(self, path: str):
+        """Register templates from a JSON list of {id, name, prefix}"""
+        with open(path) as f:
+            for entry in json.load(f):
+                self.register(str(entry["id"]), entry["prefix"], entry.get("name"))
+
+    def stats(self) -> Dict:
+        return {
+            "templates": len(self._templates),
+            "snapshots": len(self._snapshots),
+            "snapshot_bytes": self._snapshot_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def shrink(self, nbytes: int) -> int:
+        """Evict least recently used snapshots until `nbytes` are freed; returns bytes freed"""
+        freed = 0
+        with self._lock:
+            while self._snapshots and freed < nbytes:
+                evicted, old = self._snapshots.popitem(last=False)
+                size = self._state_size(old)
+                self._snapshot_bytes -= size
+                freed += size
+                logger.info(f"Evicted prompt snapshot for template {evicted} under memory pressure")
+        return freed
+
+    def export_state(self) -> Dict:
+        """Templates and their in-memory snapshots, for warm restarts"""
+        with self._lock:
+            return {
+                "templates": [(t.id, t.name, t.prefix, t.prefix_tokens) for t in self._templates.values()],
+                "snapshots": list(self._snapshots.items()),
+            }
+
+    def import_state(self, exported: Dict):
+        for template_id, name, prefix, prefix_tokens in exported["templates"]:
+            self.register(template_id, prefix, name).prefix_tokens = prefix_tokens
+        for template_id, state in exported["snapshots"]:
+            if template_id in self._templates:
+                self._store(template_id, state)
+
+    @staticmethod
+    def _state_size(state) -> int:
+        # Besides the context blob a LlamaState holds the logits of every evaluated token (n_tokens x n_vocab
+        # floats), often more than the KV cache itself, and the token ids
+        size = int(getattr(state, "llama_state_size", 0) or len(getattr(state, "llama_state", b"")))
+        for array in ("scores", "input_ids"):
+            size += int(getattr(getattr(state, array, None), "nbytes", 0))
+        return size
+
+    def _drop_snapshot(self, template_id: str):
+        state = self._snapshots.pop(template_id, None)
+        if state is not None:
+            self._snapshot_bytes -= self._state_size(state)
+
+    def _store(self, template_id: str, state):
+        budget = get_settings().TEMPLATE_SNAPSHOT_MAX_MB << 20
+        with self._lock:
+            self._drop_snapshot(template_id)
+            self._snapshots[template_id] = state
+            self._snapshot_bytes += self._state_size(state)
+            # Evict least recently used snapshots, but always keep the one just stored
+            while self._snapshot_bytes > budget and len(self._snapshots) > 1:
+                evicted, old = self._snapshots.popitem(last=False)
+                self._snapshot_bytes -= self._state_size(old)
+                logger.info(f"Evicted prompt snapshot for template {evicted}")
+
+    def _disk_path(self, template: PromptTemplate, model_path: str, n_ctx: int) -> Optional[str]:
+        directory = get_settings().TEMPLATE_SNAPSHOT_DIR
+        if not directory:
+            return None
+        return os.path.join(directory, f"{template.digest(model_path, n_ctx)}.state")
+
+    def _load_from_disk(self, path: Optional[str]):
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable prompt snapshot {path}: {e}")
+            return None
+
+    def _save_to_disk(self, path: Optional[str], state):
+        if not path:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to persist prompt snapshot {path}: {e}")
+
+    def restore(self, llm, template: PromptTemplate, model_path: str):
+        """Put the model into the state right after evaluating `template.prefix_tokens`"""
+        with self._lock:
+            state = self._snapshots.get(template.id)
+            if state is not None:
+                self._snapshots.move_to_end(template.id)
+        if state is not None:
+            self.hits += 1
+            llm.load_state(state)
+            return
+
+        self.misses += 1
+        path = self._disk_path(template, model_path, llm.n_ctx())
+        state = self._load_from_disk(path)
+        if state is not None:
+            llm.load_state(state)
+        else:
+            llm.reset()
+            llm.eval(template.prefix_tokens)
+            state = llm.save_state()
+            self._save_to_disk(path, state)
+        self._store(template.id, state)
+
+
+template_registry = TemplateRegistry()
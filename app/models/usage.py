@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import delete
+from sqlalchemy.dialects.sqlite import insert
+from app.config import get_settings
+from app.models.database import SessionLocal, UsageMinuteModel, UsageHourModel
+
+logger = logging.getLogger(__name__)
+
+MINUTE = 60
+HOUR = 3600
+
+# (api_key, minute bucket start) -> [requests, prompt_tokens, completion_tokens, latency_ms_sum]
+BucketKey = Tuple[str, int]
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second"""
+
+    __slots__ = ("capacity", "rate", "level", "updated")
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self) -> float:
+        """Seconds until the bucket is positive again, 0 if a request may proceed"""
+        self._refill(time.monotonic())
+        if self.level > 0:
+            return 0.0
+        return (1 - self.level) / self.rate
+
+    def consume(self, amount: float):
+        """Charge the bucket; it may go negative so large responses are paid for later"""
+        self._refill(time.monotonic())
+        self.level -= amount
+
+
+class UsageMeter:
+    """In-memory per-key usage aggregator flushed to SQLite in batches"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[BucketKey, List[float]] = {}
+        self._quotas: Dict[str, TokenBucket] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def record(self, api_key: str, prompt_tokens: int, completion_tokens: int, latency_ms: float):
+        """Add one completed request to the current minute bucket and charge its quota"""
+        bucket_start = int(time.time()) // MINUTE * MINUTE
+        with self._lock:
+            counters = self._pending.get((api_key, bucket_start))
+            if counters is None:
+                counters = self._pending[(api_key, bucket_start)] = [0, 0, 0, 0.0]
+            counters[0] += 1
+            counters[1] += prompt_tokens
+            counters[2] += completion_tokens
+            counters[3] += latency_ms
+        bucket = self._quotas.get(api_key)
+        if bucket is not None:
+            bucket.consume(prompt_tokens + completion_tokens)
+
+    def check_quota(self, api_key: str) -> float:
+        """Return 0 if the key may make a request, otherwise seconds to wait"""
+        settings = get_settings()
+        if settings.QUOTA_TOKENS_PER_MINUTE <= 0:
+            return 0.0
+        bucket = self._quotas.get(api_key)
+        if bucket is None:
+            capacity = settings.QUOTA_BURST_TOKENS or settings.QUOTA_TOKENS_PER_MINUTE
+            bucket = self._quotas[api_key] = TokenBucket(capacity, settings.QUOTA_TOKENS_PER_MINUTE / MINUTE)
+        return bucket.retry_after()
+
+    def snapshot(self) -> Dict[BucketKey, List[float]]:
+        """Copy of counters not yet flushed, used to serve fresh data between flushes"""
+        with self._lock:
+            return {key: list(counters) for key, counters in self._pending.items()}
+
+    def flush(self):
+        """Write pending buckets to the minute and hour tables in one transaction"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        minute_rows = []
+        hour_rows: Dict[BucketKey, List[float]] = {}
+        for (api_key, bucket_start), counters in pending.items():
+            minute_rows.append(self._row(api_key, bucket_start, counters))
+            hour_key = (api_key, bucket_start // HOUR * HOUR)
+            totals = hour_rows.setdefault(hour_key, [0, 0, 0, 0.0])
+            for i, value in enumerate(counters):
+                totals[i] += value
+
+        db = SessionLocal()
+        try:
+            self._upsert(db, UsageMinuteModel, minute_rows)
+            self._upsert(db, UsageHourModel, [self._row(k, b, c) for (k, b), c in hour_rows.items()])
+            cutoff = int(time.time()) - get_settings().USAGE_RETENTION_DAYS * 86400
+            db.execute(delete(UsageMinuteModel).where(UsageMinuteModel.bucket_start < cutoff))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Failed to flush usage buckets: {e}", exc_info=True)
+            # Put the counters back so the next flush retries them
+            with self._lock:
+                for key, counters in pending.items():
+                    totals = self._pending.setdefault(key, [0, 0, 0, 0.0])
+                    for i, value in enumerate(counters):
+                        totals[i] += value
+        finally:
+            db.close()
+
+    @staticmethod
+    def _row(api_key: str, bucket_start: int, counters: List[float]) -> Dict:
+        return {
+            "api_key": api_key,
+            "bucket_start": bucket_start,
+            "requests": int(counters[0]),
+            "prompt_tokens": int(counters[1]),
+            "completion_tokens": int(counters[2]),
+            "latency_ms_sum": float(counters[3]),
+        }
+
+    @staticmethod
+    def _upsert(db, model, rows: List[Dict]):
+        if not rows:
+            return
+        stmt = insert(model).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["api_key", "bucket_start"],
+            set_={
+                "requests": model.requests + stmt.excluded.requests,
+                "prompt_tokens": model.prompt_tokens + stmt.excluded.prompt_tokens,
+                "completion_tokens": model.completion_tokens + stmt.excluded.completion_tokens,
+                "latency_ms_sum": model.latency_ms_sum + stmt.excluded.latency_ms_sum,
+            },
+        )
+        db.execute(stmt)
+
+    async def _flush_loop(self):
+        interval = get_settings().USAGE_FLUSH_INTERVAL
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(None, self.flush)
+
+    def start(self):
+        """Start the periodic background flush"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Cancel the background flush and write out whatever is pending"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await asyncio.get_event_loop().run_in_executor(None, self.flush)
+
+
+usage_meter = UsageMeter()
@@ -0,0 +1,98 @@
+import logging
+import os
+import pickle
+import time
+from typing import Dict, Optional
+from app.config import get_settings
+from app.models.adapters import lora_runtime
+from app.models.autotune import model_fingerprint
+from app.models.backend import get_model
+from app.models.sessions import session_store
+from app.models.templates import template_registry
+
+logger = logging.getLogger(__name__)
+
+WARM_STATE_VERSION = 1
+
+
+def _fingerprint() -> str:
+    settings = get_settings()
+    # The stub backend runs without a model file
+    model_id = model_fingerprint(settings.MODEL_PATH) if os.path.exists(settings.MODEL_PATH) else settings.MODEL_PATH
+    return f"{settings.BACKEND}:{model_id}:{settings.CONTEXT_LENGTH}"
+
+
+def _has_llama_context(model) -> bool:
+    """Only the llama.cpp backend has KV state to carry over; templates and sessions exist on all of them"""
+    return get_settings().BACKEND not in ("transformers", "stub") and getattr(model, "_model", None) is not None
+
+
+def save_warm_state(path: Optional[str] = None) -> Optional[float]:
+    """Pickle the model's KV state, template snapshots and tokenized sessions; returns seconds taken"""
+    path = path or get_settings().WARM_STATE_PATH
+    model = get_model()
+    if not path or not model._initialized:
+        return None
+
+    started = time.perf_counter()
+    llama_state = None
+    # KV evaluated with an adapter applied is meaningless on the base weights the next process loads
+    if _has_llama_context(model) and lora_runtime.active is None:
+        with model._generation_lock:
+            llama_state = model._model.save_state()
+    state = {
+        "version": WARM_STATE_VERSION,
+        "fingerprint": _fingerprint(),
+        "llama_state": llama_state,
+        "templates": template_registry.export_state(),
+        "sessions": session_store.export_state(),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    elapsed = time.perf_counter() - started
+    logger.info(f"Saved warm state to {path} in {elapsed:.2f}s ({os.path.getsize(path)} bytes)")
+    return elapsed
+
+
+def restore_warm_state(path: Optional[str] = None) -> Dict:
+    """Load state saved by the previous process if it was produced for the same model and context"""
+    path = path or get_settings().WARM_STATE_PATH
+    result = {"restored": False, "restore_seconds": 0.0}
+    if not path or not os.path.exists(path):
+        return result
+
+    started = time.perf_counter()
+    try:
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state.get("version") != WARM_STATE_VERSION or state.get("fingerprint") != _fingerprint():
+            logger.info("Warm state was saved for a different model or context, ignoring it")
+            return result
+
+        model = get_model()
+        if state["llama_state"] is not None and _has_llama_context(model):
+            with model._generation_lock:
+                model._model.load_state(state["llama_state"])
+        template_registry.import_state(state["templates"])
+        session_store.import_state(state["sessions"])
+        result.update(
+            restored=True,
+            sessions=len(state["sessions"]),
+            templates=len(state["templates"]["templates"]),
+        )
+    except Exception as e:
+        logger.warning(f"Failed to restore warm state from {path}: {e}", exc_info=True)
+    finally:
+        # A snapshot is only valid for the process that follows the one that wrote it
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    result["restore_seconds"] = round(time.perf_counter() - started, 3)
+    if result["restored"]:
+        logger.info(f"Restored warm state in {result['restore_seconds']}s")
+    return result
@@ -0,0 +1,234 @@
+"""
+CPU placement: keep inference threads on dedicated physical cores of one NUMA
+node and the event loop (plus SQLite, psutil and other executor work) on its
+own core
+
+llama.cpp and torch start their worker threads from the thread that calls
+into them, and Linux threads inherit the CPU mask of the thread that creates
+them, so pinning the calling thread for the duration of a call places the
+whole thread pool. Without sysfs topology (macOS, some sandboxes) or with too
+few cores, placement stays a no-op and says why in diagnostics.
+"""
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Set, Tuple
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+SYSFS_CPU = "/sys/devices/system/cpu"
+SYSFS_NODE = "/sys/devices/system/node"
+
+
+def parse_cpulist(text: str) -> List[int]:
+    """'0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]"""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+class Core:
+    """One physical core and its hyperthread siblings"""
+
+    def __init__(self, node: int, package: int, core_id: int):
+        self.node = node
+        self.package = package
+        self.core_id = core_id
+        self.cpus: List[int] = []
+
+    def to_dict(self) -> Dict:
+        return {"node": self.node, "package": self.package, "core_id": self.core_id, "cpus": self.cpus}
+
+
+def read_topology(usable: Set[int], sysfs_cpu: str = SYSFS_CPU, sysfs_node: str = SYSFS_NODE) -> Optional[Dict[int, List[Core]]]:
+    """Usable physical cores grouped by NUMA node, or None when sysfs has no topology"""
+    node_of: Dict[int, int] = {}
+    if os.path.isdir(sysfs_node):
+        for name in os.listdir(sysfs_node):
+            if name.startswith("node") and name[4:].isdigit():
+                cpulist = _read(os.path.join(sysfs_node, name, "cpulist"))
+                for cpu in parse_cpulist(cpulist or ""):
+                    node_of[cpu] = int(name[4:])
+
+    cores: Dict[Tuple[int, int], Core] = {}
+    for cpu in sorted(usable):
+        topology = os.path.join(sysfs_cpu, f"cpu{cpu}", "topology")
+        core_id = _read(os.path.join(topology, "core_id"))
+        package = _read(os.path.join(topology, "physical_package_id"))
+        if core_id is None or package is None:
+            return None
+        key = (int(package), int(core_id))
+        if key not in cores:
+            # Machines without NUMA nodes in sysfs are one node
+            cores[key] = Core(node_of.get(cpu, 0), int(package), int(core_id))
+        cores[key].cpus.append(cpu)
+
+    nodes: Dict[int, List[Core]] = {}
+    for core in sorted(cores.values(), key=lambda core: core.cpus[0]):
+        nodes.setdefault(core.node, []).append(core)
+    return nodes or None
+
+
+class CpuPlacement:
+    """Which cores this process's inference and event loop threads run on"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._planned = False
+        self.enabled = False
+        self.reason = "not planned"
+        self.node: Optional[int] = None
+        self.inference_cores: List[Core] = []
+        self.loop_cores: List[Core] = []
+        self.process_cpus: Optional[Set[int]] = None
+        self.nodes: Optional[Dict[int, List[Core]]] = None
+        self.loop_pinned = False
+        self.pinned_calls = 0
+
+    @staticmethod
+    def _usable_cpus() -> Optional[Set[int]]:
+        try:
+            return set(os.sched_getaffinity(0))
+        except AttributeError:
+            return None  # Not Linux
+
+    def plan(self, sysfs_cpu: str = SYSFS_CPU, sysfs_node: str = SYSFS_NODE):
+        """Split this worker's share of one node into inference cores and event loop cores"""
+        with self._lock:
+            if self._planned:
+                return
+            self._planned = True
+            settings = get_settings()
+            # Read before anything is pinned; the event loop thread's own mask shrinks later
+            self.process_cpus = usable = self._usable_cpus()
+            if usable is None:
+                self.reason = "CPU affinity is not supported on this platform"
+                return
+            self.nodes = nodes = read_topology(usable, sysfs_cpu, sysfs_node)
+            if not settings.CPU_PINNING:
+                self.reason = "CPU_PINNING is off"
+                return
+            if nodes is None:
+                self.reason = "CPU topology not available in sysfs"
+                return
+
+            worker, workers = settings.CPU_PIN_WORKER, max(settings.CPU_PIN_WORKERS, 1)
+            node_ids = sorted(nodes)
+            if settings.CPU_PIN_NODE >= 0:
+                if settings.CPU_PIN_NODE not in nodes:
+                    self.reason = f"NUMA node {settings.CPU_PIN_NODE} has no usable CPUs"
+                    return
+                node = settings.CPU_PIN_NODE
+                sharing = list(range(workers))
+            else:
+                # Spread workers across nodes first, then split each node between its workers
+                node = node_ids[worker % len(node_ids)]
+                sharing = [w for w in range(workers) if w % len(node_ids) == worker % len(node_ids)]
+
+            cores = nodes[node]
+            share = len(cores) // len(sharing)
+            position = sharing.index(worker) if worker in sharing else 0
+            mine = cores[position * share:(position + 1) * share]
+            loop_count = max(settings.CPU_PIN_LOOP_CORES, 0)
+            if len(mine) <= loop_count:
+                self.reason = f"Worker {worker} gets {len(mine)} cores on node {node}, too few to separate the event loop"
+                return
+
+            self.node = node
+            self.loop_cores = mine[len(mine) - loop_count:] if loop_count else []
+            self.inference_cores = mine[:len(mine) - loop_count]
+            self.enabled = True
+            self.reason = "pinned"
+            logger.info(
+                f"CPU placement: node {node}, inference on CPUs {self.inference_cpus}, "
+                f"event loop on CPUs {self.loop_cpus or 'unpinned'}"
+            )
+
+    @property
+    def inference_cpus(self) -> List[int]:
+        # One thread per physical core; hyperthread siblings share the core's execution units
+        return [core.cpus[0] for core in self.inference_cores]
+
+    @property
+    def loop_cpus(self) -> List[int]:
+        return [cpu for core in self.loop_cores for cpu in core.cpus]
+
+    def thread_limit(self, n_threads: int) -> int:
+        """Cap a thread count at the pinned core count; more threads than cores only contend"""
+        self.plan()
+        if self.enabled and n_threads > len(self.inference_cpus):
+            logger.info(f"Reducing {n_threads} inference threads to the {len(self.inference_cpus)} pinned cores")
+            return len(self.inference_cpus)
+        return n_threads
+
+    def pin_event_loop(self):
+        """Pin the calling (event loop) thread; executor threads it starts later inherit the mask"""
+        self.plan()
+        if not self.enabled or not self.loop_cpus:
+            return
+        try:
+            os.sched_setaffinity(0, self.loop_cpus)
+            self.loop_pinned = True
+        except OSError as e:
+            logger.warning(f"Could not pin the event loop to CPUs {self.loop_cpus}: {e}")
+
+    @contextmanager
+    def inference(self):
+        """Run the enclosed inference call, and the threads it starts, on the inference cores"""
+        self.plan()
+        if not self.enabled:
+            yield
+            return
+        # sched_setaffinity(0) on Linux affects only the calling thread
+        previous = os.sched_getaffinity(0)
+        try:
+            os.sched_setaffinity(0, self.inference_cpus)
+        except OSError as e:
+            logger.warning(f"Could not pin inference to CPUs {self.inference_cpus}: {e}")
+            yield
+            return
+        self.pinned_calls += 1
+        try:
+            yield
+        finally:
+            # Executor threads go back to background work, which belongs off the inference cores
+            os.sched_setaffinity(0, previous)
+
+    def report(self) -> Dict:
+        self.plan()
+        settings = get_settings()
+        return {
+            "enabled": self.enabled,
+            "reason": self.reason,
+            "worker": settings.CPU_PIN_WORKER,
+            "workers": settings.CPU_PIN_WORKERS,
+            "node": self.node,
+            "inference_cpus": self.inference_cpus,
+            "loop_cpus": self.loop_cpus,
+            "loop_pinned": self.loop_pinned,
+            "pinned_calls": self.pinned_calls,
+            "process_cpus": sorted(self.process_cpus) if self.process_cpus is not None else None,
+            "topology": {
+                str(node): [core.to_dict() for core in cores] for node, cores in self.nodes.items()
+            } if self.nodes else None,
+        }
+
+
+cpu_placement = CpuPlacement()
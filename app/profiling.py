@@ -0,0 +1,230 @@
+"""
+Sampling profiler and event-loop lag monitor for the live process
+
+The profiler is a background thread that reads every other thread's Python
+stack with sys._current_frames() at a fixed interval, so the cost is one stack
+walk per thread per sample and nothing at all between profiles. Stacks are
+returned collapsed ("thread;file:function;... count" per line), the input
+format of flamegraph.pl, speedscope and inferno.
+
+The lag monitor pairs a heartbeat coroutine on the event loop with a watchdog
+thread. When the heartbeat falls behind by more than the threshold, the
+watchdog captures the loop thread's stack while the offending callback is
+still running, which is the one moment its culprit is visible.
+"""
+import asyncio
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MAX_DEPTH = 128
+# Leaf frames of threads parked waiting for work, left out of profiles unless asked for
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("thread.py", "_worker"),
+}
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profile is requested while another one is running"""
+
+
+def _label(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def _thread_group(name: str) -> str:
+    # Executor workers "ThreadPoolExecutor-0_3" fold into one "ThreadPoolExecutor-0" root
+    return re.sub(r"_\d+$", "", name)
+
+
+def thread_stack(frame, limit: int = MAX_DEPTH) -> List[str]:
+    """`file:function` of each frame from the outermost call inward"""
+    stack = []
+    while frame is not None and len(stack) < limit:
+        stack.append(_label(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class SamplingProfiler:
+    """One profile at a time, run on its own thread so the executor pool is not used"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = False
+
+    def _sample(self, seconds: float, interval: float, include_idle: bool) -> Dict[str, Any]:
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks: Counter = Counter()
+        samples = 0
+        started = time.perf_counter()
+        deadline = started + seconds
+        while time.perf_counter() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if not include_idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                root = _thread_group(names.get(ident, f"thread-{ident}"))
+                stacks[";".join([root] + thread_stack(frame))] += 1
+            samples += 1
+            time.sleep(interval)
+        return {
+            "duration_seconds": round(time.perf_counter() - started, 3),
+            "interval_ms": interval * 1000,
+            "samples": samples,
+            "stacks": stacks,
+        }
+
+    async def profile(self, seconds: float, interval_ms: float, include_idle: bool = False) -> Dict[str, Any]:
+        """Sample all threads for `seconds`; raises ProfilerBusyError if a profile is already running"""
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError("A profile is already running")
+        loop = asyncio.get_event_loop()
+        done = loop.create_future()
+
+        def run():
+            try:
+                result = self._sample(seconds, interval_ms / 1000, include_idle)
+                loop.call_soon_threadsafe(done.set_result, result)
+            except Exception as e:
+                loop.call_soon_threadsafe(done.set_exception, e)
+            finally:
+                self.running = False
+                self._lock.release()
+
+        self.running = True
+        threading.Thread(target=run, name="sampling-profiler", daemon=True).start()
+        return await done
+
+    @staticmethod
+    def collapsed(stacks: Counter) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    @staticmethod
+    def top_frames(stacks: Counter, limit: int = 20) -> List[Dict[str, Any]]:
+        """Functions by samples spent in them (self) and under them (total)"""
+        own: Counter = Counter()
+        total: Counter = Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(";")[1:]
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return [
+            {"frame": frame, "self": count, "total": total[frame]}
+            for frame, count in own.most_common(limit)
+        ]
+
+
+class LoopLagMonitor:
+    """Heartbeat on the event loop, watched from a thread that captures the loop's stack during stalls"""
+
+    def __init__(self):
+        self.threshold_ms = 100.0
+        self.interval = 0.05
+        self.stalls: deque = deque(maxlen=50)
+        self.stall_count = 0
+        self.max_lag_ms = 0.0
+        self._recent_lag: deque = deque(maxlen=1200)
+        self._beat = time.perf_counter()
+        self._loop_thread: Optional[int] = None
+        self._pending: Optional[Dict[str, Any]] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+
+    async def _heartbeat_loop(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            lag_ms = max(now - expected, 0.0) * 1000
+            self._beat = now
+            self._recent_lag.append(lag_ms)
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            pending = self._pending
+            if pending is not None:
+                # The heartbeat is back, so the blocking callback has returned
+                self._pending = None
+                if lag_ms < self.threshold_ms:
+                    # The watchdog raced a heartbeat that was already on its way
+                    continue
+                pending["blocked_ms"] = round(lag_ms, 1)
+                self.stalls.append(pending)
+                self.stall_count += 1
+                logger.warning(
+                    f"Event loop blocked for {pending['blocked_ms']}ms in {pending['stack'][-1] if pending['stack'] else '?'}: "
+                    + " <- ".join(reversed(pending["stack"][-8:]))
+                )
+
+    def _watchdog(self):
+        while not self._stop.wait(self.interval / 2):
+            behind_ms = (time.perf_counter() - self._beat) * 1000 - self.interval * 1000
+            if behind_ms < self.threshold_ms or self._pending is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            self._pending = {
+                "detected_at": time.time(),
+                "stack": thread_stack(frame),
+            }
+
+    def start(self, threshold_ms: float):
+        if self._heartbeat is not None:
+            return
+        self.threshold_ms = threshold_ms
+        # Check often enough to catch a stall while it is still under way
+        self.interval = min(0.05, threshold_ms / 2000)
+        self._loop_thread = threading.get_ident()
+        self._beat = time.perf_counter()
+        self._stop.clear()
+        self._heartbeat = asyncio.ensure_future(self._heartbeat_loop())
+        threading.Thread(target=self._watchdog, name="loop-lag-watchdog", daemon=True).start()
+        logger.info(f"Event loop lag monitor recording stalls over {threshold_ms}ms")
+
+    def stop(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        self._stop.set()
+
+    def summary(self) -> Dict[str, Any]:
+        recent = sorted(self._recent_lag)
+
+        def percentile(q: float) -> Optional[float]:
+            return round(recent[min(int(q * len(recent)), len(recent) - 1)], 2) if recent else None
+
+        return {
+            "enabled": self._heartbeat is not None,
+            "threshold_ms": self.threshold_ms,
+            "lag_p50_ms": percentile(0.5),
+            "lag_p99_ms": percentile(0.99),
+            "max_lag_ms": round(self.max_lag_ms, 2),
+            "stalls": self.stall_count,
+        }
+
+    def report(self) -> Dict[str, Any]:
+        return {**self.summary(), "recent_stalls": list(reversed(self.stalls))}
+
+
+sampling_profiler = SamplingProfiler()
+loop_monitor = LoopLagMonitor()
@@ -0,0 +1,344 @@
+"""
+Session-affinity router for several HuggingMind instances
+
+Turns of one conversation (or requests of one API key) go to the same
+backend so its prompt, session and template caches stay useful. Backends
+are polled through their health endpoints; unhealthy or draining nodes are
+skipped and requests without an affinity key go to the least-loaded node.
+
+    python -m app.router --backends http://127.0.0.1:8001,http://127.0.0.1:8002 --port 8000
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Hop-by-hop headers are per connection and must not be forwarded
+HOP_BY_HOP = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade", "host", "content-length",
+}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+MAX_PINNED_SESSIONS = 100000
+
+
+class Backend:
+    """One HuggingMind instance and what the router last learned about it"""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.healthy = False
+        self.status = "unknown"
+        self.reported_in_flight = 0
+        self.outstanding = 0  # Requests this router has open against the node
+        self.failures = 0
+        self.last_check: Optional[float] = None
+
+    @property
+    def load(self) -> int:
+        # The router's own count is current; the reported one covers other clients
+        return max(self.reported_in_flight, self.outstanding)
+
+    def to_dict(self) -> Dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "status": self.status,
+            "in_flight": self.reported_in_flight,
+            "outstanding": self.outstanding,
+            "failures": self.failures,
+            "last_check": self.last_check,
+        }
+
+
+class HashRing:
+    """Consistent hash ring; adding or removing a node only moves that node's keys"""
+
+    def __init__(self, backends: List[Backend], vnodes: int):
+        self._points: List[int] = []
+        self._owners: Dict[int, Backend] = {}
+        for backend in backends:
+            for i in range(vnodes):
+                point = self._hash(f"{backend.url}#{i}")
+                self._owners[point] = backend
+                bisect.insort(self._points, point)
+        self._count = len(backends)
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def walk(self, key: str) -> Iterator[Backend]:
+        """Distinct backends clockwise from the key's position, its owner first"""
+        if not self._points:
+            return
+        seen = set()
+        start = bisect.bisect(self._points, self._hash(key))
+        for i in range(len(self._points)):
+            backend = self._owners[self._points[(start + i) % len(self._points)]]
+            if backend.url not in seen:
+                seen.add(backend.url)
+                yield backend
+                if len(seen) == self._count:
+                    return
+
+
+class Router:
+    def __init__(self, urls: List[str], vnodes: int, retries: int, health_interval: float):
+        self.backends = [Backend(url) for url in urls]
+        self.ring = HashRing(self.backends, vnodes)
+        self.retries = retries
+        self.health_interval = health_interval
+        self.client: Optional[httpx.AsyncClient] = None
+        self._health_task: Optional[asyncio.Task] = None
+        # Sessions live where they were created, which the ring cannot know in advance
+        self.pinned: "OrderedDict[str, Backend]" = OrderedDict()
+        self.affinity_hits = 0
+        self.fallbacks = 0
+        self.retried = 0
+
+    async def start(self):
+        # No read timeout: generations and streams can legitimately take minutes
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(10.0, read=None))
+        await self.check_all()
+        self._health_task = asyncio.ensure_future(self._health_loop())
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def _check(self, backend: Backend):
+        try:
+            ready = await self.client.get(f"{backend.url}/health/ready", timeout=2.0)
+            body = ready.json()
+            backend.status = body.get("status", "unknown")
+            backend.healthy = ready.status_code == 200
+            if backend.healthy:
+                health = await self.client.get(f"{backend.url}/health", timeout=2.0)
+                if health.status_code == 200:
+                    backend.reported_in_flight = int(health.json().get("in_flight", 0))
+        except (httpx.HTTPError, ValueError) as e:
+            backend.healthy = False
+            backend.status = f"unreachable: {type(e).__name__}"
+        backend.last_check = time.time()
+
+    async def check_all(self):
+        await asyncio.gather(*(self._check(backend) for backend in self.backends))
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_all()
+
+    def candidates(self, key: Optional[str]) -> List[Backend]:
+        """Healthy backends in the order they should be tried"""
+        by_load = sorted((backend for backend in self.backends if backend.healthy), key=lambda backend: backend.load)
+        if key is None:
+            return by_load
+        owner = self.pinned.get(key) or next(self.ring.walk(key), None)
+        if owner is not None and owner.healthy:
+            self.affinity_hits += 1
+        else:
+            # The owner is down or draining; its ring successor keeps the key stable until it returns
+            self.fallbacks += 1
+            owner = next((backend for backend in self.ring.walk(key) if backend.healthy), None)
+        if owner is None:
+            return []
+        # After the ring owner, fail over to whichever node is least loaded
+        return [owner] + [backend for backend in by_load if backend is not owner]
+
+    def pin(self, key: str, backend: Backend):
+        self.pinned[key] = backend
+        self.pinned.move_to_end(key)
+        while len(self.pinned) > MAX_PINNED_SESSIONS:
+            self.pinned.popitem(last=False)
+
+    def stats(self) -> Dict:
+        return {
+            "backends": [backend.to_dict() for backend in self.backends],
+            "affinity_hits": self.affinity_hits,
+            "fallbacks": self.fallbacks,
+            "retried": self.retried,
+            "pinned_sessions": len(self.pinned),
+        }
+
+
+def affinity_key(request: Request, body: bytes) -> Optional[str]:
+    """Session id when the request names one, otherwise the caller's API key"""
+    parts = request.url.path.strip("/").split("/")
+    if len(parts) >= 2 and parts[0] == "sessions":
+        return f"session:{parts[1]}"
+    if body and request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict) and payload.get("session_id"):
+            return f"session:{payload['session_id']}"
+    authorization = request.headers.get("authorization")
+    if authorization:
+        return f"key:{authorization}"
+    return None
+
+
+class Relay:
+    """Pass the upstream body through chunk by chunk, so SSE streams are not buffered
+
+    The body's finally only runs if Starlette starts iterating it; a client that
+    disconnects first would leak the backend's outstanding count and the upstream
+    connection, so the response's background task releases them too, once.
+    """
+
+    def __init__(self, response: httpx.Response, backend: Backend):
+        self.response = response
+        self.backend = backend
+        self.released = False
+
+    async def body(self):
+        try:
+            async for chunk in self.response.aiter_raw():
+                yield chunk
+        finally:
+            await self.release()
+
+    async def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.backend.outstanding -= 1
+        await self.response.aclose()
+
+
+def create_app(router: Router) -> FastAPI:
+    app = FastAPI(title="HuggingMind AI Router")
+
+    @app.on_event("startup")
+    async def on_startup():
+        await router.start()
+        logger.info(f"Routing across {len(router.backends)} backends")
+
+    @app.on_event("shutdown")
+    async def on_shutdown():
+        await router.stop()
+
+    @app.get("/router/status")
+    async def router_status():
+        """Backend health, load and routing counters"""
+        return router.stats()
+
+    @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"])
+    async def proxy(path: str, request: Request):
+        body = await request.body()
+        key = affinity_key(request, body)
+        forward_headers = [(name, value) for name, value in request.headers.raw if name.decode("latin-1").lower() not in HOP_BY_HOP]
+        idempotent = request.method in IDEMPOTENT_METHODS
+
+        candidates = router.candidates(key)
+        if not candidates:
+            return JSONResponse(status_code=503, content={"detail": "No healthy backends"}, headers={"Retry-After": "1"})
+
+        last_error = None
+        for attempt, backend in enumerate(candidates[:router.retries + 1]):
+            if attempt:
+                router.retried += 1
+            upstream = router.client.build_request(
+                request.method,
+                f"{backend.url}/{path}",
+                params=request.query_params.multi_items(),
+                headers=forward_headers,
+                content=body,
+            )
+            backend.outstanding += 1
+            try:
+                response = await router.client.send(upstream, stream=True)
+            except httpx.ConnectError as e:
+                # Nothing reached the node, so any method can go elsewhere
+                backend.outstanding -= 1
+                backend.healthy = False
+                backend.failures += 1
+                last_error = e
+                continue
+            except httpx.HTTPError as e:
+                backend.outstanding -= 1
+                backend.failures += 1
+                last_error = e
+                if idempotent:
+                    continue
+                break
+
+            # 503 means the node refused the work (draining, memory pressure); others only retry if idempotent
+            retryable = response.status_code == 503 or (idempotent and response.status_code in (502, 504))
+            if retryable and attempt < min(router.retries, len(candidates) - 1):
+                await response.aclose()
+                backend.outstanding -= 1
+                backend.failures += 1
+                continue
+
+            headers = {name: value for name, value in response.headers.items() if name.lower() not in HOP_BY_HOP}
+            if request.method == "POST" and path.strip("/") == "sessions" and response.status_code == 200:
+                # Small JSON body; read it to pin the new session to the node that holds it
+                content = await response.aread()
+                backend.outstanding -= 1
+                await response.aclose()
+                try:
+                    router.pin(f"session:{json.loads(content)['id']}", backend)
+                except (ValueError, KeyError, TypeError):
+                    pass
+                return Response(content=content, status_code=response.status_code, headers=headers)
+
+            relay = Relay(response, backend)
+            return StreamingResponse(
+                relay.body(),
+                status_code=response.status_code,
+                headers=headers,
+                background=BackgroundTask(relay.release),
+            )
+
+        logger.warning(f"{request.method} /{path} failed on every candidate: {last_error}")
+        return JSONResponse(status_code=502, content={"detail": f"Upstream request failed: {last_error}"})
+
+    return app
+
+
+def parse_args():
+    settings = get_settings()
+    parser = argparse.ArgumentParser(description="Session-affinity router for HuggingMind instances")
+    parser.add_argument("--backends", default=settings.ROUTER_BACKENDS, help="Comma-separated backend base URLs")
+    parser.add_argument("--host", default=settings.HOST)
+    parser.add_argument("--port", type=int, default=settings.PORT)
+    parser.add_argument("--vnodes", type=int, default=settings.ROUTER_VNODES, help="Ring points per backend")
+    parser.add_argument("--retries", type=int, default=settings.ROUTER_RETRIES, help="Other nodes tried after a failure")
+    parser.add_argument("--health-interval", type=float, default=settings.ROUTER_HEALTH_INTERVAL, help="Seconds between health polls")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    args = parse_args()
+    urls = [url.strip() for url in args.backends.split(",") if url.strip()]
+    if not urls:
+        raise SystemExit("No backends given; pass --backends or set ROUTER_BACKENDS")
+    router = Router(urls, args.vnodes, args.retries, args.health_interval)
+    uvicorn.run(create_app(router), host=args.host, port=args.port, log_level="info")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Request-scoped timing spans
+"""
+import json
+import logging
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+slow_logger = logging.getLogger("app.slow_requests")
+
+class RequestTrace:
+    """Spans collected for one HTTP request"""
+
+    def __init__(self, method: str = "", path: str = ""):
+        self.request_id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.arrived = time.time()
+        self.spans: List[Tuple[str, float]] = []
+        # Filled in by handlers for the request log
+        self.api_key: Optional[str] = None
+        self.prompt_tokens: Optional[int] = None
+        self.completion_tokens: Optional[int] = None
+        # Request shape for traffic capture, set by generation handlers while capture is on
+        self.capture: Optional[Dict] = None
+
+    def add(self, name: str, duration_ms: float):
+        self.spans.append((name, duration_ms))
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def totals(self) -> Dict[str, float]:
+        """Span durations summed by name, in the order they were first seen"""
+        totals: Dict[str, float] = {}
+        for name, duration_ms in self.spans:
+            totals[name] = totals.get(name, 0.0) + duration_ms
+        return totals
+
+    def server_timing(self) -> str:
+        entries = [f"{name};dur={duration_ms:.1f}" for name, duration_ms in self.totals().items()]
+        entries.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(entries)
+
+_current_trace: ContextVar[Optional[RequestTrace]] = ContextVar("current_trace", default=None)
+
+def start_trace(method: str = "", path: str = "") -> RequestTrace:
+    trace = RequestTrace(method, path)
+    _current_trace.set(trace)
+    return trace
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+def record_span(name: str, duration_ms: float):
+    """Attach an externally measured duration to the current request, if any"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, duration_ms)
+
+def tag_request(**fields):
+    """Set request log fields (api_key, prompt_tokens, completion_tokens, capture) on the current request"""
+    trace = _current_trace.get()
+    if trace is not None:
+        for name, value in fields.items():
+            setattr(trace, name, value)
+
+@contextmanager
+def span(name: str):
+    """Time the enclosed block as a span of the current request"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, (time.perf_counter() - started) * 1000)
+
+def log_if_slow(trace: RequestTrace, status_code: int, threshold_ms: float, sample_rate: float):
+    """Log the full span breakdown for a sample of requests slower than the threshold"""
+    total_ms = trace.elapsed_ms()
+    if total_ms < threshold_ms or random.random() >= sample_rate:
+        return
+    slow_logger.warning("Slow request: " + json.dumps({
+        "method": trace.method,
+        "path": trace.path,
+        "status": status_code,
+        "total_ms": round(total_ms, 1),
+        "spans": [{"name": name, "ms": round(duration_ms, 1)} for name, duration_ms in trace.spans]
+    }))
@@ -0,0 +1,6 @@
+import { BACKEND_ADMIN_API_KEY, forwardToBackend } from "@/lib/backend"
+
+export async function GET(request: Request) {
+  const { search } = new URL(request.url)
+  return forwardToBackend(`/api/logs${search}`, {}, BACKEND_ADMIN_API_KEY)
+}
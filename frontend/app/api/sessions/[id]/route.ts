@@ -0,0 +1,25 @@
+import { NextResponse } from "next/server"
+import { forwardToBackend } from "@/lib/backend"
+
+type Params = { params: Promise<{ id: string }> }
+
+export async function GET(_request: Request, { params }: Params) {
+  const { id } = await params
+  return forwardToBackend(`/sessions/${encodeURIComponent(id)}`)
+}
+
+// Send the next user turn; the backend keeps the history, so only the new message goes over the wire
+export async function POST(request: Request, { params }: Params) {
+  const { id } = await params
+  const body = await request.json().catch(() => ({}))
+  if (!body.message || typeof body.message !== 'string') {
+    return NextResponse.json(
+      { error: 'Invalid request: message is required' },
+      { status: 400 }
+    )
+  }
+  return forwardToBackend('/chat', {
+    method: 'POST',
+    body: JSON.stringify({ session_id: id, message: body.message }),
+  })
+}
@@ -0,0 +1,10 @@
+import { forwardToBackend } from "@/lib/backend"
+
+export async function GET() {
+  return forwardToBackend('/sessions')
+}
+
+export async function POST(request: Request) {
+  const body = await request.json().catch(() => ({}))
+  return forwardToBackend('/sessions', { method: 'POST', body: JSON.stringify(body) })
+}
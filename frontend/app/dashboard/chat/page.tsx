@@ -1,3 +1,4 @@
+import { Suspense } from "react"
 import { ChatInterface } from "@/components/dashboard/chat-interface"
 
 export default function ChatPage() {
@@ -8,7 +9,10 @@ export default function ChatPage() {
         <p className="text-muted-foreground">Have a conversation with HuggingMind AI.</p>
       </div>
 
-      <ChatInterface />
+      {/* ChatInterface reads ?session= from the URL */}
+      <Suspense>
+        <ChatInterface />
+      </Suspense>
     </div>
   )
 }
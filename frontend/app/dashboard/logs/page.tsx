@@ -4,6 +4,7 @@ import { Tabs, TabsContent, TabsList, TabsTrigger } from "@/components/ui/tabs"
 import { Table, TableBody, TableCell, TableHead, TableHeader, TableRow } from "@/components/ui/table"
 import { Badge } from "@/components/ui/badge"
 import { Clock, AlertCircle, CheckCircle, Search } from "lucide-react"
+import { RequestLogTable } from "@/components/dashboard/request-log-table"
 
 export default function LogsPage() {
   // Sample log data
@@ -81,8 +82,9 @@ export default function LogsPage() {
       </div>
 
       <Tabs defaultValue="chat" className="w-full">
-        <TabsList className="grid w-full grid-cols-2">
+        <TabsList className="grid w-full grid-cols-3">
           <TabsTrigger value="chat">Chat History</TabsTrigger>
+          <TabsTrigger value="requests">API Requests</TabsTrigger>
           <TabsTrigger value="system">System Logs</TabsTrigger>
         </TabsList>
 
@@ -122,6 +124,18 @@ export default function LogsPage() {
           </Card>
         </TabsContent>
 
+        <TabsContent value="requests" className="mt-6">
+          <Card>
+            <CardHeader>
+              <CardTitle>API Requests</CardTitle>
+              <CardDescription>Every request served by the backend, newest first.</CardDescription>
+            </CardHeader>
+            <CardContent>
+              <RequestLogTable />
+            </CardContent>
+          </Card>
+        </TabsContent>
+
         <TabsContent value="system" className="mt-6">
           <Card>
             <CardHeader>
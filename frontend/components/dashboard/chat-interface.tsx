@@ -6,6 +6,8 @@ import { Input } from "@/components/ui/input"
 import { Card } from "@/components/ui/card"
 import { SendIcon, Loader2, User, Sparkles, MessageSquare } from "lucide-react"
 import { cn } from "@/lib/utils"
+import { useRouter, useSearchParams } from "next/navigation"
+import { createSession, getSession, sendSessionMessage } from "@/lib/api"
 
 interface Message {
   id: string
@@ -20,6 +22,30 @@ export function ChatInterface() {
   const [isLoading, setIsLoading] = useState(false)
   const [error, setError] = useState<string | null>(null)
   const messagesEndRef = useRef<HTMLDivElement>(null)
+  const router = useRouter()
+  const sessionParam = useSearchParams().get("session")
+  // The session this page is talking to; set before the URL changes so a new session is not reloaded
+  const sessionRef = useRef<string | null>(null)
+
+  useEffect(() => {
+    if (!sessionParam || sessionParam === sessionRef.current) return
+    sessionRef.current = sessionParam
+    setError(null)
+    getSession(sessionParam)
+      .then((session) =>
+        setMessages(
+          session.transcript
+            .filter((turn) => turn.role === "user" || turn.role === "assistant")
+            .map((turn, index) => ({
+              id: `${session.id}-${index}`,
+              role: turn.role as Message["role"],
+              content: turn.content,
+              timestamp: new Date(session.updated_at),
+            }))
+        )
+      )
+      .catch((error) => setError(error instanceof Error ? error.message : "Failed to load session"))
+  }, [sessionParam])
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" })
@@ -45,29 +71,27 @@ export function ChatInterface() {
     setError(null)
 
     try {
-      const res = await fetch("/api/chat", {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-        },
-        body: JSON.stringify({ prompt: input }),
-      })
-
-      const data = await res.json()
-      
-      if (!res.ok) {
-        throw new Error(data.error || "Failed to fetch response")
+      let sessionId = sessionRef.current
+      if (!sessionId) {
+        // Keep the conversation on the server and in the URL so a reload picks it up again
+        const session = await createSession()
+        sessionId = sessionRef.current = session.id
+        router.replace(`/dashboard/chat?session=${session.id}`)
       }
+      const response = await sendSessionMessage(sessionId, userMessage.content)
 
       const assistantMessage: Message = {
         id: (Date.now() + 1).toString(),
         role: "assistant",
-        content: data.response,
+        content: response,
         timestamp: new Date(),
       }
       setMessages((prev) => [...prev, assistantMessage])
     } catch (error) {
       console.error("Error:", error)
+      // The server dropped the unanswered turn, so drop it here too
+      setMessages((prev) => prev.filter((message) => message.id !== userMessage.id))
+      setInput(userMessage.content)
       setError(error instanceof Error ? error.message : "An error occurred while processing your request.")
     } finally {
       setIsLoading(false)
@@ -0,0 +1,77 @@
+"use client"
+import { Button } from "@/components/ui/button"
+import { Badge } from "@/components/ui/badge"
+import { Table, TableBody, TableCell, TableHead, TableHeader, TableRow } from "@/components/ui/table"
+import { useEffect, useState } from "react"
+import { listRequestLogs, type RequestLogEntry } from "@/lib/api"
+
+export function RequestLogTable() {
+  const [entries, setEntries] = useState<RequestLogEntry[]>([])
+  const [cursor, setCursor] = useState<string | undefined>()
+  const [error, setError] = useState<string | null>(null)
+
+  const loadPage = (after?: string) => {
+    listRequestLogs(after ? { cursor: after } : {})
+      .then((page) => {
+        setEntries((previous) => (after ? [...previous, ...page.entries] : page.entries))
+        setCursor(page.next_cursor)
+        setError(null)
+      })
+      .catch((error) => {
+        console.error("Failed to load request logs:", error)
+        setError(error instanceof Error ? error.message : "Failed to load request logs")
+      })
+  }
+
+  useEffect(() => {
+    loadPage()
+  }, [])
+
+  return (
+    <div className="space-y-4">
+      {error && (
+        <div className="p-4 bg-red-50 text-red-700 rounded-lg">
+          <p>{error}</p>
+        </div>
+      )}
+      <Table>
+        <TableHeader>
+          <TableRow>
+            <TableHead>Time</TableHead>
+            <TableHead>Endpoint</TableHead>
+            <TableHead className="text-right">Tokens</TableHead>
+            <TableHead className="text-right">Latency</TableHead>
+            <TableHead className="text-right">Status</TableHead>
+          </TableRow>
+        </TableHeader>
+        <TableBody>
+          {entries.map((entry) => (
+            <TableRow key={entry.request_id}>
+              <TableCell className="font-mono text-xs">{new Date(entry.timestamp).toLocaleString()}</TableCell>
+              <TableCell className="font-mono text-xs">
+                {entry.method} {entry.endpoint}
+              </TableCell>
+              <TableCell className="text-right">
+                {entry.prompt_tokens != null ? (entry.prompt_tokens ?? 0) + (entry.completion_tokens ?? 0) : "-"}
+              </TableCell>
+              <TableCell className="text-right">{Math.round(entry.latency_ms)} ms</TableCell>
+              <TableCell className="text-right">
+                <Badge
+                  variant="outline"
+                  className={entry.status < 400 ? "bg-green-50 text-green-700 hover:bg-green-50" : "bg-red-50 text-red-700 hover:bg-red-50"}
+                >
+                  {entry.status}
+                </Badge>
+              </TableCell>
+            </TableRow>
+          ))}
+        </TableBody>
+      </Table>
+      {cursor && (
+        <Button variant="outline" onClick={() => loadPage(cursor)}>
+          Load more
+        </Button>
+      )}
+    </div>
+  )
+}
@@ -3,39 +3,22 @@ import { Card, CardContent, CardDescription, CardHeader, CardTitle } from "@/com
 import { Button } from "@/components/ui/button"
 import { MessageSquare, Clock, ArrowRight } from "lucide-react"
 import { useRouter } from "next/navigation"
+import { useEffect, useState } from "react"
+import { listSessions, type SessionSummary } from "@/lib/api"
 
 export function SavedSessions() {
   const router = useRouter()
 
-  // Sample saved sessions
-  const savedSessions = [
-    {
-      id: "session-1",
-      title: "Quantum Computing Explanation",
-      preview: "How does quantum computing work?",
-      timestamp: "May 15, 2023 • 2:32 PM",
-      messages: 8,
-    },
-    {
-      id: "session-2",
-      title: "React Best Practices",
-      preview: "What are the best practices for React?",
-      timestamp: "May 15, 2023 • 11:05 AM",
-      messages: 12,
-    },
-    {
-      id: "session-3",
-      title: "AI History Summary",
-      preview: "Summarize the history of artificial intelligence",
-      timestamp: "May 14, 2023 • 7:45 PM",
-      messages: 5,
-    },
-  ]
+  const [savedSessions, setSavedSessions] = useState<SessionSummary[]>([])
+
+  useEffect(() => {
+    listSessions()
+      .then((sessions) => setSavedSessions(sessions.slice(0, 3)))
+      .catch((error) => console.error("Failed to load sessions:", error))
+  }, [])
 
   const loadSession = (sessionId: string) => {
-    // In a real app, this would load the session data
-    console.log("Loading session:", sessionId)
-    router.push("/dashboard/chat")
+    router.push(`/dashboard/chat?session=${sessionId}`)
   }
 
   return (
@@ -72,7 +55,7 @@ export function SavedSessions() {
                     <p className="text-sm text-muted-foreground line-clamp-1">{session.preview}</p>
                     <div className="flex items-center gap-2 mt-1">
                       <Clock className="h-3 w-3 text-muted-foreground" />
-                      <p className="text-xs text-muted-foreground">{session.timestamp}</p>
+                      <p className="text-xs text-muted-foreground">{new Date(session.updated_at).toLocaleString()}</p>
                     </div>
                   </div>
                 </div>
@@ -146,4 +146,89 @@ export async function listUploads(): Promise<FileResponse[]> {
   }
 
   return response.json();
-} 
\ No newline at end of file
+} 
+export interface SessionSummary {
+  id: string;
+  title: string;
+  preview: string;
+  created_at: string;
+  updated_at: string;
+  messages: number;
+}
+
+export interface SessionDetail extends SessionSummary {
+  transcript: { role: string; content: string }[];
+}
+
+// Session calls go through the Next.js routes under /api/sessions, which add the backend API key
+async function sessionRequest<T>(path: string, init: RequestInit, failure: string): Promise<T> {
+  const response = await fetch(`/api/sessions${path}`, {
+    ...init,
+    headers: {
+      'Content-Type': 'application/json',
+    },
+  });
+
+  if (!response.ok) {
+    const error = await response.json().catch(() => ({ error: failure }));
+    throw new Error(error.error || failure);
+  }
+
+  return response.json();
+}
+
+export async function listSessions(): Promise<SessionSummary[]> {
+  return sessionRequest('', { method: 'GET' }, 'Failed to list sessions');
+}
+
+export async function createSession(title?: string): Promise<SessionSummary> {
+  return sessionRequest('', { method: 'POST', body: JSON.stringify({ title }) }, 'Failed to create session');
+}
+
+export async function getSession(sessionId: string): Promise<SessionDetail> {
+  return sessionRequest(`/${encodeURIComponent(sessionId)}`, { method: 'GET' }, 'Failed to load session');
+}
+
+export async function sendSessionMessage(sessionId: string, message: string): Promise<string> {
+  const data = await sessionRequest<{ response: string }>(
+    `/${encodeURIComponent(sessionId)}`,
+    { method: 'POST', body: JSON.stringify({ message }) },
+    'Failed to fetch response'
+  );
+  return data.response;
+}
+
+export interface RequestLogEntry {
+  timestamp: string;
+  request_id: string;
+  api_key?: string;
+  method: string;
+  endpoint: string;
+  status: number;
+  prompt_tokens?: number;
+  completion_tokens?: number;
+  latency_ms: number;
+}
+
+export interface RequestLogPage {
+  entries: RequestLogEntry[];
+  next_cursor?: string;
+}
+
+export async function listRequestLogs(params: Record<string, string> = {}): Promise<RequestLogPage> {
+  const query = new URLSearchParams(params).toString();
+  // Goes through the Next.js route under /api/logs, which adds the backend admin key
+  const response = await fetch(`/api/logs${query ? `?${query}` : ''}`, {
+    method: 'GET',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+  });
+
+  if (!response.ok) {
+    const error = await response.json().catch(() => ({ error: 'Failed to list request logs' }));
+    throw new Error(error.error || 'Failed to list request logs');
+  }
+
+  return response.json();
+}
@@ -0,0 +1,30 @@
+import { NextResponse } from "next/server"
+
+const BACKEND_URL = process.env.NEXT_PUBLIC_API_URL || 'https://web-production-cc82b.up.railway.app'
+// Sessions belong to the API key that created them, so every dashboard call uses the same one
+const BACKEND_API_KEY = process.env.BACKEND_API_KEY || 'test-key'
+// Admin-only routes such as /api/logs need a key listed in the backend's ADMIN_API_KEYS
+export const BACKEND_ADMIN_API_KEY = process.env.BACKEND_ADMIN_API_KEY || BACKEND_API_KEY
+
+export async function forwardToBackend(path: string, init: RequestInit = {}, apiKey: string = BACKEND_API_KEY) {
+  try {
+    const response = await fetch(`${BACKEND_URL}${path}`, {
+      ...init,
+      headers: {
+        'Content-Type': 'application/json',
+        'Authorization': `Bearer ${apiKey}`,
+      },
+    })
+    const data = await response.json().catch(() => ({ detail: response.statusText }))
+    if (!response.ok) {
+      return NextResponse.json({ error: data.detail || 'Backend error' }, { status: response.status })
+    }
+    return NextResponse.json(data)
+  } catch (fetchError) {
+    console.error('Fetch error:', fetchError)
+    return NextResponse.json(
+      { error: 'Could not connect to the AI backend. Please try again in a few minutes.' },
+      { status: 503 }
+    )
+  }
+}
@@ -0,0 +1,170 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Allow running as `python scripts/check_downloader.py` from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.models.downloader import ModelDownloader, ChecksumMismatch
+
+CHUNK_SIZE = 1 << 20
+
+class FileServer(ThreadingHTTPServer):
+    """Serves one payload with single-range support, counting requests and cutting chosen ranges short once"""
+
+    daemon_threads = True
+
+    def __init__(self, payload: bytes):
+        super().__init__(("127.0.0.1", 0), RangeHandler)
+        self.payload = payload
+        self.ranges = True
+        self.fail_starts = set()
+        self.range_requests = 0
+        self.full_requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/model.gguf"
+
+class RangeHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _headers(self, status: int, length: int, extra=()):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", '"payload-v1"')
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        for name, value in extra:
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._headers(200, len(self.server.payload))
+
+    def do_GET(self):
+        payload = self.server.payload
+        header = self.headers.get("Range")
+        if not (header and self.server.ranges):
+            with self.server.lock:
+                self.server.full_requests += 1
+            self._headers(200, len(payload))
+            self.wfile.write(payload)
+            return
+        start, end = (int(part) for part in header.split("=", 1)[1].split("-"))
+        with self.server.lock:
+            self.server.range_requests += 1
+            fail = start in self.server.fail_starts
+            self.server.fail_starts.discard(start)
+        body = payload[start:end + 1]
+        self._headers(206, len(body), [("Content-Range", f"bytes {start}-{end}/{len(payload)}")])
+        if fail:
+            # Promise the whole range, send half of it and drop the connection
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Exercise the model downloader against a local HTTP server with range support")
+    parser.add_argument("--size-mb", type=int, default=8, help="Payload size in MiB")
+    parser.add_argument("--connections", type=int, default=4, help="Parallel range requests")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    return parser.parse_args()
+
+def check_parallel(server, workdir, payload_sha, chunks, connections):
+    server.range_requests = 0
+    dest = os.path.join(workdir, "parallel.gguf")
+    ModelDownloader(server.url, dest, sha256=payload_sha, connections=connections, chunk_size=CHUNK_SIZE).download()
+    ok = open(dest, "rb").read() == server.payload and server.range_requests == chunks
+    return ok, f"{server.range_requests} range requests for {chunks} chunks"
+
+def check_resume(server, workdir, payload_sha, chunks, connections):
+    server.range_requests = 0
+    dest = os.path.join(workdir, "resume.gguf")
+    broken = {1, chunks - 2}
+    server.fail_starts = {index * CHUNK_SIZE for index in broken}
+    downloader = ModelDownloader(server.url, dest, sha256=payload_sha, connections=connections, chunk_size=CHUNK_SIZE)
+    try:
+        downloader.download()
+        return False, "first attempt should have failed"
+    except OSError:
+        pass
+    with open(dest + ".part.json") as f:
+        done = set(json.load(f)["done"])
+    first = server.range_requests
+    server.range_requests = 0
+    ModelDownloader(server.url, dest, sha256=payload_sha, connections=connections, chunk_size=CHUNK_SIZE).download()
+    ok = (
+        done == set(range(chunks)) - broken
+        and server.range_requests == len(broken)
+        and open(dest, "rb").read() == server.payload
+        and not os.path.exists(dest + ".part.json")
+    )
+    return ok, f"interrupted after {first} range requests with {len(done)}/{chunks} chunks done; resume fetched {server.range_requests}"
+
+def check_no_ranges(server, workdir, payload_sha, chunks, connections):
+    server.ranges = False
+    server.range_requests = server.full_requests = 0
+    dest = os.path.join(workdir, "stream.gguf")
+    try:
+        ModelDownloader(server.url, dest, sha256=payload_sha, connections=connections, chunk_size=CHUNK_SIZE).download()
+    finally:
+        server.ranges = True
+    ok = open(dest, "rb").read() == server.payload and server.full_requests == 1 and server.range_requests == 0
+    return ok, f"{server.full_requests} full request, {server.range_requests} range requests"
+
+def check_mismatch(server, workdir, payload_sha, chunks, connections):
+    dest = os.path.join(workdir, "mismatch.gguf")
+    try:
+        ModelDownloader(server.url, dest, sha256="0" * 64, connections=connections, chunk_size=CHUNK_SIZE).download()
+        return False, "wrong digest was accepted"
+    except ChecksumMismatch:
+        pass
+    leftovers = [path for path in (dest, dest + ".part", dest + ".part.json") if os.path.exists(path)]
+    return not leftovers, f"left behind: {leftovers}" if leftovers else "rejected, no partial files kept"
+
+CHECKS = [
+    ("parallel ranges", check_parallel),
+    ("resume after interruption", check_resume),
+    ("no range support", check_no_ranges),
+    ("checksum mismatch", check_mismatch),
+]
+
+def main():
+    args = parse_args()
+    payload = os.urandom(args.size_mb * CHUNK_SIZE + 12345)
+    payload_sha = hashlib.sha256(payload).hexdigest()
+    chunks = (len(payload) + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+    server = FileServer(payload)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for name, check in CHECKS:
+                try:
+                    ok, detail = check(server, workdir, payload_sha, chunks, args.connections)
+                except Exception as e:
+                    ok, detail = False, f"{type(e).__name__}: {e}"
+                results.append({"check": name, "ok": ok, "detail": detail})
+    finally:
+        server.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(f"{'PASS' if result['ok'] else 'FAIL':<6}{result['check']:<28}{result['detail']}")
+    if not all(result["ok"] for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
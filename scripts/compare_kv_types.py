@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+# Allow running as `python scripts/compare_kv_types.py` from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import get_settings
+from app.models.kv_cache import load_llama, model_kv_bytes_per_token
+
+PROMPTS = [
+    "User: What is the capital of France?\nAssistant:",
+    "User: Explain in two sentences why the sky is blue.\nAssistant:",
+    "User: Write a Python function that reverses a string.\nAssistant:",
+    "User: List three uses of a paperclip.\nAssistant:",
+    "System: You are a terse assistant.\nUser: Summarize the plot of Hamlet.\nAssistant:",
+]
+DEFAULT_CONFIGS = "f16/f16,q8_0/f16,q4_0/f16,q8_0/q8_0,q4_0/q4_0"
+
+def parse_args():
+    settings = get_settings()
+    parser = argparse.ArgumentParser(description="Compare speed and output divergence of KV cache types on a fixed prompt set")
+    parser.add_argument("--model", default=settings.MODEL_PATH, help="GGUF model (defaults to MODEL_PATH)")
+    parser.add_argument("--configs", default=DEFAULT_CONFIGS, help="Comma-separated K/V type pairs; the first is the baseline")
+    parser.add_argument("--ctx", type=int, default=settings.CONTEXT_LENGTH)
+    parser.add_argument("--threads", type=int, default=settings.THREADS)
+    parser.add_argument("--batch", type=int, default=settings.N_BATCH)
+    parser.add_argument("--max-tokens", type=int, default=64, help="Greedy tokens generated per prompt")
+    parser.add_argument("--flash-attn", action="store_true", help="Request flash attention where the build supports it")
+    parser.add_argument("--prompts", help="JSON file with a list of prompts to use instead of the built-in set")
+    parser.add_argument("--json", action="store_true", help="Print the full results as JSON")
+    return parser.parse_args()
+
+def log_softmax(logits):
+    shifted = logits - logits.max()
+    return shifted - np.log(np.exp(shifted).sum())
+
+def run_prompt(llm, prompt, max_tokens):
+    """Greedy tokens, the first-step log-probabilities and prompt/decode seconds"""
+    tokens = llm.tokenize(prompt.encode("utf-8"), add_bos=True)
+    llm.reset()
+    started = time.perf_counter()
+    llm.eval(tokens)
+    prompt_seconds = time.perf_counter() - started
+    first = log_softmax(np.array(llm.scores[llm.n_tokens - 1], dtype=np.float32))
+
+    generated = []
+    started = time.perf_counter()
+    for _ in range(max_tokens):
+        if llm.n_tokens >= llm.n_ctx():
+            break
+        token = int(np.argmax(llm.scores[llm.n_tokens - 1]))
+        if token == llm.token_eos():
+            break
+        generated.append(token)
+        llm.eval([token])
+    decode_seconds = time.perf_counter() - started
+    return {
+        "prompt_tokens": len(tokens),
+        "tokens": generated,
+        "first_logprobs": first,
+        "prompt_seconds": prompt_seconds,
+        "decode_seconds": decode_seconds,
+    }
+
+def divergence(baseline, result):
+    """How far greedy output and the first-step distribution moved from the baseline"""
+    expected, actual = baseline["tokens"], result["tokens"]
+    first_mismatch = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), None)
+    if first_mismatch is None and len(expected) != len(actual):
+        first_mismatch = min(len(expected), len(actual))
+    matching = sum(a == b for a, b in zip(expected, actual))
+    p = np.exp(baseline["first_logprobs"])
+    kl = max(float(np.sum(p * (baseline["first_logprobs"] - result["first_logprobs"]))), 0.0)
+    return {
+        "token_agreement": matching / max(len(expected), 1),
+        "first_mismatch": first_mismatch,
+        "first_step_kl": kl,
+    }
+
+def main():
+    args = parse_args()
+    prompts = PROMPTS
+    if args.prompts:
+        with open(args.prompts) as f:
+            prompts = json.load(f)
+
+    results = []
+    baseline = None
+    for config in args.configs.split(","):
+        type_k, type_v = config.strip().split("/")
+        llm, resolved = load_llama(
+            type_k=type_k,
+            type_v=type_v,
+            flash_attn=args.flash_attn,
+            model_path=args.model,
+            n_ctx=args.ctx,
+            n_threads=args.threads,
+            n_batch=args.batch,
+            verbose=False
+        )
+        try:
+            runs = [run_prompt(llm, prompt, args.max_tokens) for prompt in prompts]
+            per_token = model_kv_bytes_per_token(llm, resolved["type_k"], resolved["type_v"])
+        finally:
+            del llm
+
+        prompt_tokens = sum(run["prompt_tokens"] for run in runs)
+        decode_tokens = sum(len(run["tokens"]) for run in runs)
+        result = {
+            "requested": f"{type_k}/{type_v}",
+            "effective": f"{resolved['type_k']}/{resolved['type_v']}",
+            "flash_attn": resolved["flash_attn"],
+            "notes": resolved["notes"],
+            "kv_bytes_per_token": per_token,
+            "kv_cache_mb": round(per_token * args.ctx / (1 << 20), 2),
+            "prompt_tps": round(prompt_tokens / max(sum(run["prompt_seconds"] for run in runs), 1e-9), 2),
+            "decode_tps": round(decode_tokens / max(sum(run["decode_seconds"] for run in runs), 1e-9), 2),
+        }
+        if baseline is None:
+            baseline = runs
+        else:
+            scores = [divergence(expected, run) for expected, run in zip(baseline, runs)]
+            result["token_agreement"] = round(float(np.mean([s["token_agreement"] for s in scores])), 4)
+            result["mean_first_step_kl"] = round(float(np.mean([s["first_step_kl"] for s in scores])), 6)
+            result["identical_outputs"] = sum(s["first_mismatch"] is None for s in scores)
+            result["first_mismatch"] = [s["first_mismatch"] for s in scores]
+        results.append(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{len(prompts)} prompts, {args.max_tokens} greedy tokens each, n_ctx={args.ctx}; baseline {results[0]['effective']}")
+    print(f"{'K/V':<12}{'effective':<12}{'KV MB':>10}{'prompt t/s':>12}{'decode t/s':>12}{'agreement':>11}{'KL':>11}{'identical':>11}")
+    for result in results:
+        agreement = f"{result['token_agreement']:.1%}" if "token_agreement" in result else "-"
+        kl = f"{result['mean_first_step_kl']:.2e}" if "mean_first_step_kl" in result else "-"
+        identical = f"{result['identical_outputs']}/{len(prompts)}" if "identical_outputs" in result else "-"
+        print(
+            f"{result['requested']:<12}{result['effective']:<12}{result['kv_cache_mb']:>10}"
+            f"{result['prompt_tps']:>12}{result['decode_tps']:>12}{agreement:>11}{kl:>11}{identical:>11}"
+        )
+        for note in result["notes"]:
+            print(f"    {note}")
+
+if __name__ == "__main__":
+    main()
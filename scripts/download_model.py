@@ -1,46 +1,55 @@
 import os
 import sys
-import requests
+import argparse
 from tqdm import tqdm
 
-def download_file(url, destination):
-    """Download a file with progress bar"""
-    # Add Hugging Face user agent
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    }
-    
-    response = requests.get(url, stream=True, headers=headers)
-    total_size = int(response.headers.get('content-length', 0))
-    
-    os.makedirs(os.path.dirname(destination), exist_ok=True)
-    
-    with open(destination, 'wb') as f, tqdm(
-        desc=os.path.basename(destination),
-        total=total_size,
-        unit='iB',
-        unit_scale=True,
-        unit_divisor=1024,
-    ) as pbar:
-        for data in response.iter_content(chunk_size=1024):
-            size = f.write(data)
-            pbar.update(size)
+# Allow running as `python scripts/download_model.py` from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import get_settings
+from app.models.downloader import ModelDownloader, DownloadError, load_expected_sha256
+
+def parse_args():
+    settings = get_settings()
+    parser = argparse.ArgumentParser(description="Download and verify the GGUF model")
+    parser.add_argument("--url", default=settings.MODEL_URL, help="Model URL (defaults to MODEL_URL)")
+    parser.add_argument("--dest", default=settings.MODEL_PATH, help="Destination path (defaults to MODEL_PATH)")
+    parser.add_argument("--sha256", default=settings.MODEL_SHA256 or None, help="Expected SHA256 digest")
+    parser.add_argument("--manifest", default=settings.MODEL_MANIFEST or None, help="JSON manifest of file name -> sha256")
+    parser.add_argument("--connections", type=int, default=settings.DOWNLOAD_CONNECTIONS, help="Parallel range requests")
+    parser.add_argument("--chunk-mb", type=int, default=settings.DOWNLOAD_CHUNK_MB, help="Range size in MiB")
+    parser.add_argument("--force", action="store_true", help="Download even if the destination exists")
+    return parser.parse_args()
 
 def main():
-    # Your specific Hugging Face model URL
-    model_url = "https://huggingface.co/Jazhanma0074/llama-2-7b-chat-gguf/resolve/main/model-q4_k_m.gguf?download=true"
-    
-    # Destination path in Render
-    model_path = "/opt/render/project/src/models/model-q4_k_m.gguf"
-    
-    print(f"Downloading model from Hugging Face Hub...")
-    print(f"Destination: {model_path}")
+    args = parse_args()
+
+    if os.path.exists(args.dest) and not args.force:
+        print(f"Model already present at {args.dest}")
+        return
+
+    print(f"Downloading model from {args.url}")
+    print(f"Destination: {args.dest}")
     try:
-        download_file(model_url, model_path)
+        sha256 = load_expected_sha256(args.url, args.manifest, args.sha256)
+        with tqdm(desc=os.path.basename(args.dest), unit='iB', unit_scale=True, unit_divisor=1024) as pbar:
+            def progress(downloaded, total):
+                pbar.total = total or None
+                pbar.n = downloaded
+                pbar.refresh()
+
+            ModelDownloader(
+                args.url,
+                args.dest,
+                sha256=sha256,
+                connections=args.connections,
+                chunk_size=args.chunk_mb << 20,
+                progress=progress
+            ).download()
         print("Model downloaded successfully!")
-    except Exception as e:
+    except (DownloadError, OSError) as e:
         print(f"Error downloading model: {e}")
         sys.exit(1)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
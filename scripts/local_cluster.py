@@ -0,0 +1,73 @@
+import os
+import sys
+import argparse
+import signal
+import subprocess
+
+# Child processes run from the project root so `app` is importable
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run several HuggingMind instances behind the router on one machine")
+    parser.add_argument("--instances", type=int, default=2, help="Number of backend processes")
+    parser.add_argument("--base-port", type=int, default=8001, help="Port of the first backend")
+    parser.add_argument("--router-port", type=int, default=8000, help="Port the router listens on")
+    parser.add_argument("--data-dir", default=os.path.join(ROOT, "data", "cluster"), help="Parent of the per-instance data directories")
+    return parser.parse_args()
+
+def instance_env(index: int, port: int, instances: int, data_dir: str) -> dict:
+    """Environment for one backend, with the state each process writes kept in its own directory
+
+    Request logs, the tuning profile and the optional warm-state, snapshot and capture
+    files are written by one process at a time; API keys and usage stay in the shared
+    database so a key works on every instance.
+    """
+    instance_dir = os.path.join(data_dir, f"instance-{index}")
+    os.makedirs(instance_dir, exist_ok=True)
+    env = {
+        **os.environ,
+        "PORT": str(port),
+        # Each instance takes its own slice of cores when CPU_PINNING is on
+        "CPU_PIN_WORKER": str(index),
+        "CPU_PIN_WORKERS": str(instances),
+        "REQUEST_LOG_DIR": os.path.join(instance_dir, "request_logs"),
+        "AUTOTUNE_PROFILE_PATH": os.path.join(instance_dir, "tuning_profiles.json"),
+    }
+    # Optional features stay off unless configured, but never share a file
+    for name in ("WARM_STATE_PATH", "TEMPLATE_SNAPSHOT_DIR", "CAPTURE_PATH"):
+        if os.environ.get(name):
+            env[name] = os.path.join(instance_dir, os.path.basename(os.environ[name].rstrip("/")))
+    return env
+
+def main():
+    args = parse_args()
+    processes = []
+    urls = []
+    for i in range(args.instances):
+        port = args.base_port + i
+        urls.append(f"http://127.0.0.1:{port}")
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--workers", "1"],
+            cwd=ROOT,
+            env=instance_env(i, port, args.instances, args.data_dir)
+        ))
+    processes.append(subprocess.Popen(
+        [sys.executable, "-m", "app.router", "--backends", ",".join(urls), "--host", "127.0.0.1", "--port", str(args.router_port)],
+        cwd=ROOT
+    ))
+    print(f"Router on http://127.0.0.1:{args.router_port} -> {', '.join(urls)}")
+
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for process in processes:
+            process.wait()
+
+if __name__ == "__main__":
+    main()
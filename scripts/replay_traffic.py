@@ -0,0 +1,289 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import Dict, List, Optional
+import httpx
+import websockets
+
+# Allow running as `python scripts/replay_traffic.py` from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.models.memory import estimate_tokens
+
+WORDS = (
+    "the of and to in is it that for on was with as be at by this have from or one had not but what all were when "
+    "we there can an your which their said if do will each about how up out them then she many some so these would "
+    "other into has more her two like him see time could no make than first been its who now people my made over"
+).split()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Re-issue a captured trace (CAPTURE_PATH) against a server and report latency per request class")
+    parser.add_argument("capture", help="JSON Lines file written with CAPTURE_PATH set")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Server to replay against")
+    parser.add_argument("--api-key", default="test-key")
+    parser.add_argument("--speed", type=float, default=1.0, help="Arrival-time acceleration; 1 replays in real time")
+    parser.add_argument("--limit", type=int, default=0, help="Replay only the first N captured requests")
+    parser.add_argument("--buckets", default="128,1024", help="Prompt-token bounds separating short, medium and long requests")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per-request timeout in seconds")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    return parser.parse_args()
+
+def load_capture(path: str, limit: int) -> List[Dict]:
+    records = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            # Each capturing process starts its file with a header line
+            if "capture" not in record:
+                records.append(record)
+    records.sort(key=lambda record: record["ts"])
+    return records[:limit] if limit else records
+
+def synth_text(seed: int, tokens: int) -> str:
+    """Filler text the server's token estimate puts at `tokens`; the same seed always gives the same text"""
+    rng = random.Random(seed)
+    parts: List[str] = []
+    length = 0
+    while estimate_tokens("x" * length) < tokens:
+        word = rng.choice(WORDS)
+        parts.append(word)
+        length += len(word) + 1
+    return " ".join(parts)
+
+def request_class(record: Dict, bounds: List[int]) -> str:
+    endpoint = record["ep"] + ("/stream" if record.get("stream") else "")
+    names = ["short", "medium", "long"]
+    for name, bound in zip(names, bounds):
+        if record.get("pt", 0) < bound:
+            return f"{endpoint} {name}"
+    return f"{endpoint} {names[min(len(bounds), len(names) - 1)]}"
+
+def sampling(record: Dict, index: int) -> Dict:
+    """Recorded sampling parameters; completion length follows what production generated"""
+    body = {"max_tokens": record.get("ct") or record.get("mt")}
+    for name in ("temperature", "top_p", "top_k"):
+        value = record.get("temp" if name == "temperature" else name)
+        if value is not None:
+            body[name] = value
+    if record.get("seeded"):
+        body["seed"] = index
+    return body
+
+class Replayer:
+    def __init__(self, args):
+        self.args = args
+        self.headers = {"Authorization": f"Bearer {args.api_key}"}
+        self.client = httpx.AsyncClient(base_url=args.url, timeout=httpx.Timeout(args.timeout))
+        self.sessions: Dict[str, asyncio.Task] = {}
+        self.sockets: Dict[str, asyncio.Task] = {}
+        self.pending: Dict[str, asyncio.Queue] = {}
+
+    async def close(self):
+        await self.client.aclose()
+        for task in self.sockets.values():
+            if task.done() and not task.exception():
+                await task.result().close()
+
+    async def _session(self, key: str) -> str:
+        response = await self.client.post("/sessions", json={"title": f"replay {key}"})
+        response.raise_for_status()
+        return response.json()["id"]
+
+    async def _socket(self, key: str):
+        """One connection per captured connection, with a reader routing frames to their stream"""
+        socket = await websockets.connect(self.args.url.replace("http", "ws", 1) + "/ws/chat", max_size=None)
+        await socket.send(json.dumps({"type": "auth", "api_key": self.args.api_key}))
+        json.loads(await socket.recv())
+
+        async def read():
+            async for message in socket:
+                frame = json.loads(message)
+                queue = self.pending.get(frame.get("id"))
+                if queue is not None:
+                    queue.put_nowait(frame)
+        asyncio.ensure_future(read())
+        return socket
+
+    async def api_chat(self, record: Dict, index: int) -> Dict:
+        body = {"prompt": synth_text(index, record.get("pt", 1)), "stream": bool(record.get("stream")), **sampling(record, index)}
+        started = time.perf_counter()
+        if not body["stream"]:
+            response = await self.client.post("/api/chat", json=body, headers=self.headers)
+            return {"status": response.status_code, "latency": time.perf_counter() - started}
+        first = None
+        failed = False
+        async with self.client.stream("POST", "/api/chat", json=body, headers=self.headers) as response:
+            async for line in response.aiter_lines():
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                event = json.loads(line[6:])
+                if "text" in event and first is None:
+                    first = time.perf_counter() - started
+                failed = failed or "error" in event
+            status = 500 if failed else response.status_code
+        return {"status": status, "latency": time.perf_counter() - started, "ttft": first}
+
+    async def chat(self, record: Dict, index: int) -> Dict:
+        body = sampling(record, index)
+        if record.get("sess"):
+            # Turns of one captured session go to one replayed session, which holds the history
+            if record["sess"] not in self.sessions:
+                self.sessions[record["sess"]] = asyncio.ensure_future(self._session(record["sess"]))
+            body["session_id"] = await self.sessions[record["sess"]]
+            body["message"] = synth_text(index, record.get("mpt", 1))
+        else:
+            count = max(record.get("msgs", 1), 1)
+            # Alternate roles so the last message is the user's
+            body["messages"] = [
+                {"role": "user" if (count - i) % 2 else "assistant", "content": synth_text(index * 100 + i, max(record.get("pt", 1) // count, 1))}
+                for i in range(count)
+            ]
+        started = time.perf_counter()
+        response = await self.client.post("/chat", json=body)
+        return {"status": response.status_code, "latency": time.perf_counter() - started}
+
+    async def ws_chat(self, record: Dict, index: int) -> Dict:
+        connection = record.get("conn", "default")
+        if connection not in self.sockets:
+            self.sockets[connection] = asyncio.ensure_future(self._socket(connection))
+        socket = await self.sockets[connection]
+        stream_id = f"r{index}"
+        queue: asyncio.Queue = asyncio.Queue()
+        self.pending[stream_id] = queue
+        started = time.perf_counter()
+        first = None
+        try:
+            await socket.send(json.dumps({"type": "chat", "id": stream_id, "prompt": synth_text(index, record.get("pt", 1)), **sampling(record, index)}))
+            while True:
+                frame = await asyncio.wait_for(queue.get(), self.args.timeout)
+                if "t" in frame:
+                    first = first if first is not None else time.perf_counter() - started
+                    continue
+                status = 200 if frame.get("done") else frame.get("code", 499 if frame.get("cancelled") else 500)
+                return {"status": status, "latency": time.perf_counter() - started, "ttft": first}
+        finally:
+            self.pending.pop(stream_id, None)
+
+    async def score(self, record: Dict, index: int) -> Dict:
+        # Captured prompt tokens include the candidates, as in the usage block
+        n, candidate_tokens = record.get("n", 1), record.get("cpt", 1)
+        body = {
+            "prompt": synth_text(index, max(record.get("pt", 1) - n * candidate_tokens, 1)),
+            "candidates": [synth_text(index * 1000 + i, candidate_tokens) for i in range(n)],
+        }
+        started = time.perf_counter()
+        response = await self.client.post("/api/score", json=body, headers=self.headers)
+        return {"status": response.status_code, "latency": time.perf_counter() - started}
+
+    async def issue(self, record: Dict, index: int, due: float) -> Dict:
+        await asyncio.sleep(max(due - time.perf_counter(), 0))
+        lag = time.perf_counter() - due
+        handler = getattr(self, record["ep"], None)
+        if handler is None:
+            return {"status": None, "latency": 0.0, "lag": lag, "skipped": True}
+        try:
+            result = await handler(record, index)
+        except Exception as e:
+            result = {"status": None, "latency": time.perf_counter() - due, "error": str(e)}
+        result["lag"] = lag
+        return result
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+def summarize(records: List[Dict], results: List[Dict], bounds: List[int]) -> Dict[str, Dict]:
+    classes: Dict[str, Dict[str, List]] = {}
+    for record, result in zip(records, results):
+        if result.get("skipped"):
+            continue
+        bucket = classes.setdefault(request_class(record, bounds), {"latency": [], "ttft": [], "captured": [], "errors": 0})
+        if result["status"] != 200:
+            bucket["errors"] += 1
+            continue
+        bucket["latency"].append(result["latency"] * 1000)
+        if result.get("ttft") is not None:
+            bucket["ttft"].append(result["ttft"] * 1000)
+        if record.get("st") == 200 and "lat" in record:
+            bucket["captured"].append(record["lat"])
+
+    def ms(value):
+        return round(value, 1) if value is not None else None
+
+    summary = {}
+    for name, bucket in sorted(classes.items()):
+        summary[name] = {
+            "requests": len(bucket["latency"]) + bucket["errors"],
+            "errors": bucket["errors"],
+            "p50_ms": ms(percentile(bucket["latency"], 0.5)),
+            "p90_ms": ms(percentile(bucket["latency"], 0.9)),
+            "p99_ms": ms(percentile(bucket["latency"], 0.99)),
+            "max_ms": ms(max(bucket["latency"], default=None)),
+            "ttft_p50_ms": ms(percentile(bucket["ttft"], 0.5)),
+            "ttft_p90_ms": ms(percentile(bucket["ttft"], 0.9)),
+            # What the same class saw when it was captured
+            "captured_p50_ms": ms(percentile(bucket["captured"], 0.5)),
+            "captured_p90_ms": ms(percentile(bucket["captured"], 0.9)),
+        }
+    return summary
+
+async def replay(args) -> Dict:
+    records = load_capture(args.capture, args.limit)
+    if not records:
+        raise SystemExit(f"No captured requests in {args.capture}")
+    bounds = [int(bound) for bound in args.buckets.split(",")]
+    replayer = Replayer(args)
+    first = records[0]["ts"]
+    started = time.perf_counter()
+    try:
+        results = await asyncio.gather(*(
+            replayer.issue(record, index, started + (record["ts"] - first) / args.speed)
+            for index, record in enumerate(records)
+        ))
+    finally:
+        await replayer.close()
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(records),
+        "skipped": sum(1 for result in results if result.get("skipped")),
+        "speed": args.speed,
+        "captured_seconds": round(records[-1]["ts"] - first, 3),
+        "replay_seconds": round(elapsed, 3),
+        # How late the replayer itself issued requests; large values mean the client, not the server, was the bottleneck
+        "max_issue_lag_ms": round(max(result["lag"] for result in results) * 1000, 1),
+        "errors": [result["error"] for result in results if "error" in result][:10],
+        "classes": summarize(records, results, bounds),
+    }
+
+def main():
+    args = parse_args()
+    report = asyncio.run(replay(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(
+        f"{report['requests']} requests captured over {report['captured_seconds']}s, replayed at {args.speed}x "
+        f"in {report['replay_seconds']}s (max issue lag {report['max_issue_lag_ms']}ms)"
+    )
+    print(f"{'class':<24}{'n':>6}{'err':>6}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}{'ttft p50':>10}{'ttft p90':>10}{'captured p50':>14}")
+    for name, result in report["classes"].items():
+        cells = [result[field] for field in ("p50_ms", "p90_ms", "p99_ms", "max_ms", "ttft_p50_ms", "ttft_p90_ms")]
+        print(
+            f"{name:<24}{result['requests']:>6}{result['errors']:>6}"
+            + "".join(f"{'-' if value is None else value:>10}" for value in cells)
+            + f"{'-' if result['captured_p50_ms'] is None else result['captured_p50_ms']:>14}"
+        )
+    for error in report["errors"]:
+        print(f"    {error}")
+
+if __name__ == "__main__":
+    main()
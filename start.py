@@ -18,11 +18,6 @@ logger = logging.getLogger(__name__)
 def get_port():
     """Get port from environment with detailed error handling"""
     try:
-        # Log all environment variables for debugging
-        logger.info("Environment variables:")
-        for key, value in os.environ.items():
-            logger.info(f"  {key}: {value!r}")
-        
         # Get raw port value
         port_raw = os.environ.get("PORT", "8000")
         logger.info(f"Raw PORT value: {port_raw!r}")
@@ -93,6 +88,7 @@ def main():
             workers=1,
             log_level="info",
             timeout_keep_alive=120,
+            timeout_graceful_shutdown=5,  # Requests have already been drained on SIGTERM
             reload=False
         )
     except Exception as e:
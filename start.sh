@@ -6,5 +6,12 @@ export PORT="${PORT:-8000}"
 # Print debug information
 echo "Starting server with PORT=$PORT"
 
+# Optional cap on concurrent connections; requests past it get a 503 from uvicorn
+# before reaching the drain, queue and memory admission in the app
+LIMIT_CONCURRENCY_ARGS=()
+if [ -n "$LIMIT_CONCURRENCY" ]; then
+    LIMIT_CONCURRENCY_ARGS=(--limit-concurrency "$LIMIT_CONCURRENCY")
+fi
+
 # Start uvicorn with the correct port
-exec uvicorn app.main:app --host 0.0.0.0 --port "$PORT" --workers 1 --limit-concurrency 1 --timeout-keep-alive 75 --log-level info 
\ No newline at end of file
+exec uvicorn app.main:app --host 0.0.0.0 --port "$PORT" --workers 1 "${LIMIT_CONCURRENCY_ARGS[@]}" --timeout-keep-alive 75 --timeout-graceful-shutdown 5 --log-level info
\ No newline at end of file